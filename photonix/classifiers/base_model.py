@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import json
 import os
@@ -19,6 +20,23 @@ graph_cache = {}
 logger = logging.getLogger(__name__)
 
 
+def map_in_threads(fn, *iterables):
+    '''
+    Like map() but runs on a small thread pool. Used to decode a batch of
+    images in parallel as PIL and TensorFlow release the GIL while decoding.
+    '''
+    iterables = [list(iterable) for iterable in iterables]
+    if len(iterables[0]) < 2:
+        return list(map(fn, *iterables))
+    try:
+        from django.conf import settings
+        num_threads = settings.CLASSIFIER_DECODE_THREADS
+    except Exception:
+        num_threads = 4
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(fn, *iterables))
+
+
 class BaseModel:
     def __init__(self, model_dir=None):
         global graph_cache
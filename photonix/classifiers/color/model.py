@@ -1,6 +1,5 @@
 import operator
 import sys
-from collections import defaultdict
 from colorsys import rgb_to_hsv
 from pathlib import Path
 
@@ -38,6 +37,11 @@ class ColorModel:
             'Black':                ((0, 0, 0),         17),
         }
 
+        # Palette in HSV, worked out once rather than for every pixel
+        self.color_names = list(self.colors)
+        palette_hsv = np.array([rgb_to_hsv(r / 255, g / 255, b / 255) for (r, g, b), _ in self.colors.values()])
+        self.palette_h, self.palette_s, self.palette_v = palette_hsv.T
+
     def predict(self, image_file, image_size=32, min_score=0.005, photo_file=None):
         image = Image.open(image_file)
 
@@ -47,19 +51,27 @@ class ColorModel:
 
         image = image.resize((image_size, image_size), Image.Resampling.BICUBIC)
         pixels = np.asarray(image)
-        pixels = [j for i in pixels for j in i]
-
-        summed_results = defaultdict(int)
-        for i, pixel in enumerate(pixels):
-            best_color = None
-            best_score = 0
-            for name, (target, _) in self.colors.items():
-                score = self.color_distance(pixel, target)
-                if score > best_score:
-                    best_color = name
-                    best_score = score
-            if best_color:
-                summed_results[best_color] += 1
+        if pixels.ndim != 3:
+            pixels = np.asarray(image.convert('RGB'))
+        pixels = pixels.reshape(-1, pixels.shape[-1])[:, :3].astype(np.float64) / 255
+
+        # Score every pixel against every palette color in one go
+        h, s, v = self.rgb_to_hsv_array(pixels)
+        diff_h = 1 - np.abs(h[:, None] - self.palette_h)  # Hue is more highly weighted than saturation and value
+        diff_s = 1 - np.abs(s[:, None] - self.palette_s) * 0.5
+        diff_v = 1 - np.abs(v[:, None] - self.palette_v) * 0.25
+        scores = diff_h * diff_s * diff_v
+
+        # First best color wins ties, as when comparing them one at a time
+        best = np.argmax(scores, axis=1)
+        best = best[scores[np.arange(len(best)), best] > 0]
+
+        # Colors are listed in the order they first appear in the image so
+        # equal scores sort the same way as before
+        color_indexes, first_pixels, counts = np.unique(best, return_index=True, return_counts=True)
+        summed_results = {}
+        for i in np.argsort(first_pixels):
+            summed_results[self.color_names[color_indexes[i]]] = int(counts[i])
 
         averaged_results = {}
         for key, val in summed_results.items():
@@ -70,6 +82,25 @@ class ColorModel:
         sorted_results = sorted(averaged_results.items(), key=operator.itemgetter(1), reverse=True)
         return sorted_results
 
+    def rgb_to_hsv_array(self, rgb):
+        # colorsys.rgb_to_hsv() for an N x 3 array of floats from 0.0 to 1.0,
+        # doing the same operations in the same order so results are identical
+        r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+        maxc = np.maximum(np.maximum(r, g), b)
+        minc = np.minimum(np.minimum(r, g), b)
+        rangec = maxc - minc
+        grey = minc == maxc
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = rangec / maxc
+            rc = (maxc - r) / rangec
+            gc = (maxc - g) / rangec
+            bc = (maxc - b) / rangec
+        h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+        h = (h / 6.0) % 1.0
+        h[grey] = 0.0
+        s[grey] = 0.0
+        return h, s, maxc
+
     def color_distance(self, a, b):
         # Colors are list of 3 floats (RGB) from 0.0 to 1.0
         a_h, a_s, a_v = rgb_to_hsv(a[0] / 255, a[1] / 255, a[2] / 255)
@@ -209,6 +209,28 @@ def preprocess_face(img, target_size=(224, 224), grayscale = False, enforce_dete
 		return img_pixels
 
 
+def preprocess_detected_face(img, detection, target_size=(160, 160)):
+	# Crops and aligns a face using the box and keypoints MTCNN already found in
+	# the full image, so the detector doesn't have to be run again on the crop.
+	x, y, w, h = detection["box"]
+	x, y = max(x, 0), max(y, 0)
+	img = img[int(y):int(y+h), int(x):int(x+w)]
+
+	if img.shape[0] == 0 or img.shape[1] == 0:
+		raise ValueError("Detected face shape is ", img.shape)
+
+	# Only the angle between the eyes is used so full image coordinates are fine
+	keypoints = detection["keypoints"]
+	img = alignment_procedure(img, keypoints["left_eye"], keypoints["right_eye"])
+
+	img = cv2.resize(img, target_size)
+	img_pixels = image.img_to_array(img)
+	img_pixels = np.expand_dims(img_pixels, axis = 0)
+	img_pixels /= 255 #normalize input in [0, 1]
+
+	return img_pixels
+
+
 def find_input_shape(model):
 	# face recognition models have different size of inputs
 	# my environment returns (None, 224, 224, 3) but some people mentioned that they got [(None, 224, 224, 3)]. I think this is because of version issue.
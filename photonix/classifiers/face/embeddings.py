@@ -0,0 +1,231 @@
+import threading
+
+import numpy as np
+
+
+EMBEDDING_SIZE = 128  # FaceNet output size
+EMBEDDING_DTYPE = np.dtype('<f4')
+
+
+def embedding_to_bytes(embedding):
+    return np.asarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def embedding_from_bytes(data):
+    '''Reads a stored embedding without copying it.'''
+    return np.frombuffer(data, dtype=EMBEDDING_DTYPE)
+
+
+def find_nearest(embeddings, source_embedding, k=1):
+    '''
+    Returns (indexes, distances) of the k rows of `embeddings` closest to
+    `source_embedding` by Euclidean distance, nearest first.
+    '''
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    if not len(embeddings):
+        return np.empty(0, dtype=int), np.empty(0)
+    diff = embeddings - np.asarray(source_embedding, dtype=np.float64)
+    distances = np.sqrt(np.sum(diff * diff, axis=1))
+    k = min(k, len(distances))
+    indexes = np.argpartition(distances, k - 1)[:k]
+    indexes = indexes[np.argsort(distances[indexes])]
+    return indexes, distances[indexes]
+
+
+def cluster_embeddings(embeddings, threshold, max_block_elements=16 * 1024 * 1024):
+    '''
+    Groups embeddings so that every pair of faces in a group is within
+    `threshold` of each other (complete linkage). The closest pairs are joined
+    first and two groups are only merged if all of their faces are close, so a
+    chain of similar looking faces can't pull different people together the
+    way connected components of the distance graph would. Distances are
+    worked out a block of rows at a time so memory use stays bounded. Returns
+    a cluster label for each row.
+    '''
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    size = len(embeddings)
+    if not size:
+        return np.empty(0, dtype=int)
+
+    sq_norms = np.einsum('ij,ij->i', embeddings, embeddings)
+    block_size = max(1, max_block_elements // size)
+    rows, cols, sq_distances = [], [], []
+    for start in range(0, size, block_size):
+        block = embeddings[start:start + block_size]
+        # Each pair only needs comparing once so skip rows before this block
+        block_sq_distances = sq_norms[start:start + block_size, None] - 2 * (block @ embeddings[start:].T) + sq_norms[None, start:]
+        block_rows, block_cols = np.nonzero(block_sq_distances < threshold ** 2)
+        # Columns are offset by the same start so this drops each face paired with itself
+        above_diagonal = block_cols > block_rows
+        block_rows, block_cols = block_rows[above_diagonal], block_cols[above_diagonal]
+        rows.append(block_rows + start)
+        cols.append(block_cols + start)
+        sq_distances.append(block_sq_distances[block_rows, block_cols])
+
+    order = np.argsort(np.concatenate(sq_distances), kind='stable')
+    rows = np.concatenate(rows)[order].tolist()
+    cols = np.concatenate(cols)[order].tolist()
+
+    # Cluster -> {other cluster: number of close pairs between them}
+    links = [dict() for _ in range(size)]
+    for i, j in zip(rows, cols):
+        links[i][j] = links[j][i] = 1
+    labels = list(range(size))
+    members = [[i] for i in range(size)]
+
+    for i, j in zip(rows, cols):
+        a, b = labels[i], labels[j]
+        if a == b or links[a].get(b, 0) < len(members[a]) * len(members[b]):
+            continue
+        # Every face in one cluster is close to every face in the other so merge the smaller into the larger
+        if len(members[a]) < len(members[b]):
+            a, b = b, a
+        for member in members[b]:
+            labels[member] = a
+        members[a].extend(members[b])
+        members[b] = []
+        for other, num_links in links[b].items():
+            del links[other][b]
+            if other != a:
+                links[a][other] = links[other][a] = links[a].get(other, 0) + num_links
+        links[b] = {}
+    return np.array(labels)
+
+
+class FaceEmbeddingMatrix:
+    '''
+    All the face embeddings of a library held in memory as an N x 128 float32
+    matrix, with the tag ID and creation time of each row alongside. Searching
+    is a single matrix-vector product so it stays fast with 100k+ faces.
+
+    The matrix is filled from the database on first use. refresh() then only
+    fetches face tags that were added or changed since the last sync, falling
+    back to a full reload if rows have been deleted.
+    '''
+
+    def __init__(self, library_id):
+        self.library_id = library_id
+        self.lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._embeddings = np.empty((0, EMBEDDING_SIZE), dtype=np.float32)
+        self._sq_norms = np.empty(0, dtype=np.float32)
+        self._created_at = np.empty(0, dtype=np.float64)
+        self._tag_ids = []
+        self._photo_tag_ids = []
+        self._rows = {}  # PhotoTag ID -> row number
+        self._size = 0
+        self._num_skipped = 0
+        self.synced_at = None
+
+    def __len__(self):
+        return self._size
+
+    def _queryset(self):
+        from photonix.photos.models import PhotoTag
+        return PhotoTag.objects.filter(photo__library_id=self.library_id, tag__type='F', embedding__isnull=False)
+
+    def _grow(self, num_rows):
+        capacity = len(self._sq_norms)
+        if self._size + num_rows <= capacity:
+            return
+        capacity = max(capacity * 2, self._size + num_rows, 1024)
+        embeddings = np.empty((capacity, EMBEDDING_SIZE), dtype=np.float32)
+        embeddings[:self._size] = self._embeddings[:self._size]
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        created_at = np.empty(capacity, dtype=np.float64)
+        created_at[:self._size] = self._created_at[:self._size]
+        self._embeddings, self._sq_norms, self._created_at = embeddings, sq_norms, created_at
+
+    def add(self, photo_tag_id, tag_id, embedding, created_at):
+        '''Adds a face, or updates it if the PhotoTag is already in the matrix.'''
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self.lock:
+            row = self._rows.get(str(photo_tag_id))
+            if row is None:
+                self._grow(1)
+                row = self._size
+                self._rows[str(photo_tag_id)] = row
+                self._tag_ids.append(str(tag_id))
+                self._photo_tag_ids.append(str(photo_tag_id))
+                self._size += 1
+            else:
+                self._tag_ids[row] = str(tag_id)
+            self._embeddings[row] = embedding
+            self._sq_norms[row] = np.dot(embedding, embedding)
+            self._created_at[row] = created_at.timestamp()
+
+    def _add_rows(self, rows):
+        for photo_tag_id, tag_id, created_at, data in rows:
+            embedding = embedding_from_bytes(data)
+            if len(embedding) != EMBEDDING_SIZE:
+                self._num_skipped += 1
+                continue
+            self.add(photo_tag_id, tag_id, embedding, created_at)
+
+    def refresh(self):
+        from django.utils import timezone
+
+        with self.lock:
+            synced_at = timezone.now()
+            queryset = self._queryset()
+            if self.synced_at is not None:
+                # Only new and edited face tags need fetching
+                self._add_rows(queryset.filter(updated_at__gte=self.synced_at).values_list('id', 'tag_id', 'created_at', 'embedding'))
+                if queryset.count() == self._size + self._num_skipped:
+                    self.synced_at = synced_at
+                    return
+            # First load or some faces have been deleted so start again
+            self._reset()
+            self._add_rows(queryset.values_list('id', 'tag_id', 'created_at', 'embedding').iterator())
+            self.synced_at = synced_at
+
+    def search(self, source_embedding, k=1, created_after=None):
+        '''
+        Returns up to k (tag_id, distance) pairs for the faces nearest to
+        `source_embedding`, nearest first. `created_after` limits the search to
+        faces tagged after that datetime.
+        '''
+        source_embedding = np.asarray(source_embedding, dtype=np.float32)
+        with self.lock:
+            size = self._size
+            if not size:
+                return []
+            # |a - b|^2 = |a|^2 - 2a.b + |b|^2 avoids building an N x 128 difference matrix
+            sq_distances = self._sq_norms[:size] - 2 * (self._embeddings[:size] @ source_embedding) + np.dot(source_embedding, source_embedding)
+            if created_after is not None:
+                sq_distances = np.where(self._created_at[:size] > created_after.timestamp(), sq_distances, np.inf)
+            k = min(k, size)
+            indexes = np.argpartition(sq_distances, k - 1)[:k]
+            indexes = indexes[np.argsort(sq_distances[indexes])]
+            return [(self._tag_ids[i], float(np.sqrt(max(sq_distances[i], 0)))) for i in indexes if np.isfinite(sq_distances[i])]
+
+    def search_within(self, source_embedding, max_distance):
+        '''
+        Returns (photo_tag_id, tag_id, distance) for every face closer than
+        `max_distance` to `source_embedding`, nearest first.
+        '''
+        source_embedding = np.asarray(source_embedding, dtype=np.float32)
+        with self.lock:
+            size = self._size
+            sq_distances = self._sq_norms[:size] - 2 * (self._embeddings[:size] @ source_embedding) + np.dot(source_embedding, source_embedding)
+            indexes = np.nonzero(sq_distances < max_distance ** 2)[0]
+            indexes = indexes[np.argsort(sq_distances[indexes])]
+            return [(self._photo_tag_ids[i], self._tag_ids[i], float(np.sqrt(max(sq_distances[i], 0)))) for i in indexes]
+
+
+_matrices = {}
+_matrices_lock = threading.Lock()
+
+
+def get_embedding_matrix(library_id):
+    '''Returns the shared embedding matrix for a library, loading it on first use.'''
+    with _matrices_lock:
+        matrix = _matrices.get(str(library_id))
+        if matrix is None:
+            matrix = _matrices[str(library_id)] = FaceEmbeddingMatrix(library_id)
+    if matrix.synced_at is None:
+        matrix.refresh()
+    return matrix
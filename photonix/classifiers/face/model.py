@@ -5,6 +5,7 @@ import os
 import sys
 from pathlib import Path
 from random import randint
+from time import time
 
 from annoy import AnnoyIndex
 
@@ -15,6 +16,7 @@ from PIL import Image, ImageOps
 from redis_lock import Lock
 
 from photonix.classifiers.base_model import BaseModel
+from photonix.classifiers.face.embeddings import embedding_from_bytes, embedding_to_bytes, find_nearest, get_embedding_matrix
 from photonix.photos.utils.redis import redis_connection
 
 # Lazy-loaded modules (heavy imports - TensorFlow/Keras based)
@@ -40,13 +42,19 @@ def _ensure_face_libs():
 
 
 GRAPH_FILE = os.path.join('face', 'mtcnn_weights.npy')
+# Library ID -> memory-mapped similarity index, shared by all FaceModel instances in the process
+_similarity_indexes = {}
 DISTANCE_THRESHOLD = 10
+# Name given to faces that don't match anyone already known
+UNKNOWN_PERSON_PREFIX = 'Unknown person '
+REASSIGN_CHUNK_SIZE = 1000
 
 
 class FaceModel(BaseModel):
     name = 'face'
     version = 20210528
     retrained_version = 0
+    retrained_at = None  # Exact time the index build started, retrained_version is only to the second
     library_id = None
     approx_ram_mb = 600
     max_num_workers = 1
@@ -100,10 +108,7 @@ class FaceModel(BaseModel):
                 'facenet': facenet_graph,
             }
 
-    def predict(self, image_file, min_score=0.99, photo_file=None):
-        self._ensure_loaded()  # Lazy load on first use
-
-        # Detects face bounding boxes
+    def load_image(self, image_file, photo_file=None):
         image = Image.open(image_file)
 
         if image.mode != 'RGB':
@@ -117,10 +122,18 @@ class FaceModel(BaseModel):
             # Fallback: just apply EXIF orientation correction
             image = ImageOps.exif_transpose(image)
 
-        image = np.asarray(image)
+        return np.asarray(image)
+
+    def detect_faces(self, image, min_score=0.99):
+        self._ensure_loaded()  # Lazy load on first use
+
+        # Detects face bounding boxes and keypoints
         results = self.graph['mtcnn'].detect_faces(image)
         return list(filter(lambda f: f['confidence'] > min_score, results))
 
+    def predict(self, image_file, min_score=0.99, photo_file=None):
+        return self.detect_faces(self.load_image(image_file, photo_file=photo_file), min_score=min_score)
+
     def crop(self, image_data, box):
         # Calculate crop coordinates with 30% padding, clipped to image boundaries
         x1 = max(box[0] - int(box[2] * 0.3), 0)
@@ -141,21 +154,94 @@ class FaceModel(BaseModel):
         DeepFace, _, _, _ = _ensure_face_libs()
         return DeepFace.represent(np.asarray(image_data), model_name='Facenet', model= self.graph['facenet'])
 
-    def find_closest_face_tag_by_ann(self, source_embedding):
-        # Use ANN index to do quick serach if it has been trained by retrain_face_similarity_index
+    def get_face_embedding_from_detection(self, image, detection):
+        # Aligns using the detection from the whole image rather than running MTCNN on the crop again
+        embedding = self.get_face_embeddings([(image, detection)])[0]
+        if embedding is None:
+            raise ValueError('Detected face is empty')
+        return embedding
+
+    def get_face_embeddings(self, faces, batch_size=None):
+        '''
+        Embeds many faces with one Facenet call per batch instead of one per
+        face. `faces` is a list of (image, detection) pairs which can come from
+        several photos. Returns embeddings in the same order, with None for
+        faces that couldn't be cropped.
+        '''
+        from django.conf import settings
+        if batch_size is None:
+            batch_size = settings.FACE_EMBEDDING_BATCH_SIZE
+        self._ensure_loaded()
+        _ensure_face_libs()
+        from photonix.classifiers.face.deepface.commons import functions
+        input_shape_x, input_shape_y = functions.find_input_shape(self.graph['facenet'])
+
+        embeddings = [None] * len(faces)
+        indexes = []
+        pixels = []
+        for i, (image, detection) in enumerate(faces):
+            try:
+                pixels.append(functions.preprocess_detected_face(image, detection, target_size=(input_shape_y, input_shape_x)))
+                indexes.append(i)
+            except ValueError:
+                pass
+
+        for start in range(0, len(pixels), batch_size):
+            batch = np.concatenate(pixels[start:start + batch_size])
+            for i, embedding in zip(indexes[start:start + batch_size], self.graph['facenet'].predict(batch, verbose=0)):
+                embeddings[i] = embedding.tolist()
+        return embeddings
+
+    def get_similarity_index(self):
+        '''
+        Returns (AnnoyIndex, tag_ids) for the library or (None, None) if it
+        hasn't been trained yet. The index stays memory-mapped between lookups
+        and is only reloaded when the version file changes. A new index is
+        swapped in whole so threads searching the old one are unaffected.
+        '''
         from django.conf import settings
         ann_path = Path(settings.MODEL_DIR) / 'face' / f'{self.library_id}_faces.ann'
         tag_ids_path = Path(settings.MODEL_DIR) / 'face' / f'{self.library_id}_faces_tag_ids.json'
+        version_file = Path(settings.MODEL_DIR) / 'face' / f'{self.library_id}_retrained_version.txt'
 
-        if os.path.exists(ann_path) and os.path.exists(tag_ids_path):
+        cached = _similarity_indexes.get(self.library_id)
+        try:
+            stat = os.stat(version_file)
+        except FileNotFoundError:
+            # Never built or invalidated, so every face is searched by brute force
+            self.retrained_version = 0
+            self.retrained_at = None
+            return None, None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        if not cached or cached['key'] != key:
             embedding_size = 128  # FaceNet output size
             t = AnnoyIndex(embedding_size, 'euclidean')
-            # Ensure ANN index, tag IDs and version files can't be updated while we are reading
-            with Lock(redis_connection, 'face_model_retrain'):
-                self.reload_retrained_model_version()
+            try:
                 t.load(str(ann_path))
                 with open(tag_ids_path) as f:
                     tag_ids = json.loads(f.read())
+            except (OSError, json.decoder.JSONDecodeError):
+                tag_ids = None
+            # Files are replaced before the version file so a mismatch means a rebuild is part way through
+            if tag_ids is None or t.get_n_items() != len(tag_ids):
+                if cached:
+                    self.retrained_version = cached['version']
+                    self.retrained_at = cached['retrained_at']
+                    return cached['index'], cached['tag_ids']
+                return None, None
+            version = self.reload_retrained_model_version()
+            cached = {'key': key, 'index': t, 'tag_ids': tag_ids, 'version': version, 'retrained_at': self.retrained_at}
+            _similarity_indexes[self.library_id] = cached
+
+        self.retrained_version = cached['version']
+        self.retrained_at = cached['retrained_at']
+        return cached['index'], cached['tag_ids']
+
+    def find_closest_face_tag_by_ann(self, source_embedding):
+        # Use ANN index to do quick serach if it has been trained by retrain_face_similarity_index
+        t, tag_ids = self.get_similarity_index()
+        if t is not None:
             nearest = t.get_nns_by_vector(source_embedding, 1, include_distances=True)
             if nearest[0]:
                 return tag_ids[nearest[0][0]], nearest[1][0]
@@ -166,35 +252,21 @@ class FaceModel(BaseModel):
         if not self.library_id and not target_data:
             raise ValueError('No Library ID is set')
 
-        representations = []
         if target_data:  # Mainly as an option for testing
-            for id, embedding in target_data:
-                representations.append((id, embedding))
-        else:
-            # Collect all previously generated embeddings
-            from photonix.photos.models import PhotoTag
-            photo_tags = PhotoTag.objects.filter(photo__library_id=self.library_id, tag__type='F')
-            if oldest_date:
-                photo_tags = photo_tags.filter(created_at__gt=oldest_date)
-            for photo_tag in photo_tags:
-                try:
-                    tag_embedding = json.loads(photo_tag.extra_data)['facenet_embedding']
-                    representations.append((str(photo_tag.tag.id), tag_embedding))
-                except (KeyError, json.decoder.JSONDecodeError):
-                    pass
-
-        # Calculate Euclidean distances
-        _, _, findEuclideanDistance, _ = _ensure_face_libs()
-        distances = []
-        for (_, target_embedding) in representations:
-            distance = findEuclideanDistance(source_embedding, target_embedding)
-            distances.append(distance)
-
-        # Return closest match and distance value
-        if not distances:  # First face added has nothing to compare to
+            indexes, distances = find_nearest([embedding for _, embedding in target_data], source_embedding)
+            return target_data[indexes[0]][0], distances[0]
+
+        # Search all previously generated embeddings in one go
+        nearest = self.find_closest_face_tags(source_embedding, k=1, oldest_date=oldest_date)
+        if not nearest:  # First face added has nothing to compare to
             return (None, 999)
-        index = np.argmin(distances)
-        return (representations[index][0], distances[index])
+        return nearest[0]
+
+    def find_closest_face_tags(self, source_embedding, k=5, oldest_date=None):
+        '''Returns up to k (tag_id, distance) pairs for the library's faces nearest to the embedding.'''
+        if not self.library_id:
+            raise ValueError('No Library ID is set')
+        return get_embedding_matrix(self.library_id).search(source_embedding, k=k, created_after=oldest_date)
 
     def find_closest_face_tag(self, source_embedding):
         if not self.library_id:
@@ -202,9 +274,7 @@ class FaceModel(BaseModel):
 
         ann_nearest, ann_distance = self.find_closest_face_tag_by_ann(source_embedding)
 
-        oldest_date = None
-        if self.retrained_version:
-            oldest_date = dt.datetime.strptime(str(self.retrained_version), '%Y%m%d%H%M%S').replace(tzinfo=dt.timezone.utc)
+        oldest_date = self.retrained_at if self.retrained_version else None
 
         brute_force_nearest, brute_force_distance = self.find_closest_face_tag_by_brute_force(source_embedding, oldest_date=oldest_date)
 
@@ -213,6 +283,36 @@ class FaceModel(BaseModel):
         else:
             return brute_force_nearest, brute_force_distance
 
+    def similarity_index_needs_retrain(self):
+        '''
+        Returns a reason for rebuilding the library's similarity index, or None
+        if it's current enough. A small number of new faces doesn't need a
+        rebuild as find_closest_face_tag() searches faces added since the last
+        build by brute force. Edited or deleted faces always need one as the
+        index would otherwise return stale tags.
+        '''
+        from django.conf import settings
+        from photonix.photos.models import PhotoTag
+        photo_tags = PhotoTag.objects.filter(photo__library_id=self.library_id, tag__type='F', embedding__isnull=False)
+        num_faces = photo_tags.count()
+        if not num_faces:
+            return None
+
+        _, tag_ids = self.get_similarity_index()
+        if tag_ids is None:
+            return f'no index yet for {num_faces} faces'
+
+        version_date = self.retrained_at
+        num_new = photo_tags.filter(created_at__gt=version_date).count()
+        num_edited = photo_tags.filter(created_at__lte=version_date, updated_at__gt=version_date).count()
+        num_deleted = len(tag_ids) - (num_faces - num_new)
+
+        if num_edited or num_deleted > 0:
+            return f'{num_edited} edited and {max(num_deleted, 0)} deleted faces'
+        if num_new >= max(settings.FACE_INDEX_MIN_NEW_FACES, len(tag_ids) * settings.FACE_INDEX_REBUILD_FRACTION):
+            return f'{num_new} new faces'
+        return None
+
     def retrain_face_similarity_index(self, training_data=None):
         if not self.library_id and not training_data:
             raise ValueError('No Library ID is set')
@@ -223,9 +323,12 @@ class FaceModel(BaseModel):
         tag_ids_path = Path(settings.MODEL_DIR) / 'face' / f'{self.library_id}_faces_tag_ids.json'
         version_file = Path(settings.MODEL_DIR) / 'face' / f'{self.library_id}_retrained_version.txt'
 
+        start = time()
         embedding_size = 128  # FaceNet output size
         t = AnnoyIndex(embedding_size, 'euclidean')
-        retrained_version = dt.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        # Faces saved after this are treated as new or edited so it's kept to the microsecond
+        retrained_at = dt.datetime.now(dt.timezone.utc)
+        retrained_version = retrained_at.strftime('%Y%m%d%H%M%S')
 
         tag_ids = []
         if training_data:  # Mainly as an option for testing
@@ -233,30 +336,39 @@ class FaceModel(BaseModel):
                 t.add_item(len(tag_ids), embedding)
                 tag_ids.append(id)
         else:
-            for photo_tag in PhotoTag.objects.filter(tag__type='F').order_by('id'):
-                try:
-                    extra_data = json.loads(photo_tag.extra_data)
-                    embedding = extra_data['facenet_embedding']
+            photo_tags = PhotoTag.objects.filter(photo__library_id=self.library_id, tag__type='F', embedding__isnull=False)
+            for tag_id, data in photo_tags.order_by('id').values_list('tag_id', 'embedding').iterator(chunk_size=2000):
+                embedding = embedding_from_bytes(data)
+                if len(embedding) == embedding_size:
                     t.add_item(len(tag_ids), embedding)
-                    tag_ids.append(str(photo_tag.tag.id))
-                except (json.decoder.JSONDecodeError, KeyError, TypeError):
-                    pass
+                    tag_ids.append(str(tag_id))
 
         # Build the ANN index
         t.build(3)  # Number of random forest trees
 
-        # Aquire lock to save ANN, tag IDs and version files atomically
+        # Aquire lock so only one process writes the ANN, tag IDs and version files at a time
         with Lock(redis_connection, 'face_model_retrain'):
+            # Files are written alongside and moved into place as workers have
+            # the current index memory-mapped. The version file goes last as
+            # it's what workers watch to know when to load the new index.
             # Save ANN index
-            t.save(str(ann_path))
+            t.save(str(ann_path) + '.tmp')
+            os.replace(str(ann_path) + '.tmp', ann_path)
 
             # Save Tag IDs to JSON file as Annoy only supports integer IDs so we have to do the mapping ourselves
-            with open(tag_ids_path, 'w') as f:
+            with open(str(tag_ids_path) + '.tmp', 'w') as f:
                 f.write(json.dumps(tag_ids))
+            os.replace(str(tag_ids_path) + '.tmp', tag_ids_path)
 
-            # Save version of retrained model to text file - used to save against on PhotoTag model and to determine whether retraining is required
-            with open(version_file, 'w') as f:
-                f.write(retrained_version)
+            # Save version of retrained model to text file - used to save against on PhotoTag model and to determine whether retraining is required.
+            # The exact build time goes on the second line.
+            with open(str(version_file) + '.tmp', 'w') as f:
+                f.write(f'{retrained_version}\n{retrained_at.isoformat()}\n')
+            os.replace(str(version_file) + '.tmp', version_file)
+
+        stats = {'num_items': len(tag_ids), 'build_seconds': time() - start, 'version': retrained_version}
+        logger.info(f'Face similarity index for library {self.library_id}: {stats["num_items"]} faces in {stats["build_seconds"]:.3f}s')
+        return stats
 
     def reload_retrained_model_version(self):
         if self.library_id:
@@ -265,18 +377,95 @@ class FaceModel(BaseModel):
             version_date = None
             if os.path.exists(version_file):
                 with open(version_file) as f:
-                    contents = f.read().strip()
-                    version_date = dt.datetime.strptime(contents, '%Y%m%d%H%M%S').replace(tzinfo=dt.timezone.utc)
+                    lines = f.read().split()
+                    version_date = dt.datetime.strptime(lines[0], '%Y%m%d%H%M%S').replace(tzinfo=dt.timezone.utc)
                     self.retrained_version = int(version_date.strftime('%Y%m%d%H%M%S'))
+                    # Files written before the exact time was stored only have the version
+                    self.retrained_at = dt.datetime.fromisoformat(lines[1]) if len(lines) > 1 else version_date
                     return self.retrained_version
         return 0
 
 
+def invalidate_similarity_index(library_id):
+    '''
+    Stops workers using a library's similarity index, e.g. because it refers
+    to tags that have been deleted. Faces are matched by brute force until
+    the index is next rebuilt, which the missing version file triggers.
+    '''
+    from django.conf import settings
+    version_file = Path(settings.MODEL_DIR) / 'face' / f'{library_id}_retrained_version.txt'
+    with Lock(redis_connection, 'face_model_retrain'):
+        try:
+            os.remove(version_file)
+        except FileNotFoundError:
+            pass
+
+
+def reassign_faces(photo_tag_ids, tag_id):
+    '''
+    Moves faces onto another tag in bulk and deletes any unknown person tags
+    left without faces, invalidating the library's similarity index if any
+    were. Returns the number of tags deleted.
+    '''
+    from django.db import transaction
+    from photonix.photos.models import PhotoTag, Tag
+
+    photo_tag_ids = list(photo_tag_ids)
+    old_tag_ids = set()
+    num_deleted = 0
+    now = timezone.now()
+    with transaction.atomic():
+        for i in range(0, len(photo_tag_ids), REASSIGN_CHUNK_SIZE):
+            photo_tags = PhotoTag.objects.filter(id__in=photo_tag_ids[i:i + REASSIGN_CHUNK_SIZE])
+            old_tag_ids.update(photo_tags.values_list('tag_id', flat=True))
+            photo_tags.update(tag_id=tag_id, updated_at=now)
+        old_tag_ids.discard(tag_id)
+        old_tag_ids = list(old_tag_ids)
+        for i in range(0, len(old_tag_ids), REASSIGN_CHUNK_SIZE):
+            num_deleted += Tag.objects.filter(
+                id__in=old_tag_ids[i:i + REASSIGN_CHUNK_SIZE], source='C', name__startswith=UNKNOWN_PERSON_PREFIX, photo_tags__isnull=True
+            ).delete()[1].get('photos.Tag', 0)
+    if num_deleted:
+        invalidate_similarity_index(Tag.objects.values_list('library_id', flat=True).get(id=tag_id))
+    return num_deleted
+
+
+def propagate_face_tag(photo_tag_id, threshold=DISTANCE_THRESHOLD):
+    '''
+    After the user names a face, moves every unverified unknown face in the
+    library within `threshold` of it onto the same tag. Neighbours come from
+    the library's in-memory embedding matrix so only the handful of nearby
+    faces are read from the database. Returns the number of faces moved.
+    '''
+    from photonix.photos.models import PhotoTag
+
+    photo_tag = PhotoTag.objects.select_related('photo').get(id=photo_tag_id)
+    if photo_tag.embedding is None:
+        return 0
+    source_embedding = embedding_from_bytes(photo_tag.embedding)
+
+    matrix = get_embedding_matrix(photo_tag.photo.library_id)
+    matrix.refresh()
+    candidate_ids = [id for id, tag_id, _ in matrix.search_within(source_embedding, threshold) if tag_id != str(photo_tag.tag_id)]
+
+    # Only faces nobody has named or confirmed are moved
+    photo_tag_ids = []
+    for i in range(0, len(candidate_ids), REASSIGN_CHUNK_SIZE):
+        photo_tag_ids.extend(PhotoTag.objects.filter(
+            id__in=candidate_ids[i:i + REASSIGN_CHUNK_SIZE], tag__type='F', tag__source='C', tag__name__startswith=UNKNOWN_PERSON_PREFIX,
+            verified=False, deleted=False).exclude(tag_id=photo_tag.tag_id).values_list('id', flat=True))
+    if not photo_tag_ids:
+        return 0
+
+    reassign_faces(photo_tag_ids, photo_tag.tag_id)
+    return len(photo_tag_ids)
+
+
 def run_on_photo(photo_id):
     from photonix.classifiers.model_manager import get_model_manager
 
     sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-    from photonix.classifiers.runners import get_photo_by_any_type, results_for_model_on_photo, get_or_create_tag
+    from photonix.classifiers.runners import get_photo_by_any_type, get_or_create_tag
 
     photo = get_photo_by_any_type(photo_id)
 
@@ -288,24 +477,26 @@ def run_on_photo(photo_id):
         library_id=photo and photo.library_id
     )
 
-    # Detect all faces in an image
-    photo, results = results_for_model_on_photo(model, photo_id)
-
-    # Read image data so we can extract faces and create embeddings
-    path = photo_id
+    # Detect all faces in an image, keeping hold of the image so the
+    # detections can be cropped and aligned from it directly
     if photo:
-        path = photo.base_image_path
         model.library_id = photo.library_id
-    image_data = Image.open(path)
-
-    # Loop over each face that was detected above
-    for result in results:
-        # Crop individual face + 30% extra in each direction
-        box = result['box']
-        face_image = model.crop(image_data, box)
-        # Generate embedding with Facenet
+        image = model.load_image(photo.base_image_path, photo_file=photo.base_file)
+    else:
+        image = model.load_image(photo_id)
+    results = model.detect_faces(image)
+
+    # Pick up faces tagged or renamed since the last photo
+    if photo:
+        get_embedding_matrix(photo.library_id).refresh()
+
+    # Generate embeddings for all the faces with one Facenet call
+    embeddings = model.get_face_embeddings([(image, result) for result in results])
+
+    for result, embedding in zip(results, embeddings):
+        if embedding is None:
+            continue
         try:
-            embedding = model.get_face_embedding(face_image)
             # Add it to the results
             result['embedding'] = embedding
             if photo:
@@ -322,14 +513,16 @@ def run_on_photo(photo_id):
 
         photo.clear_tags(source='C', type='F')
         for result in results:
-            # Use matched tag if within distance threshold
+            # Use matched tag if within distance threshold. The similarity
+            # index can still refer to a tag that has since been merged away.
+            tag = None
             if result.get('closest_distance', 999) < DISTANCE_THRESHOLD:
-                tag = Tag.objects.get(id=result['closest_tag'], library=photo.library, type='F')
+                tag = Tag.objects.filter(id=result['closest_tag'], library=photo.library, type='F').first()
 
             # Otherwise create new tag
-            else:
+            if tag is None:
                 while True:
-                    random_name = f'Unknown person {randint(0, 999999):06d}'
+                    random_name = f'{UNKNOWN_PERSON_PREFIX}{randint(0, 999999):06d}'
                     try:
                         Tag.objects.get(library=photo.library, name=random_name, type='F', source='C')
                     except Tag.DoesNotExist:
@@ -343,11 +536,14 @@ def run_on_photo(photo_id):
             height = result['box'][3] / photo.base_file.height
             score = result['confidence']
 
-            extra_data = ''
+            embedding = None
             if 'embedding' in result:
-                extra_data = json.dumps({'facenet_embedding': result['embedding']})
+                embedding = embedding_to_bytes(result['embedding'])
 
-            PhotoTag(photo=photo, tag=tag, source='F', confidence=score, significance=score, position_x=x, position_y=y, size_x=width, size_y=height, model_version=model.version, retrained_model_version=model.retrained_version, extra_data=extra_data).save()
+            photo_tag = PhotoTag(photo=photo, tag=tag, source='F', confidence=score, significance=score, position_x=x, position_y=y, size_x=width, size_y=height, model_version=model.version, retrained_model_version=model.retrained_version, embedding=embedding)
+            photo_tag.save()
+            if 'embedding' in result:
+                get_embedding_matrix(photo.library_id).add(photo_tag.id, tag.id, result['embedding'], photo_tag.created_at)
         photo.classifier_color_completed_at = timezone.now()
         photo.classifier_color_version = getattr(model, 'version', 0)
         photo.save()
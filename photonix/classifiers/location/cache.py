@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import copy
+import json
+import threading
+
+from django.conf import settings
+
+from photonix.web.utils import logger
+
+
+CACHE_REDIS_EXPIRY = 7 * 24 * 60 * 60  # Seconds
+LOG_EVERY = 10000  # Lookups between hit rate log lines
+
+
+class LocationCache:
+    '''
+    Remembers reverse-geocoding results by coordinates rounded to a cell, as
+    photos from one trip tend to be taken within a few metres of each other.
+    Results are held in a bounded in-process LRU and, if enabled, shared with
+    other location workers through Redis.
+    '''
+
+    def __init__(self, version, precision=None, size=None, use_redis=None):
+        self.version = version
+        self.precision = settings.LOCATION_CACHE_PRECISION if precision is None else precision
+        self.size = settings.LOCATION_CACHE_SIZE if size is None else size
+        self.use_redis = settings.LOCATION_CACHE_REDIS if use_redis is None else use_redis
+        self.lock = threading.Lock()
+        self._results = OrderedDict()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def key(self, lon, lat):
+        return '{:.{precision}f}:{:.{precision}f}'.format(lon, lat, precision=self.precision)
+
+    def _redis_key(self, key):
+        return f'location:{self.version}:{self.precision}:{key}'
+
+    def get(self, lon, lat):
+        '''Returns a copy of the cached result for the point's cell, or None.'''
+        key = self.key(lon, lat)
+        with self.lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                self.hits += 1
+                self._log_stats()
+                return copy.deepcopy(result)
+
+        if self.use_redis:
+            from photonix.photos.utils.redis import redis_connection
+            try:
+                data = redis_connection.get(self._redis_key(key))
+            except Exception as e:
+                logger.warning(f'Location cache Redis lookup failed: {e}')
+                data = None
+            if data is not None:
+                result = json.loads(data)
+                self._store(key, result)
+                with self.lock:
+                    self.redis_hits += 1
+                    self._log_stats()
+                return copy.deepcopy(result)
+
+        with self.lock:
+            self.misses += 1
+            self._log_stats()
+        return None
+
+    def set(self, lon, lat, result):
+        key = self.key(lon, lat)
+        result = copy.deepcopy(result)
+        self._store(key, result)
+
+        if self.use_redis:
+            from photonix.photos.utils.redis import redis_connection
+            try:
+                redis_connection.set(self._redis_key(key), json.dumps(result), ex=CACHE_REDIS_EXPIRY)
+            except Exception as e:
+                logger.warning(f'Location cache Redis update failed: {e}')
+
+    def _store(self, key, result):
+        with self.lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.redis_hits + self.misses
+            return {
+                'lookups': lookups,
+                'hits': self.hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+                'size': len(self._results),
+            }
+
+    def _log_stats(self):
+        # Called with the lock held
+        lookups = self.hits + self.redis_hits + self.misses
+        if lookups % LOG_EVERY == 0:
+            hit_rate = (self.hits + self.redis_hits) / lookups
+            logger.info(f'Location cache: {hit_rate:.1%} hit rate over {lookups} lookups ({self.redis_hits} from Redis, {len(self._results)} cells cached)')
@@ -1,3 +1,3 @@
 name = 'location'
 version = 20190109
-approx_ram_mb = 100
+approx_ram_mb = 120
@@ -1,23 +1,34 @@
+from collections import defaultdict
 import csv
 import math
 from pathlib import Path
 import sys
 
 import matplotlib.path as mpltPath
+import numpy as np
 import shapefile
 
-from photonix.photos.utils.metadata import PhotoMetadata, parse_gps_location
+from django.conf import settings
+from photonix.photos.utils.metadata import PhotoMetadata
 from photonix.classifiers.base_model import BaseModel
+from photonix.classifiers.location.cache import LocationCache
 
 
 WORLD_FILE = Path('location') / 'TM_WORLD_BORDERS-0.3.shp'  # http://thematicmapping.org/downloads/world_borders.php
 CITIES_FILE = Path('location') / 'cities1000.txt'  # http://download.geonames.org/export/dump/
+GRID_CELL_DEGREES = 1  # Size of the squares used to index country polygons
+CITY_RADIUS = 10000  # Meters
+EARTH_RADIUS = 6372800  # Meters
+# Straight line distance through the unit sphere, padded so no city on the
+# edge of the radius is missed before the exact haversine check.
+CITY_CHORD = 2 * math.sin(CITY_RADIUS / (2 * EARTH_RADIUS)) * 1.001
+BULK_BATCH_SIZE = 2000
 
 
 class LocationModel(BaseModel):
     name = 'location'
     version = 20190109
-    approx_ram_mb = 100
+    approx_ram_mb = 120
     max_num_workers = 4
 
     def __init__(self, model_dir=None, world_file=WORLD_FILE, cities_file=CITIES_FILE, lock_name=None):
@@ -28,7 +39,8 @@ class LocationModel(BaseModel):
         self._lock_name = lock_name
         self._loaded = False
         self.world = None
-        self.cities = None
+        self.city_tree = None
+        self.cache = LocationCache(self.version) if settings.LOCATION_CACHE_SIZE else None
 
         # Download model files eagerly (cheap), but don't load into memory yet
         self.ensure_downloaded(lock_name=lock_name)
@@ -39,19 +51,69 @@ class LocationModel(BaseModel):
             return
 
         self.world = self.load_world(self._world_file)
-        self.cities = self.load_cities(self._cities_file)
+        self.load_country_index(self.world)
+        self.load_cities(self._cities_file)
         self._loaded = True
 
     def load_world(self, world_file):
         return shapefile.Reader(world_file, encoding='latin1').shapeRecords()
 
+    def load_country_index(self, world):
+        # Splits the country shapes into polygons once and records which grid
+        # squares each polygon's bounding box covers, so a lookup only has to
+        # test the handful of polygons near the point.
+        self.country_names = {row.record[1]: row.record[4] for row in world}
+        self.polygon_paths = []
+        self.polygon_countries = []
+        bboxes = []
+        for shape_rec in world:
+            shape = shape_rec.shape
+            record = shape_rec.record
+            if shape.shapeTypeName != 'POLYGON':
+                continue
+            for polygon in self.split_country_points(shape.points):
+                vertices = np.asarray(polygon, dtype=np.float64)
+                self.polygon_paths.append(mpltPath.Path(vertices))
+                self.polygon_countries.append((record[4], record[1]))
+                bboxes.append(np.concatenate([vertices.min(axis=0), vertices.max(axis=0)]))
+        self.polygon_bboxes = np.array(bboxes).reshape(-1, 4)
+
+        grid = defaultdict(list)
+        for i, (min_x, min_y, max_x, max_y) in enumerate(self.polygon_bboxes):
+            for x in range(math.floor(min_x / GRID_CELL_DEGREES), math.floor(max_x / GRID_CELL_DEGREES) + 1):
+                for y in range(math.floor(min_y / GRID_CELL_DEGREES), math.floor(max_y / GRID_CELL_DEGREES) + 1):
+                    grid[(x, y)].append(i)
+        # Polygons stay in shapefile order so the first match is the same country as a full scan
+        self.country_grid = {cell: np.array(indexes) for cell, indexes in grid.items()}
+
     def load_cities(self, cities_file):
-        rows = []
+        # Only the columns needed for lookups are kept, as arrays rather than
+        # ~150k lists of strings. Cities are indexed by their position on a
+        # unit sphere so a radius search can be done with a KD-tree.
+        from scipy.spatial import cKDTree
+
+        names, latitudes, longitudes, populations, country_indexes = [], [], [], [], []
+        country_codes = {}
         with open(cities_file) as csvfile:
             reader = csv.reader(csvfile, delimiter='\t')
             for row in reader:
-                rows.append(row)
-        return rows
+                names.append(row[1])
+                latitudes.append(float(row[4]))
+                longitudes.append(float(row[5]))
+                populations.append(int(row[14]))
+                country_indexes.append(country_codes.setdefault(row[8], len(country_codes)))
+
+        self.city_names = names
+        self.city_latitudes = np.array(latitudes)
+        self.city_longitudes = np.array(longitudes)
+        self.city_populations = np.array(populations, dtype=np.int64)
+        self.city_country_indexes = np.array(country_indexes, dtype=np.int16)
+        self.city_country_codes = list(country_codes)
+        self.city_tree = cKDTree(self.unit_vectors(self.city_latitudes, self.city_longitudes))
+
+    def unit_vectors(self, latitudes, longitudes):
+        phi, lam = np.radians(latitudes), np.radians(longitudes)
+        return np.column_stack([np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)])
 
     def predict(self, image_file=None, location=None, photo_file=None):
         self._ensure_loaded()  # Lazy load on first use
@@ -60,7 +122,7 @@ class LocationModel(BaseModel):
             lon, lat = location
         else:
             metadata = PhotoMetadata(image_file)
-            location = metadata.get('GPS Position') and parse_gps_location(metadata.get('GPS Position')) or None
+            location = metadata.get_gps_location()
             if location:
                 lon, lat = location
             else:
@@ -69,11 +131,47 @@ class LocationModel(BaseModel):
                     'city': None,
                 }
 
+        return self.predict_location(lon, lat)
+
+    def predict_many(self, locations):
+        # predict() for a list of (latitude, longitude) pairs. Nearby cities
+        # for all of them are found with a single KD-tree query.
+        self._ensure_loaded()  # Lazy load on first use
+
+        locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+        if self.cache:
+            results = [self.cache.get(lon, lat) for lon, lat in locations]
+        else:
+            results = [None] * len(locations)
+
+        # Only the locations that weren't cached need looking up
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            all_candidates = self.city_tree.query_ball_point(self.unit_vectors(locations[missing, 0], locations[missing, 1]), CITY_CHORD, workers=-1)
+            for i, candidates in zip(missing, all_candidates):
+                lon, lat = locations[i]
+                results[i] = self.geocode(lon, lat, candidates)
+                if self.cache:
+                    self.cache.set(lon, lat, results[i])
+        return results
+
+    def predict_location(self, lon, lat):
+        if self.cache:
+            result = self.cache.get(lon, lat)
+            if result is not None:
+                return result
+        result = self.geocode(lon, lat)
+        if self.cache:
+            self.cache.set(lon, lat, result)
+        return result
+
+    def geocode(self, lon, lat, city_candidates=None):
+        # Works out the country and city without the cache
         country = self.get_country(lon=lon, lat=lat)
         if country:
-            city = self.get_city(lon=lon, lat=lat, country_code=country['code'])
+            city = self.get_city(lon=lon, lat=lat, country_code=country['code'], candidates=city_candidates)
         else:
-            city = self.get_city(lon=lon, lat=lat)
+            city = self.get_city(lon=lon, lat=lat, candidates=city_candidates)
 
         if not country and city:
             country = {
@@ -89,59 +187,54 @@ class LocationModel(BaseModel):
         # Using country border polygons, returns the country that contains the
         # given point.
         location = [[lat, lon]]
-        for shape_rec in self.world:
-            shape = shape_rec.shape
-            record = shape_rec.record
-            points = shape.points
-
-            if shape.shapeTypeName == 'POLYGON':
-                polygons = self.split_country_points(points)
-                for polygon in polygons:
-                    path = mpltPath.Path(polygon)
-                    inside = path.contains_points(location)[0]
-                    if inside:
-                        return {
-                            'name': record[4],
-                            'code': record[1],
-                        }
+        x, y = location[0]
+        cell = (math.floor(x / GRID_CELL_DEGREES), math.floor(y / GRID_CELL_DEGREES))
+        candidates = self.country_grid.get(cell)
+        if candidates is None:
+            return None
+
+        bboxes = self.polygon_bboxes[candidates]
+        in_bbox = (bboxes[:, 0] <= x) & (x <= bboxes[:, 2]) & (bboxes[:, 1] <= y) & (y <= bboxes[:, 3])
+        for i in candidates[in_bbox]:
+            if self.polygon_paths[i].contains_points(location)[0]:
+                name, code = self.polygon_countries[i]
+                return {
+                    'name': name,
+                    'code': code,
+                }
         return None
 
-    def get_city(self, lon, lat, country_code=None):
+    def get_city(self, lon, lat, country_code=None, candidates=None):
         # Gets the city within a 10km radius that has the highest population.
-        # It can be limited to a particular country.
-        nearest_distance = None
-        largest_population = 0
-        largest_city = None
-        chosen_country_code = None
-        chosen_country_name = None
-        countries = {row.record[1]: row.record[4] for row in self.world}
-
-        for row in self.cities:
-            if not country_code or country_code == row[8]:
-                longitude = float(row[4])
-                latitude = float(row[5])
-
-                distance = int(self.haversine([lon, lat], [longitude, latitude]))
-                if distance < 10000:
-                    population = int(row[14])
-                    if population > largest_population:
-                        largest_population = population
-                        largest_city = row[1]
-                        chosen_country_code = row[8]
-                        chosen_country_name = countries[chosen_country_code]
-
-                if nearest_distance is None or distance < nearest_distance:
-                    nearest_distance = distance
-
-        if largest_city:
-            return {
-                'name': largest_city,
-                'distance': nearest_distance,
-                'population': largest_population,
-                'country_code': chosen_country_code,
-                'country_name': chosen_country_name,
-            }
-        return None
+        # It can be limited to a particular country. As with haversine(), the
+        # first coordinate is treated as the latitude. Cities already found
+        # near the point by a KD-tree query can be passed as candidates.
+        if candidates is None:
+            candidates = self.city_tree.query_ball_point(self.unit_vectors([lon], [lat])[0], CITY_CHORD)
+        candidates = np.array(candidates, dtype=int)
+
+        if country_code:
+            if country_code not in self.city_country_codes:
+                return None
+            country_index = self.city_country_codes.index(country_code)
+            candidates = candidates[self.city_country_indexes[candidates] == country_index]
+        # Ties on population go to the first city in the file
+        candidates.sort()
+
+        distances = self.haversine([lon, lat], [self.city_latitudes[candidates], self.city_longitudes[candidates]]).astype(np.int64)
+        within = candidates[distances < CITY_RADIUS]
+        if not len(within) or self.city_populations[within].max() <= 0:
+            return None
+
+        city = within[np.argmax(self.city_populations[within])]
+        chosen_country_code = self.city_country_codes[self.city_country_indexes[city]]
+        return {
+            'name': self.city_names[city],
+            'distance': int(distances.min()),
+            'population': int(self.city_populations[city]),
+            'country_code': chosen_country_code,
+            'country_name': self.country_names.get(chosen_country_code),
+        }
 
     def split_country_points(self, points):
         # The country shapes have multiple polygons within them. We split the
@@ -164,17 +257,17 @@ class LocationModel(BaseModel):
     def haversine(self, coord1, coord2):
         # Calculate distance in meters. This is a bit simplistic as it assumes
         # a sherical world but we believe this to not have much impact for how
-        # we use it.
-        R = 6372800
+        # we use it. Works on arrays of coordinates as well as single values.
+        R = EARTH_RADIUS
         lat1, lon1 = coord1
         lat2, lon2 = coord2
 
-        phi1, phi2 = math.radians(lat1), math.radians(lat2)
-        dphi = math.radians(lat2 - lat1)
-        dlambda = math.radians(lon2 - lon1)
+        phi1, phi2 = np.radians(lat1), np.radians(lat2)
+        dphi = np.radians(np.subtract(lat2, lat1))
+        dlambda = np.radians(np.subtract(lon2, lon1))
 
-        a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2)*math.sin(dlambda/2)**2
-        return 2*R*math.atan2(math.sqrt(a), math.sqrt(1 - a))
+        a = np.sin(dphi/2)**2 + np.cos(phi1) * np.cos(phi2)*np.sin(dlambda/2)**2
+        return 2*R*np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
     def export_country_kml(self, country, path):
         # Useful for debugging country borders. The exported KML can be viewed
@@ -220,8 +313,14 @@ def run_on_photo(photo_id):
     model = get_model_manager().get_model('location', LocationModel)
 
     sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-    from photonix.classifiers.runners import results_for_model_on_photo, get_or_create_tag
-    photo, results = results_for_model_on_photo(model, photo_id)
+    from photonix.classifiers.runners import results_for_model_on_photo, get_photo_by_any_type, get_or_create_tag
+    photo = get_photo_by_any_type(photo_id, model)
+    if photo and photo.latitude is not None and photo.longitude is not None:
+        # Coordinates were stored when the photo was imported so there's no
+        # need to read them back from the file (which may be a raw's extracted JPEG)
+        results = model.predict(location=[float(photo.latitude), float(photo.longitude)])
+    else:
+        photo, results = results_for_model_on_photo(model, photo_id)
 
     if photo and results['country']:
         from photonix.photos.models import PhotoTag
@@ -235,6 +334,66 @@ def run_on_photo(photo_id):
     return photo, results
 
 
+def run_on_photos_in_bulk(photos, model=None, batch_size=BULK_BATCH_SIZE):
+    '''
+    Tags a queryset of photos with their country and city using the
+    coordinates already in the database. Photos are geocoded a batch at a time
+    and their tags replaced with one delete and one bulk insert per batch.
+    Returns the number of photos looked up and the number tagged.
+    '''
+    from django.db import transaction
+    from django.utils import timezone
+    from photonix.classifiers.runners import get_or_create_tag
+    from photonix.photos.models import Library, PhotoTag
+
+    if model is None:
+        model = LocationModel()
+    libraries = Library.objects.in_bulk()
+    tags = {}
+
+    def get_tag(library_id, name, parent=None):
+        key = (library_id, name, parent and parent.id)
+        if key not in tags:
+            tags[key] = get_or_create_tag(library=libraries[library_id], name=name, type='L', source='C', parent=parent)
+        return tags[key]
+
+    def save_batch(rows):
+        results = model.predict_many([(float(latitude), float(longitude)) for _, _, latitude, longitude in rows])
+        now = timezone.now()
+        photo_ids = []
+        photo_tags = []
+        for (photo_id, library_id, _, _), result in zip(rows, results):
+            if not result['country']:
+                continue
+            photo_ids.append(photo_id)
+            country_tag = get_tag(library_id, result['country']['name'])
+            photo_tags.append(PhotoTag(photo_id=photo_id, tag=country_tag, source='C', confidence=1.0, significance=1.0, created_at=now, updated_at=now))
+            if result['city']:
+                city_tag = get_tag(library_id, result['city']['name'], parent=country_tag)
+                photo_tags.append(PhotoTag(photo_id=photo_id, tag=city_tag, source='C', confidence=0.5, significance=0.5, created_at=now, updated_at=now))
+
+        with transaction.atomic():
+            PhotoTag.objects.filter(photo_id__in=photo_ids, tag__source='C', tag__type='L').delete()
+            PhotoTag.objects.bulk_create(photo_tags, batch_size=batch_size)
+        return len(photo_ids)
+
+    num_photos = 0
+    num_tagged = 0
+    rows = []
+    photos = photos.filter(latitude__isnull=False, longitude__isnull=False).order_by('id')
+    for row in photos.values_list('id', 'library_id', 'latitude', 'longitude').iterator(chunk_size=batch_size):
+        rows.append(row)
+        if len(rows) == batch_size:
+            num_tagged += save_batch(rows)
+            num_photos += len(rows)
+            rows = []
+    if rows:
+        num_tagged += save_batch(rows)
+        num_photos += len(rows)
+
+    return num_photos, num_tagged
+
+
 if __name__ == '__main__':
     model = LocationModel()
     if len(sys.argv) != 2:
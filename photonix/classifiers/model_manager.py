@@ -311,6 +311,10 @@ class ModelManager:
                 model = self._model_instances.pop(classifier_name)
                 self._last_used.pop(classifier_name, None)
 
+            # Release any long-lived sessions the model holds
+            if hasattr(model, 'close'):
+                model.close()
+
             # Clear from graph_cache (shared module-level dict)
             self._clear_graph_cache(classifier_name, model)
 
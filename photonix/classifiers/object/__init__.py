@@ -1 +1 @@
-from .model import ObjectModel, run_on_photo
+from .model import ObjectModel, run_on_photo, run_on_photos
@@ -1,5 +1,6 @@
 import os
 import sys
+import threading
 from pathlib import Path
 
 from django.utils import timezone
@@ -7,7 +8,7 @@ import numpy as np
 from PIL import Image, ImageOps as PILImageOps
 from redis_lock import Lock
 
-from photonix.classifiers.base_model import BaseModel
+from photonix.classifiers.base_model import BaseModel, map_in_threads
 from photonix.photos.utils.redis import redis_connection
 
 # Lazy-loaded modules (heavy imports)
@@ -35,6 +36,7 @@ def _ensure_label_map_util():
 
 GRAPH_FILE = os.path.join('object', 'ssd_mobilenet_v2_oid_v4_2018_12_12_frozen_inference_graph.pb')
 LABEL_FILE = os.path.join('object', 'oid_v4_label_map.pbtxt')
+OUTPUT_TENSORS = ['num_detections', 'detection_boxes', 'detection_scores', 'detection_classes']
 
 
 class ObjectModel(BaseModel):
@@ -49,8 +51,10 @@ class ObjectModel(BaseModel):
         self._label_file = os.path.join(self.model_dir, label_file)
         self._lock_name = lock_name
         self._loaded = False
+        self._load_lock = threading.Lock()
         self.graph = None
         self.labels = None
+        self.session = None
 
         # Download model files eagerly (cheap), but don't load into memory yet
         self.ensure_downloaded(lock_name=lock_name)
@@ -60,9 +64,32 @@ class ObjectModel(BaseModel):
         if self._loaded:
             return
 
-        self.graph = self.load_graph(self._graph_file)
-        self.labels = self.load_labels(self._label_file)
-        self._loaded = True
+        with self._load_lock:
+            if self._loaded:
+                return
+            self.graph = self.load_graph(self._graph_file)
+            self.labels = self.load_labels(self._label_file)
+            self.load_session()
+            self._loaded = True
+
+    def load_session(self):
+        """
+        Opens one session for the life of the model and looks up the input and
+        output tensors up front. Session.run() is thread-safe so the classifier
+        worker threads all share it.
+        """
+        tf = _ensure_tensorflow()
+        self.session = tf.compat.v1.Session(graph=self.graph)
+        self.image_tensor = self.graph.get_tensor_by_name('image_tensor:0')
+        self.output_tensors = {key: self.graph.get_tensor_by_name(key + ':0') for key in OUTPUT_TENSORS}
+
+    def close(self):
+        """Releases the session, called when the model manager unloads the model."""
+        with self._load_lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+            self._loaded = False
 
     def load_graph(self, graph_file):
         tf = _ensure_tensorflow()
@@ -90,41 +117,22 @@ class ObjectModel(BaseModel):
         return lmu.create_category_index(categories)
 
     def load_image_into_numpy_array(self, image):
-        (im_width, im_height) = image.size
-        return np.array(image.getdata()).reshape((im_height, im_width, 3)).astype(np.uint8)
+        return np.asarray(image, dtype=np.uint8)
+
+    def run_inference(self, images):
+        """Runs detection on a list of same-sized images in one session call."""
+        output_dict = self.session.run(self.output_tensors, feed_dict={self.image_tensor: np.stack(images)})
+
+        # all outputs are float32 numpy arrays, so convert types as appropriate
+        return [{
+            'num_detections':    int(output_dict['num_detections'][i]),
+            'detection_classes': output_dict['detection_classes'][i].astype(np.uint16),
+            'detection_boxes':   output_dict['detection_boxes'][i],
+            'detection_scores':  output_dict['detection_scores'][i],
+        } for i in range(len(images))]
 
     def run_inference_for_single_image(self, image):
-        tf = _ensure_tensorflow()
-        with self.graph.as_default():
-            with tf.compat.v1.Session() as sess:
-                # Get handles to input and output tensors
-                ops = tf.compat.v1.get_default_graph().get_operations()
-                all_tensor_names = {output.name for op in ops for output in op.outputs}
-                tensor_dict = {}
-                for key in [
-                    'num_detections', 'detection_boxes', 'detection_scores',
-                    'detection_classes', 'detection_masks'
-                ]:
-                    tensor_name = key + ':0'
-                    if tensor_name in all_tensor_names:
-                        tensor_dict[key] = tf.compat.v1.get_default_graph().get_tensor_by_name(tensor_name)
-                if 'detection_masks' in tensor_dict:
-                    # The following processing is only for single image
-                    detection_boxes = tf.squeeze(tensor_dict['detection_boxes'], [0])
-                    # Reframe is required to translate mask from box coordinates to image coordinates and fit the image size.
-                    real_num_detection = tf.cast(tensor_dict['num_detections'][0], tf.int32)
-                    detection_boxes = tf.slice(detection_boxes, [0, 0], [real_num_detection, -1])
-                image_tensor = tf.compat.v1.get_default_graph().get_tensor_by_name('image_tensor:0')
-
-                # Run inference
-                output_dict = sess.run(tensor_dict, feed_dict={image_tensor: np.expand_dims(image, 0)})
-
-                # all outputs are float32 numpy arrays, so convert types as appropriate
-                output_dict['num_detections'] = int(output_dict['num_detections'][0])
-                output_dict['detection_classes'] = output_dict['detection_classes'][0].astype(np.uint16)
-                output_dict['detection_boxes'] = output_dict['detection_boxes'][0]
-                output_dict['detection_scores'] = output_dict['detection_scores'][0]
-        return output_dict
+        return self.run_inference([image])[0]
 
     def format_output(self, output_dict, min_score):
         results = []
@@ -148,9 +156,7 @@ class ObjectModel(BaseModel):
             })
         return results
 
-    def predict(self, image_file, min_score=0.1, photo_file=None):
-        self._ensure_loaded()  # Lazy load on first use
-
+    def load_image(self, image_file, photo_file=None):
         image = Image.open(image_file)
 
         if image.mode != 'RGB':
@@ -164,15 +170,54 @@ class ObjectModel(BaseModel):
             # Fallback: just apply EXIF orientation correction
             image = PILImageOps.exif_transpose(image)
 
-        # the array based representation of the image will be used later in order to prepare the
-        # result image with boxes and labels on it.
-        image_np = self.load_image_into_numpy_array(image)
-        # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-        np.expand_dims(image_np, axis=0)
+        return self.load_image_into_numpy_array(image)
+
+    def predict(self, image_file, min_score=0.1, photo_file=None):
+        self._ensure_loaded()  # Lazy load on first use
+
+        image_np = self.load_image(image_file, photo_file)
         # Actual detection.
         output_dict = self.run_inference_for_single_image(image_np)
         return self.format_output(output_dict, min_score)
 
+    def predict_batch(self, image_files, min_score=0.1, photo_files=None):
+        """
+        Returns the predict() results for each image. Images are decoded in
+        parallel and those with the same dimensions go through the graph
+        together. They aren't resized to a common shape first as that would
+        change the detections compared to predicting them one at a time.
+        """
+        self._ensure_loaded()  # Lazy load on first use
+
+        if photo_files is None:
+            photo_files = [None] * len(image_files)
+        images = map_in_threads(self.load_image, image_files, photo_files)
+
+        by_shape = {}
+        for i, image in enumerate(images):
+            by_shape.setdefault(image.shape, []).append(i)
+
+        results = [None] * len(images)
+        for indexes in by_shape.values():
+            output_dicts = self.run_inference([images[i] for i in indexes])
+            for i, output_dict in zip(indexes, output_dicts):
+                results[i] = self.format_output(output_dict, min_score)
+        return results
+
+
+def save_results(model, photo, results):
+    from photonix.classifiers.runners import get_or_create_tag
+    from photonix.photos.models import PhotoTag
+
+    photo.clear_tags(source='C', type='O')
+    for result in results:
+        if result['label'] != 'Human face':  # We have a specialised face detector
+            tag = get_or_create_tag(library=photo.library, name=result['label'], type='O', source='C')
+            PhotoTag(photo=photo, tag=tag, source='C', confidence=result['score'], significance=result['significance'], position_x=result['x'], position_y=result['y'], size_x=result['width'], size_y=result['height']).save()
+    photo.classifier_object_completed_at = timezone.now()
+    photo.classifier_object_version = getattr(model, 'version', 0)
+    photo.save()
+
 
 def run_on_photo(photo_id):
     from photonix.classifiers.model_manager import get_model_manager
@@ -181,23 +226,28 @@ def run_on_photo(photo_id):
     model = get_model_manager().get_model('object', ObjectModel)
 
     sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-    from photonix.classifiers.runners import results_for_model_on_photo, get_or_create_tag
+    from photonix.classifiers.runners import results_for_model_on_photo
     photo, results = results_for_model_on_photo(model, photo_id)
 
     if photo:
-        from photonix.photos.models import PhotoTag
-        photo.clear_tags(source='C', type='O')
-        for result in results:
-            if result['label'] != 'Human face':  # We have a specialised face detector
-                tag = get_or_create_tag(library=photo.library, name=result['label'], type='O', source='C')
-                PhotoTag(photo=photo, tag=tag, source='C', confidence=result['score'], significance=result['significance'], position_x=result['x'], position_y=result['y'], size_x=result['width'], size_y=result['height']).save()
-        photo.classifier_object_completed_at = timezone.now()
-        photo.classifier_object_version = getattr(model, 'version', 0)
-        photo.save()
+        save_results(model, photo, results)
 
     return photo, results
 
 
+def run_on_photos(photo_ids):
+    from photonix.classifiers.model_manager import get_model_manager
+    from photonix.classifiers.runners import results_for_model_on_photos
+
+    model = get_model_manager().get_model('object', ObjectModel)
+    photos_results = results_for_model_on_photos(model, photo_ids)
+
+    for photo, results in photos_results:
+        save_results(model, photo, results)
+
+    return photos_results
+
+
 if __name__ == '__main__':
     model = ObjectModel()
     if len(sys.argv) != 2:
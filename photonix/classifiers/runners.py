@@ -56,3 +56,10 @@ def results_for_model_on_photo(model, photo_id):
     else:
         results = model.predict(photo_id)
     return photo, results
+
+
+def results_for_model_on_photos(model, photo_ids):
+    '''Batched version of results_for_model_on_photo(), for Photo IDs only.'''
+    photos = [get_photo_by_any_type(photo_id, model) for photo_id in photo_ids]
+    results = model.predict_batch([photo.base_image_path for photo in photos], photo_files=[photo.base_file for photo in photos])
+    return list(zip(photos, results))
@@ -1,12 +1,13 @@
 import os
 import sys
+import threading
 from pathlib import Path
 
 import numpy as np
 
 from redis_lock import Lock
 
-from photonix.classifiers.base_model import BaseModel
+from photonix.classifiers.base_model import BaseModel, map_in_threads
 from photonix.photos.utils.redis import redis_connection
 from photonix.web.utils import logger
 
@@ -25,6 +26,9 @@ def _ensure_tensorflow():
 
 GRAPH_FILE = os.path.join('style', 'graph.pb')
 LABEL_FILE = os.path.join('style', 'labels.txt')
+INPUT_SIZE = 224
+INPUT_MEAN = 128
+INPUT_STD = 128
 
 
 class StyleModel(BaseModel):
@@ -40,8 +44,10 @@ class StyleModel(BaseModel):
         self._label_file = os.path.join(self.model_dir, label_file)
         self._lock_name = lock_name
         self._loaded = False
+        self._load_lock = threading.Lock()
         self.graph = None
         self.labels = None
+        self.session = None
 
         # Download model files eagerly (cheap), but don't load into memory yet
         self.ensure_downloaded(lock_name=lock_name)
@@ -51,9 +57,28 @@ class StyleModel(BaseModel):
         if self._loaded:
             return
 
-        self.graph = self.load_graph(self._graph_file)
-        self.labels = self.load_labels(self._label_file)
-        self._loaded = True
+        with self._load_lock:
+            if self._loaded:
+                return
+            self.graph = self.load_graph(self._graph_file)
+            self.labels = self.load_labels(self._label_file)
+            self.load_session()
+            self._loaded = True
+
+    def load_session(self):
+        """Opens one session for the life of the model, shared by the worker threads."""
+        tf = _ensure_tensorflow()
+        self.session = tf.compat.v1.Session(graph=self.graph)
+        self.input_tensor = self.graph.get_operation_by_name('import/input').outputs[0]
+        self.output_tensor = self.graph.get_operation_by_name('import/final_result').outputs[0]
+
+    def close(self):
+        """Releases the session, called when the model manager unloads the model."""
+        with self._load_lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+            self._loaded = False
 
     def load_graph(self, graph_file):
         tf = _ensure_tensorflow()
@@ -80,43 +105,47 @@ class StyleModel(BaseModel):
             labels.append(l.rstrip())
         return labels
 
-    def predict(self, image_file, min_score=0.66, photo_file=None):
-        self._ensure_loaded()  # Lazy load on first use
-
-        input_height = 224
-        input_width = 224
-        input_mean = 128
-        input_std = 128
-        input_layer = "input"
-        output_layer = "final_result"
-
-        t = self.read_tensor_from_image_file(
+    def load_image(self, image_file):
+        return self.read_tensor_from_image_file(
             image_file,
-            input_height=input_height,
-            input_width=input_width,
-            input_mean=input_mean,
-            input_std=input_std)
-
-        if t is None:
-            logger.info(f'Skipping {image_file}, file format not supported by Tensorflow')
-            return None
-
-        input_name = "import/" + input_layer
-        output_name = "import/" + output_layer
-        input_operation = self.graph.get_operation_by_name(input_name)
-        output_operation = self.graph.get_operation_by_name(output_name)
-
-        tf = _ensure_tensorflow()
-        with tf.compat.v1.Session(graph=self.graph) as sess:
-            results = sess.run(output_operation.outputs[0], {input_operation.outputs[0]: t})
-        results = np.squeeze(results)
+            input_height=INPUT_SIZE,
+            input_width=INPUT_SIZE,
+            input_mean=INPUT_MEAN,
+            input_std=INPUT_STD)
 
+    def format_output(self, results, min_score):
         response = []
         top_k = results.argsort()[-5:][::-1]
         for i in top_k:
             if results[i] >= min_score:
                 response.append((self.labels[i], results[i]))
+        return response
 
+    def predict(self, image_file, min_score=0.66, photo_file=None):
+        return self.predict_batch([image_file], min_score=min_score)[0]
+
+    def predict_batch(self, image_files, min_score=0.66, photo_files=None):
+        """
+        Returns the predict() results for each image, or None for images
+        TensorFlow can't decode. Images are decoded and resized in parallel
+        then classified with a single session call.
+        """
+        self._ensure_loaded()  # Lazy load on first use
+
+        tensors = map_in_threads(self.load_image, image_files)
+        response = [None] * len(image_files)
+        indexes = []
+        for i, (image_file, t) in enumerate(zip(image_files, tensors)):
+            if t is None:
+                logger.info(f'Skipping {image_file}, file format not supported by Tensorflow')
+            else:
+                indexes.append(i)
+        if not indexes:
+            return response
+
+        results = self.session.run(self.output_tensor, {self.input_tensor: np.concatenate([tensors[i] for i in indexes])})
+        for i, scores in zip(indexes, results):
+            response[i] = self.format_output(scores, min_score)
         return response
 
     def read_tensor_from_image_file(self, file_name, input_height=299, input_width=299, input_mean=0, input_std=255):
@@ -140,6 +169,16 @@ class StyleModel(BaseModel):
             return None
 
 
+def save_results(photo, results):
+    from photonix.classifiers.runners import get_or_create_tag
+    from photonix.photos.models import PhotoTag
+
+    photo.clear_tags(source='C', type='S')
+    for name, score in results:
+        tag = get_or_create_tag(library=photo.library, name=name, type='S', source='C')
+        PhotoTag(photo=photo, tag=tag, source='C', confidence=score, significance=score).save()
+
+
 def run_on_photo(photo_id):
     from photonix.classifiers.model_manager import get_model_manager
 
@@ -147,19 +186,29 @@ def run_on_photo(photo_id):
     model = get_model_manager().get_model('style', StyleModel)
 
     sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-    from photonix.classifiers.runners import results_for_model_on_photo, get_or_create_tag
+    from photonix.classifiers.runners import results_for_model_on_photo
     photo, results = results_for_model_on_photo(model, photo_id)
 
     if photo and results is not None:
-        from photonix.photos.models import PhotoTag
-        photo.clear_tags(source='C', type='S')
-        for name, score in results:
-            tag = get_or_create_tag(library=photo.library, name=name, type='S', source='C')
-            PhotoTag(photo=photo, tag=tag, source='C', confidence=score, significance=score).save()
+        save_results(photo, results)
 
     return photo, results
 
 
+def run_on_photos(photo_ids):
+    from photonix.classifiers.model_manager import get_model_manager
+    from photonix.classifiers.runners import results_for_model_on_photos
+
+    model = get_model_manager().get_model('style', StyleModel)
+    photos_results = results_for_model_on_photos(model, photo_ids)
+
+    for photo, results in photos_results:
+        if results is not None:
+            save_results(photo, results)
+
+    return photos_results
+
+
 if __name__ == '__main__':
     model = StyleModel()
     if len(sys.argv) != 2:
@@ -0,0 +1,68 @@
+from time import time
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Measures per-photo latency of the object or style classifier, separating the one-off model load from steady state inference and optionally comparing against a new session per photo.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='+', help='Image files to classify')
+        parser.add_argument('--classifier', choices=['object', 'style'], default='object')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of passes over the images')
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8], help='Photos per predict_batch() call')
+        parser.add_argument('--session-per-call', action='store_true', help='Also time opening a new TensorFlow session for every photo, as inference used to')
+
+    def get_model(self, classifier):
+        if classifier == 'object':
+            from photonix.classifiers.object.model import ObjectModel
+            return ObjectModel()
+        from photonix.classifiers.style.model import StyleModel
+        return StyleModel()
+
+    def predict_with_new_session(self, model, image):
+        # A session is opened, used for one photo and closed again rather
+        # than being kept open for the life of the model
+        model.session.close()
+        model.load_session()
+        return model.predict(image)
+
+    def time_predictions(self, predict, images, repeat):
+        start = time()
+        for _ in range(repeat):
+            for image in images:
+                predict(image)
+        return time() - start, repeat * len(images)
+
+    def handle(self, *args, **options):
+        model = self.get_model(options['classifier'])
+        images = options['images']
+
+        # The first prediction includes loading the graph and opening the session
+        start = time()
+        model.predict(images[0])
+        first_ms = (time() - start) * 1000
+
+        if options['session_per_call']:
+            elapsed, num_predictions = self.time_predictions(lambda image: self.predict_with_new_session(model, image), images, options['repeat'])
+            self.stdout.write(
+                f'{options["classifier"]}: new session per photo, {elapsed / num_predictions * 1000:.0f}ms per photo '
+                f'({num_predictions / elapsed:.2f} photos/sec)'
+            )
+
+        elapsed, num_predictions = self.time_predictions(model.predict, images, options['repeat'])
+        self.stdout.write(
+            f'{options["classifier"]}: first photo {first_ms:.0f}ms, then {elapsed / num_predictions * 1000:.0f}ms per photo '
+            f'with one persistent session ({num_predictions / elapsed:.2f} photos/sec)'
+        )
+
+        for batch_size in options['batch_sizes']:
+            batch = (images * batch_size)[:batch_size]
+            start = time()
+            for _ in range(options['repeat']):
+                model.predict_batch(batch)
+            elapsed = time() - start
+            self.stdout.write(
+                f'{options["classifier"]}: batches of {batch_size}, {elapsed / (options["repeat"] * batch_size) * 1000:.0f}ms per photo '
+                f'({options["repeat"] * batch_size / elapsed:.2f} photos/sec)'
+            )
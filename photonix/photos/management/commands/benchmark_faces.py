@@ -0,0 +1,62 @@
+import math
+from time import time
+
+from django.core.management.base import BaseCommand
+import numpy as np
+from PIL import Image
+
+from photonix.classifiers.face.model import FaceModel
+
+
+class Command(BaseCommand):
+    help = 'Compares per-photo face embedding latency of re-detecting faces in each crop against reusing the full image detections.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('face_image', help='Photo of a single face to tile into group photos')
+        parser.add_argument('--counts', type=int, nargs='+', default=[1, 5, 20], help='Number of faces per generated photo')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of times to time each photo')
+        parser.add_argument('--tile-size', type=int, default=240, help='Size in pixels of each face in the generated photos')
+
+    def make_group_photo(self, face, count, tile_size):
+        columns = math.ceil(math.sqrt(count))
+        rows = math.ceil(count / columns)
+        face = face.resize((tile_size, tile_size))
+        group = Image.new('RGB', (columns * tile_size, rows * tile_size), (255, 255, 255))
+        for i in range(count):
+            group.paste(face, ((i % columns) * tile_size, (i // columns) * tile_size))
+        return np.asarray(group)
+
+    def time_per_photo(self, fn, repeat):
+        fn()  # Warm up
+        start = time()
+        for _ in range(repeat):
+            fn()
+        return (time() - start) / repeat * 1000
+
+    def handle(self, *args, **options):
+        model = FaceModel()
+        face = Image.open(options['face_image']).convert('RGB')
+
+        for count in options['counts']:
+            image = self.make_group_photo(face, count, options['tile_size'])
+            detections = model.detect_faces(image)
+            image_data = Image.fromarray(image)
+
+            def redetect():
+                for detection in detections:
+                    model.get_face_embedding(model.crop(image_data, detection['box']))
+
+            def reuse_detections():
+                for detection in detections:
+                    model.get_face_embedding_from_detection(image, detection)
+
+            def batched():
+                model.get_face_embeddings([(image, detection) for detection in detections])
+
+            redetect_ms = self.time_per_photo(redetect, options['repeat'])
+            reuse_ms = self.time_per_photo(reuse_detections, options['repeat'])
+            batched_ms = self.time_per_photo(batched, options['repeat'])
+            self.stdout.write(
+                f'{count} faces ({len(detections)} detected): '
+                f're-detect {redetect_ms:.0f}ms, reuse detections {reuse_ms:.0f}ms, batched {batched_ms:.0f}ms per photo'
+            )
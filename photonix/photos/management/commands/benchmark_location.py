@@ -0,0 +1,56 @@
+from time import time
+
+from django.core.management.base import BaseCommand
+import numpy as np
+import psutil
+
+from photonix.classifiers.location.model import LocationModel
+
+
+class Command(BaseCommand):
+    help = 'Measures the location classifier load time, memory use and per-lookup latency for random coordinates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lookups', type=int, default=1000, help='Number of random coordinates to look up')
+
+    def handle(self, *args, **options):
+        process = psutil.Process()
+        rss_before = process.memory_info().rss
+
+        start = time()
+        model = LocationModel()
+        model._ensure_loaded()
+        load_seconds = time() - start
+        rss_mb = (process.memory_info().rss - rss_before) / (1024 * 1024)
+
+        rng = np.random.default_rng(0)
+        locations = np.column_stack([rng.uniform(-60, 75, options['lookups']), rng.uniform(-180, 180, options['lookups'])])
+
+        start = time()
+        for lat, lon in locations:
+            model.get_country(lon=lat, lat=lon)
+        country_us = (time() - start) / len(locations) * 1000000
+
+        start = time()
+        for lat, lon in locations:
+            model.get_city(lon=lat, lat=lon)
+        city_us = (time() - start) / len(locations) * 1000000
+
+        start = time()
+        for lat, lon in locations:
+            model.predict(location=[lat, lon])
+        predict_us = (time() - start) / len(locations) * 1000000
+
+        # Photos from a trip: bursts of shots within a few metres of each other
+        centres = locations[:max(1, len(locations) // 50)]
+        trip = centres[rng.integers(len(centres), size=len(locations))] + rng.normal(0, 0.0002, (len(locations), 2))
+        start = time()
+        for lat, lon in trip:
+            model.predict(location=[lat, lon])
+        trip_us = (time() - start) / len(trip) * 1000000
+
+        self.stdout.write(f'Loaded in {load_seconds:.2f}s using {rss_mb:.0f}MB')
+        self.stdout.write(f'Country lookup {country_us:.0f}µs, city lookup {city_us:.0f}µs, full prediction {predict_us:.0f}µs per location')
+        if model.cache:
+            stats = model.cache.stats()
+            self.stdout.write(f'Clustered trip photos {trip_us:.0f}µs per location, cache hit rate {stats["hit_rate"]:.1%} over {stats["lookups"]} lookups')
@@ -0,0 +1,66 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from photonix.photos.utils.metadata import PhotoMetadata, get_exiftool_pool
+from photonix.photos.utils.system import missing_system_dependencies
+from photonix.web.utils import logger
+
+
+class Command(BaseCommand):
+    help = 'Compares metadata extraction throughput of forking exiftool per file against the persistent exiftool pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--limit', type=int, default=500, help='Maximum number of files to read')
+        parser.add_argument('--threads', type=int, default=4, help='Number of threads to share the exiftool pool between')
+
+    def collect_files(self, paths, limit):
+        files = []
+        for path in paths:
+            if os.path.isfile(path):
+                files.append(path)
+                continue
+            for r, d, f in os.walk(path):
+                for fn in sorted(f):
+                    files.append(os.path.join(r, fn))
+                    if len(files) >= limit:
+                        return files
+        return files[:limit]
+
+    def report(self, label, num_files, duration):
+        rate = num_files / duration if duration else 0
+        self.stdout.write(f'{label:<32} {num_files} files in {duration:.2f}s ({rate:.1f} files/sec)')
+
+    def handle(self, *args, **options):
+        missing = missing_system_dependencies(['exiftool', ])
+        if missing:
+            logger.critical(f'Missing dependencies: {missing}')
+            exit(1)
+
+        files = self.collect_files(options['paths'], options['limit'])
+        if not files:
+            self.stdout.write('No files found')
+            return
+
+        start = time()
+        for path in files:
+            PhotoMetadata(path, use_pool=False, use_cache=False)
+        self.report('Subprocess per file', len(files), time() - start)
+
+        # Warm up the pool so process start-up isn't included in the timings
+        pool = get_exiftool_pool()
+        pool.execute('-ver')
+
+        start = time()
+        for path in files:
+            PhotoMetadata(path, use_cache=False)
+        self.report('Pool (1 thread)', len(files), time() - start)
+
+        start = time()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            list(executor.map(partial(PhotoMetadata, use_cache=False), files))
+        self.report(f'Pool ({options["threads"]} threads, {pool.num_workers} workers)', len(files), time() - start)
@@ -1,6 +1,7 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from photonix.classifiers.object import ObjectModel, run_on_photo
+from photonix.classifiers.object import ObjectModel, run_on_photo, run_on_photos
 from photonix.classifiers.model_manager import get_model_manager
 from photonix.photos.utils.classification import ThreadedQueueProcessor
 from photonix.web.utils import logger
@@ -23,6 +24,8 @@ class Command(BaseCommand):
             model_name='object',
             task_type='classify.object',
             runner=run_on_photo,
+            batch_runner=run_on_photos,
+            inference_batch_size=settings.CLASSIFIER_INFERENCE_BATCH_SIZE,
             num_workers=num_workers,
             batch_size=batch_size
         )
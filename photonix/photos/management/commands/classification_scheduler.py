@@ -1,9 +1,8 @@
-from time import sleep
-
 from django.core.management.base import BaseCommand
 
 from photonix.photos.models import Task
-from photonix.photos.utils.classification import process_classify_images_tasks
+from photonix.photos.utils.classification import process_classify_images_tasks, process_propagate_face_tag_tasks
+from photonix.photos.utils.tasks import TaskListener
 from photonix.web.utils import logger
 
 
@@ -12,13 +11,15 @@ class Command(BaseCommand):
 
     def run_scheduler(self):
         prev_num_remaining = 0
+        listener = TaskListener(['classify_images', 'propagate_face_tag'])
         while True:
             num_remaining = Task.objects.filter(type='classify_images', status__in=['P', 'S', 'M']).count()
             if num_remaining != prev_num_remaining:
                 logger.info('{} photos remaining for classification'.format(num_remaining))
                 prev_num_remaining = num_remaining
                 process_classify_images_tasks()
-            sleep(1)
+            process_propagate_face_tag_tasks()
+            listener.wait()
 
     def handle(self, *args, **options):
         try:
@@ -0,0 +1,28 @@
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from photonix.classifiers.location.model import BULK_BATCH_SIZE, LocationModel, run_on_photos_in_bulk
+from photonix.photos.models import Photo
+from photonix.web.utils import logger
+
+
+class Command(BaseCommand):
+    help = 'Tags every photo that has GPS coordinates with its country and city, in bulk rather than one task per photo.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--library', help='ID of the library to tag (defaults to all libraries)')
+        parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE, help='Number of photos geocoded and saved at a time')
+
+    def handle(self, *args, **options):
+        photos = Photo.objects.filter(deleted=False)
+        if options['library']:
+            photos = photos.filter(library_id=options['library'])
+
+        model = LocationModel()
+        start = time()
+        num_photos, num_tagged = run_on_photos_in_bulk(photos, model=model, batch_size=options['batch_size'])
+        elapsed = time() - start
+        logger.info(f'Tagged {num_tagged} of {num_photos} photos with GPS coordinates in {elapsed:.1f}s')
+        if model.cache:
+            logger.info(f'Location cache hit rate {model.cache.stats()["hit_rate"]:.1%}')
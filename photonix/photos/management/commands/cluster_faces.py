@@ -0,0 +1,82 @@
+from collections import Counter, defaultdict
+from time import time
+
+from django.core.management.base import BaseCommand
+import numpy as np
+
+from photonix.classifiers.face.embeddings import EMBEDDING_SIZE, cluster_embeddings, embedding_from_bytes
+from photonix.classifiers.face.model import DISTANCE_THRESHOLD, UNKNOWN_PERSON_PREFIX, FaceModel, reassign_faces
+from photonix.photos.models import Library, PhotoTag
+from photonix.web.utils import logger
+
+
+class Command(BaseCommand):
+    help = 'Groups unknown faces of the same person under a single tag, collapsing the one-off "Unknown person" tags created during a big import.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--library', help='ID of the library to cluster (defaults to all libraries)')
+        parser.add_argument('--threshold', type=float, default=DISTANCE_THRESHOLD, help='Maximum embedding distance between any two faces grouped as the same person')
+        parser.add_argument('--dry-run', action='store_true', help='Report the clusters that would be merged without changing anything')
+
+    def cluster_library(self, library, threshold, dry_run=False):
+        start = time()
+
+        # Only faces the classifier couldn't match to anyone, and the user hasn't confirmed
+        photo_tags = []
+        embeddings = []
+        for photo_tag_id, tag_id, data in PhotoTag.objects.filter(
+                photo__library=library, tag__type='F', tag__source='C', tag__name__startswith=UNKNOWN_PERSON_PREFIX,
+                verified=False, deleted=False, embedding__isnull=False).values_list('id', 'tag_id', 'embedding').iterator(chunk_size=2000):
+            embedding = embedding_from_bytes(data)
+            if len(embedding) == EMBEDDING_SIZE:
+                photo_tags.append((photo_tag_id, tag_id))
+                embeddings.append(embedding)
+
+        if not photo_tags:
+            logger.info(f'Library {library.id}: no unknown faces to cluster')
+            return
+
+        labels = cluster_embeddings(np.stack(embeddings), threshold)
+        clusters = defaultdict(list)
+        for i, label in enumerate(labels):
+            clusters[label].append(i)
+
+        # Each cluster keeps whichever of its tags already has the most faces
+        merges = []
+        for members in clusters.values():
+            if len(members) < 2:
+                continue
+            keep_tag_id = Counter(photo_tags[i][1] for i in members).most_common(1)[0][0]
+            merges.append(([photo_tags[i][0] for i in members if photo_tags[i][1] != keep_tag_id], keep_tag_id))
+        sizes = sorted((len(members) for members in clusters.values() if len(members) > 1), reverse=True)
+        num_moved = sum(len(photo_tag_ids) for photo_tag_ids, _ in merges)
+
+        if dry_run:
+            logger.info(
+                f'Library {library.id}: would cluster {len(photo_tags)} unknown faces into {len(sizes)} people '
+                f'and {len(clusters) - len(sizes)} singletons, moving {num_moved} faces'
+            )
+            if sizes:
+                logger.info(f'Library {library.id}: largest clusters {sizes[:20]}, faces per cluster {sorted(Counter(sizes).items())}')
+            return
+
+        num_deleted_tags = 0
+        for photo_tag_ids, keep_tag_id in merges:
+            num_deleted_tags += reassign_faces(photo_tag_ids, keep_tag_id)
+
+        # The similarity index would otherwise keep matching faces to the removed tags
+        if merges:
+            FaceModel(library_id=library.id).retrain_face_similarity_index()
+
+        logger.info(
+            f'Library {library.id}: clustered {len(photo_tags)} unknown faces into {len(sizes)} people '
+            f'and {len(clusters) - len(sizes)} singletons, moved {num_moved} faces, '
+            f'removed {num_deleted_tags} tags in {time() - start:.3f}s'
+        )
+
+    def handle(self, *args, **options):
+        libraries = Library.objects.all()
+        if options['library']:
+            libraries = libraries.filter(id=options['library'])
+        for library in libraries:
+            self.cluster_library(library, options['threshold'], dry_run=options['dry_run'])
@@ -10,15 +10,16 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('paths', nargs='+')
+        parser.add_argument('--workers', type=int, default=1, help='Number of processes to read file metadata with')
 
-    def import_photos(self, paths):
+    def import_photos(self, paths, num_workers=1):
         missing = missing_system_dependencies(['exiftool', ])
         if missing:
             logger.critical('Missing dependencies: {}'.format(missing))
             exit(1)
 
         for path in paths:
-            import_photos_from_dir(path)
+            import_photos_from_dir(path, num_workers=num_workers)
 
     def handle(self, *args, **options):
-        self.import_photos(options['paths'])
+        self.import_photos(options['paths'], options['workers'])
@@ -1,13 +1,13 @@
 import queue
 import threading
 from multiprocessing import cpu_count
-from time import sleep
+from time import time
 
 from django.core.management.base import BaseCommand
 
-from photonix.photos.models import Task
+from photonix.photos.models import Task, get_worker_id
 from photonix.photos.utils.raw import process_raw_task
-from photonix.photos.utils.tasks import requeue_stuck_tasks
+from photonix.photos.utils.tasks import TaskListener, interrupt_on_sigterm, release_queued_tasks, requeue_dead_worker_tasks, requeue_stuck_tasks
 from photonix.web.utils import logger
 
 
@@ -32,32 +32,46 @@ class Command(BaseCommand):
     def run_processors(self):
         num_workers = max(int(cpu_count() / 4), 1)
         threads = []
+        worker_id = get_worker_id()
 
         logger.info(f'Starting {num_workers} raw processor workers')
 
+        interrupt_on_sigterm()
+        requeue_dead_worker_tasks('process_raw')
+
         for i in range(num_workers):
             t = threading.Thread(target=worker)
             t.start()
             threads.append(t)
 
+        listener = TaskListener(['process_raw'])
+        last_requeued = 0
+
         try:
             while True:
-                requeue_stuck_tasks('process_raw')
+                if time() - last_requeued >= listener.poll_interval:
+                    requeue_stuck_tasks('process_raw')
+                    last_requeued = time()
 
                 num_remaining = Task.objects.filter(type='process_raw', status='P').count()
                 if num_remaining:
                     logger.info(f'{num_remaining} tasks remaining for raw processing')
 
                 # Load 'Pending' tasks onto worker threads
-                for task in Task.objects.filter(type='process_raw', status='P')[:64]:
+                tasks = Task.objects.claim('process_raw', limit=64, worker_id=worker_id)
+                for task in tasks:
                     q.put(task)
                     logger.info('Finished raw processing batch')
 
                 # Wait until all threads have finished
                 q.join()
-                sleep(1)
+
+                # Carry straight on while there's a backlog, otherwise sleep until a task is queued
+                if len(tasks) < 64:
+                    listener.wait()
 
         except KeyboardInterrupt:
+            release_queued_tasks(q)
             # Shut down threads cleanly
             for i in range(num_workers):
                 q.put(None)
@@ -2,6 +2,7 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 from redis_lock import Lock
 
+from photonix.photos.utils.metadata import metadata_cache
 from photonix.photos.utils.redis import redis_connection
 from photonix.photos.utils.organise import rescan_photo_libraries
 from photonix.photos.utils.system import missing_system_dependencies
@@ -13,16 +14,20 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--paths', nargs='+', default=[])
+        parser.add_argument('--full', action='store_true', help='Re-read every file instead of skipping ones whose modification time and size are unchanged')
+        parser.add_argument('--workers', type=int, default=1, help='Number of processes to read file metadata with')
+        parser.add_argument('--allow-mass-delete', action='store_true', help='Remove missing photos even if the library path is empty or most of it has gone')
 
-    def rescan_photos(self, paths):
+    def rescan_photos(self, paths, full=False, num_workers=1, allow_mass_delete=False):
         missing = missing_system_dependencies(['exiftool', ])
         if missing:
             logger.critical(f'Missing dependencies: {missing}')
             exit(1)
 
-        rescan_photo_libraries(paths)
+        rescan_photo_libraries(paths, full=full, num_workers=num_workers, allow_mass_delete=allow_mass_delete)
         logger.info('Rescan complete')
+        logger.info(f'Metadata cache: {metadata_cache.stats()}')
 
     def handle(self, *args, **options):
         with Lock(redis_connection, 'rescan_photos'):
-            self.rescan_photos(options['paths'])
+            self.rescan_photos(options['paths'], options['full'], options['workers'], options['allow_mass_delete'])
@@ -15,21 +15,23 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--paths', nargs='+', default=[])
+        parser.add_argument('--full', action='store_true', help='Re-read every file instead of skipping ones whose modification time and size are unchanged')
+        parser.add_argument('--workers', type=int, default=1, help='Number of processes to read file metadata with')
 
-    def rescan_photos(self, paths):
+    def rescan_photos(self, paths, full=False, num_workers=1):
         missing = missing_system_dependencies(['exiftool', ])
         if missing:
             logger.critical(f'Missing dependencies: {missing}')
             exit(1)
 
-        rescan_photo_libraries(paths)
+        rescan_photo_libraries(paths, full=full, num_workers=num_workers)
         logger.info('Rescan complete')
 
     def handle(self, *args, **options):
         try:
             while True:
                 with Lock(redis_connection, 'rescan_photos'):
-                    self.rescan_photos(options['paths'])
+                    self.rescan_photos(options['paths'], options['full'], options['workers'])
                 sleep(60 * 60)  # Sleep for an hour
         except KeyboardInterrupt:
             pass
\ No newline at end of file
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0019_alter_task_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='claimed_by',
+            field=models.CharField(blank=True, help_text='Host and process ID of the worker that claimed the task', max_length=128, null=True),
+        ),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+
+CREATE_TRIGGER = '''
+CREATE OR REPLACE FUNCTION photos_task_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' OR OLD.status IS DISTINCT FROM NEW.status THEN
+        PERFORM pg_notify('photonix_tasks', NEW.type);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS photos_task_notify ON photos_task;
+CREATE TRIGGER photos_task_notify
+    AFTER INSERT OR UPDATE OF status ON photos_task
+    FOR EACH ROW WHEN (NEW.status = 'P')
+    EXECUTE FUNCTION photos_task_notify();
+'''
+
+DROP_TRIGGER = '''
+DROP TRIGGER IF EXISTS photos_task_notify ON photos_task;
+DROP FUNCTION IF EXISTS photos_task_notify();
+'''
+
+
+def create_trigger(apps, schema_editor):
+    # Workers fall back to polling on databases without LISTEN/NOTIFY
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_TRIGGER)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0020_task_claimed_by'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
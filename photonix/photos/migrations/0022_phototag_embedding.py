@@ -0,0 +1,60 @@
+import json
+import struct
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def move_embeddings_to_binary(apps, schema_editor):
+    # Face embeddings used to be JSON lists in extra_data: {"facenet_embedding": [...]}
+    PhotoTag = apps.get_model('photos', 'PhotoTag')
+    batch = []
+    for photo_tag in PhotoTag.objects.filter(extra_data__contains='facenet_embedding').only('id', 'extra_data').iterator(chunk_size=BATCH_SIZE):
+        try:
+            extra_data = json.loads(photo_tag.extra_data)
+            embedding = extra_data.pop('facenet_embedding')
+        except (json.decoder.JSONDecodeError, KeyError, TypeError, AttributeError):
+            continue
+        photo_tag.embedding = struct.pack(f'<{len(embedding)}f', *embedding)
+        photo_tag.extra_data = json.dumps(extra_data) if extra_data else None
+        batch.append(photo_tag)
+        if len(batch) >= BATCH_SIZE:
+            PhotoTag.objects.bulk_update(batch, ['embedding', 'extra_data'])
+            batch = []
+    if batch:
+        PhotoTag.objects.bulk_update(batch, ['embedding', 'extra_data'])
+
+
+def move_embeddings_to_json(apps, schema_editor):
+    PhotoTag = apps.get_model('photos', 'PhotoTag')
+    batch = []
+    for photo_tag in PhotoTag.objects.filter(embedding__isnull=False).only('id', 'extra_data', 'embedding').iterator(chunk_size=BATCH_SIZE):
+        data = bytes(photo_tag.embedding)
+        extra_data = json.loads(photo_tag.extra_data) if photo_tag.extra_data else {}
+        extra_data['facenet_embedding'] = list(struct.unpack(f'<{len(data) // 4}f', data))
+        photo_tag.extra_data = json.dumps(extra_data)
+        photo_tag.embedding = None
+        batch.append(photo_tag)
+        if len(batch) >= BATCH_SIZE:
+            PhotoTag.objects.bulk_update(batch, ['embedding', 'extra_data'])
+            batch = []
+    if batch:
+        PhotoTag.objects.bulk_update(batch, ['embedding', 'extra_data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0021_task_notify_trigger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phototag',
+            name='embedding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(move_embeddings_to_binary, move_embeddings_to_json),
+    ]
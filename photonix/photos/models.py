@@ -1,4 +1,6 @@
+import os
 from pathlib import Path
+import socket
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -65,11 +67,11 @@ class LibraryPath(UUIDModel, VersionedModel):
     s3_access_key_id = models.CharField(max_length=20, blank=True, null=True, help_text='AWS S3 (or compatible) access key ID')
     s3_secret_key = models.CharField(max_length=40, blank=True, null=True, help_text='AWS S3 (or compatible) secret key')
 
-    def rescan(self):
+    def rescan(self, full=False, num_workers=1, allow_mass_delete=False):
         from photonix.photos.utils.organise import import_photos_in_place
 
         if self.type == 'St' and self.backend_type == 'Lo':
-            import_photos_in_place(self)
+            import_photos_in_place(self, full=full, num_workers=num_workers, allow_mass_delete=allow_mass_delete)
 
 
 class LibraryUser(UUIDModel, VersionedModel):
@@ -292,6 +294,8 @@ class PhotoTag(UUIDModel, VersionedModel):
     size_y = models.FloatField(null=True)
     # A place to store extra JSON data such as face feature positions for eyes, nose and mouth
     extra_data = models.TextField(null=True)
+    # Face embeddings stored as packed little-endian float32 values (512 bytes for FaceNet)
+    embedding = models.BinaryField(null=True, blank=True)
     deleted = models.BooleanField(default=False)
 
     class Meta:
@@ -311,6 +315,40 @@ TASK_STATUS_CHOICES = (
 )
 
 
+def get_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class TaskQuerySet(models.QuerySet):
+    def claim(self, task_type, limit=1, worker_id=None, **filters):
+        '''
+        Picks up to `limit` pending tasks and marks them as started in one
+        transaction. On Postgres rows locked by another worker's claim are
+        skipped (FOR UPDATE SKIP LOCKED) so any number of processors can share
+        a queue without running the same task twice.
+        '''
+        if worker_id is None:
+            worker_id = get_worker_id()
+        now = timezone.now()
+        with transaction.atomic():
+            tasks = list(self.select_for_update(skip_locked=True, of=('self',)).filter(type=task_type, status='P', **filters)[:limit])
+            if tasks:
+                self.filter(id__in=[task.id for task in tasks]).update(status='S', started_at=now, updated_at=now, claimed_by=worker_id)
+        for task in tasks:
+            task.status = 'S'
+            task.started_at = now
+            task.updated_at = now
+            task.claimed_by = worker_id
+        return tasks
+
+    def release(self):
+        '''
+        Puts claimed tasks that are still marked as started back to pending
+        so any worker can pick them up again.
+        '''
+        return self.filter(status='S').update(status='P', started_at=None, claimed_by=None, updated_at=timezone.now())
+
+
 class Task(UUIDModel, VersionedModel):
     type = models.CharField(max_length=128, db_index=True)
     subject_id = models.UUIDField(db_index=True)
@@ -323,6 +361,9 @@ class Task(UUIDModel, VersionedModel):
     parent = models.ForeignKey('self', related_name='children', null=True, on_delete=models.CASCADE)
     complete_with_children = models.BooleanField(default=False)
     library = models.ForeignKey(Library, related_name='task_library', on_delete=models.CASCADE, null=True, blank=True)
+    claimed_by = models.CharField(max_length=128, null=True, blank=True, help_text='Host and process ID of the worker that claimed the task')
+
+    objects = TaskQuerySet.as_manager()
 
     class Meta:
         ordering = ['-priority', 'created_at']  # Higher priority first, then oldest first
@@ -331,6 +372,9 @@ class Task(UUIDModel, VersionedModel):
         return '{}: {}'.format(self.type, self.created_at)
 
     def start(self):
+        if self.status == 'S':
+            # Already marked as started by Task.objects.claim()
+            return
         self.status = 'S'
         self.started_at = timezone.now()
         self.save()
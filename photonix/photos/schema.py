@@ -43,7 +43,7 @@ class PhotoTagType(DjangoObjectType):
 
     class Meta:
         model = PhotoTag
-        fields = "__all__"
+        exclude = ('embedding',)
 
     def resolve_show_verify_icon(self, info):
         if self.tag.type == 'F' and not self.verified and self.tag.photo_tags.filter(verified=True).exists():
@@ -1029,6 +1029,9 @@ class EditFaceTag(graphene.Mutation):
         photo_tag.confidence = 1
         photo_tag.deleted = False
         photo_tag.save()
+        # Other photos of the same person get moved onto this tag in the background
+        if photo_tag.embedding is not None:
+            Task(type='propagate_face_tag', subject_id=photo_tag.id, library=photo_tag.photo.library).save()
         return EditFaceTag(ok=True)
 
 
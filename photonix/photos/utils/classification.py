@@ -1,12 +1,13 @@
+from contextlib import closing
 import queue
 import threading
-from time import sleep
+from time import time
 import traceback
 
 from django.db import transaction
 
-from photonix.photos.models import Task, Photo
-from photonix.photos.utils.tasks import requeue_stuck_tasks, requeue_memory_wait_tasks, requeue_delayed_tasks
+from photonix.photos.models import Task, Photo, get_worker_id
+from photonix.photos.utils.tasks import TaskListener, claim_pending_tasks, interrupt_on_sigterm, release_queued_tasks, requeue_dead_worker_tasks, requeue_stuck_tasks, requeue_memory_wait_tasks, requeue_delayed_tasks
 from photonix.web.utils import logger
 
 
@@ -25,9 +26,25 @@ CLASSIFIERS = list(CLASSIFIER_PRIORITIES.keys())
 
 
 def process_classify_images_tasks():
-    for task in Task.objects.filter(type='classify_images', status='P').order_by('created_at'):
-        photo_id = task.subject_id
-        generate_classifier_tasks_for_photo(photo_id, task)
+    with closing(claim_pending_tasks('classify_images')) as tasks:
+        for task in tasks:
+            photo_id = task.subject_id
+            generate_classifier_tasks_for_photo(photo_id, task)
+
+
+def process_propagate_face_tag_tasks():
+    from photonix.classifiers.face.model import propagate_face_tag
+
+    with closing(claim_pending_tasks('propagate_face_tag')) as tasks:
+        for task in tasks:
+            try:
+                num_moved = propagate_face_tag(task.subject_id)
+                logger.info(f'Propagated face tag [{task.subject_id}] to {num_moved} other faces')
+                task.complete()
+            except Exception:
+                logger.error(f'Error propagating face tag [{task.subject_id}]')
+                traceback.print_exc()
+                task.failed()
 
 
 def generate_classifier_tasks_for_photo(photo_id, task):
@@ -57,10 +74,17 @@ class ThreadedQueueProcessor:
     2. Lazy loading mode: Pass `model_class` and `model_name` to use ModelManager
 
     In lazy loading mode, models are loaded on first use and unloaded after idle timeout.
+
+    Tasks are fed to the workers continuously: up to `batch_size` claimed tasks
+    are buffered and the buffer is topped up whenever it drains below half, so
+    workers don't wait on the slowest task of a batch before getting more.
+
+    If a `batch_runner` is given, each worker takes up to `inference_batch_size`
+    tasks at a time and classifies their photos with one model run.
     """
 
     def __init__(self, model=None, task_type=None, runner=None, num_workers=4, batch_size=64,
-                 model_class=None, model_name=None):
+                 model_class=None, model_name=None, batch_runner=None, inference_batch_size=1):
         """
         Initialize the processor.
 
@@ -69,19 +93,26 @@ class ThreadedQueueProcessor:
             task_type: Task type string (e.g., 'classify.object')
             runner: Function to run on each photo
             num_workers: Number of worker threads
-            batch_size: Batch size for processing
+            batch_size: Number of tasks to claim ahead of the workers (prefetch depth)
             model_class: Model class for lazy loading (new mode)
             model_name: Classifier name for ModelManager (new mode)
+            batch_runner: Function to run on a list of photos, returning (photo, results) for each
+            inference_batch_size: Number of photos passed to batch_runner at once
         """
         self.model = model
         self.model_class = model_class
         self.model_name = model_name
         self.task_type = task_type
         self.runner = runner
+        self.batch_runner = batch_runner
+        self.inference_batch_size = inference_batch_size if batch_runner else 1
         self.num_workers = num_workers
-        self.batch_size = batch_size
+        self.batch_size = max(batch_size, num_workers * self.inference_batch_size)
+        self.low_water_mark = max(self.batch_size // 2, num_workers)
         self.queue = queue.Queue()
         self.threads = []
+        self._refill = threading.Event()
+        self.worker_id = get_worker_id()
 
         # Lazy loading mode
         self._use_lazy_loading = model_class is not None and model_name is not None
@@ -97,9 +128,68 @@ class ThreadedQueueProcessor:
             if task is None:
                 break
 
-            self.__process_task(task)
+            # Take whatever else is already waiting, up to a full inference batch
+            tasks = [task]
+            while len(tasks) < self.inference_batch_size:
+                try:
+                    task = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if task is None:
+                    # Leave the shutdown signal for after this batch
+                    self.queue.task_done()
+                    self.queue.put(None)
+                    break
+                tasks.append(task)
+
+            self.__process_tasks(tasks)
+
+            for _ in tasks:
+                self.queue.task_done()
+            if self.queue.qsize() < self.low_water_mark:
+                self._refill.set()
+
+    def __process_tasks(self, tasks):
+        # Import here to avoid circular imports
+        from photonix.classifiers.model_manager import InsufficientMemoryError
+
+        if len(tasks) == 1 or not self.batch_runner:
+            for task in tasks:
+                self.__process_task(task)
+            return
+
+        for task in tasks:
+            task.start()
+
+        try:
+            if self._use_lazy_loading and self._model_manager:
+                self._model_manager.touch(self.model_name)
+
+            photos_results = self.batch_runner([task.subject_id for task in tasks])
 
-            self.queue.task_done()
+            if self._use_lazy_loading and self._model_manager:
+                self._model_manager.touch(self.model_name)
+
+        except InsufficientMemoryError:
+            for task in tasks:
+                task.memory_wait()
+            return
+
+        except Exception:
+            # Run them one at a time so only the photos at fault fail
+            logger.error(f'Error processing batch of {len(tasks)} {self.task_type} tasks, retrying individually')
+            traceback.print_exc()
+            for task in tasks:
+                self.__process_task(task)
+            return
+
+        for task, (photo, results) in zip(tasks, photos_results):
+            task.complete()
+            tag_summary = self._build_tag_summary(photo, results)
+            if tag_summary:
+                logger.info(f'Completed: {task.type} [{photo.id}] - {tag_summary}')
+            else:
+                logger.info(f'Completed: {task.type} [{photo.id}]')
 
     def __process_task(self, task):
         # Import here to avoid circular imports
@@ -199,43 +289,65 @@ class ThreadedQueueProcessor:
     def run(self, loop=True):
         logger.info('Starting {} {} workers'.format(self.num_workers, self.task_type))
 
+        # Recover anything a previous run of this processor had claimed but not finished
+        interrupt_on_sigterm()
+        requeue_dead_worker_tasks(self.task_type)
+
         if self.num_workers > 1:
             for i in range(self.num_workers):
                 t = threading.Thread(target=self.__worker)
                 t.start()
                 self.threads.append(t)
 
+        listener = TaskListener([self.task_type])
+        last_requeued = 0
+
+        # Only pick up tasks for libraries that have this classifier turned on
+        filters = {}
+        classifier = self.task_type.replace('classify.', '')
+        if classifier in ['color', 'location', 'face', 'style', 'object']:
+            filters[f'library__classification_{classifier}_enabled'] = True
+
+        tasks = []
         try:
             while True:
-                requeue_stuck_tasks(self.task_type)
-                requeue_memory_wait_tasks(self.task_type)
-                requeue_delayed_tasks(self.task_type)
-
-                if self.task_type == 'classify.color':
-                    task_queryset = Task.objects.filter(library__classification_color_enabled=True, type=self.task_type, status='P')
-                elif self.task_type == 'classify.location':
-                    task_queryset = Task.objects.filter(library__classification_location_enabled=True, type=self.task_type, status='P')
-                elif self.task_type == 'classify.face':
-                    task_queryset = Task.objects.filter(library__classification_face_enabled=True, type=self.task_type, status='P')
-                elif self.task_type == 'classify.style':
-                    task_queryset = Task.objects.filter(library__classification_style_enabled=True, type=self.task_type, status='P')
-                elif self.task_type == 'classify.object':
-                    task_queryset = Task.objects.filter(library__classification_object_enabled=True, type=self.task_type, status='P')
-                else:
-                    task_queryset = Task.objects.filter(type=self.task_type, status='P')
-                for task in task_queryset[:8]:
-                    if self.num_workers > 1:
-                        self.queue.put(task)
-                    else:
-                        self.__process_task(task)
-
+                # Delayed and memory-wait tasks don't notify so check for them every poll interval
+                if time() - last_requeued >= listener.poll_interval:
+                    requeue_stuck_tasks(self.task_type)
+                    requeue_memory_wait_tasks(self.task_type)
+                    requeue_delayed_tasks(self.task_type)
+                    last_requeued = time()
+
+                # Top the buffer back up to the prefetch depth
+                self._refill.clear()
+                limit = self.batch_size - self.queue.qsize() if self.num_workers > 1 else self.batch_size
+                tasks = Task.objects.claim(self.task_type, limit=limit, worker_id=self.worker_id, **filters) if limit > 0 else []
                 if self.num_workers > 1:
-                    self.queue.join()
+                    for task in tasks:
+                        self.queue.put(task)
+                else:
+                    for i in range(0, len(tasks), self.inference_batch_size):
+                        self.__process_tasks(tasks[i:i + self.inference_batch_size])
 
                 if not loop:
+                    if self.num_workers > 1:
+                        self.queue.join()
+                    listener.close()
                     self.__clean_up()
                     return
-                sleep(1)
+
+                if len(tasks) < limit:
+                    # Queue is empty for now so sleep until another task is added
+                    listener.wait()
+                elif self.num_workers > 1:
+                    # More tasks are waiting so fetch them as soon as the workers have room
+                    self._refill.wait(timeout=listener.poll_interval)
 
         except KeyboardInterrupt:
+            # Don't leave claimed tasks marked as started when no worker is going to run them
+            if self.num_workers > 1:
+                release_queued_tasks(self.queue)
+            else:
+                Task.objects.filter(id__in=[task.id for task in tasks]).release()
+            listener.close()
             self.__clean_up()
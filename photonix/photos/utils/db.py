@@ -1,20 +1,26 @@
 from datetime import datetime, timezone
 from decimal import Decimal
-import imghdr
+from itertools import islice
 import mimetypes
 import os, time
 import re
 import subprocess
 
+from django.db import transaction
+from django.utils import timezone as django_timezone
+
 utc = timezone.utc
 
 from photonix.photos.models import Camera, Lens, Photo, PhotoFile, Task, Library, Tag, PhotoTag
-from photonix.photos.utils.metadata import PhotoMetadata, parse_datetime, parse_gps_location, get_mimetype
+from photonix.photos.utils.filetypes import get_image_mimetype
+from photonix.photos.utils.metadata import PhotoMetadata, parse_datetime, get_mimetype
 from photonix.web.utils import logger
 
 
+BULK_IMPORT_CHUNK_SIZE = 500
+
 MIMETYPE_WHITELIST = [
-    # This list is in addition to the filetypes detected by imghdr and 'dcraw -i'
+    # This list is in addition to the filetypes detected from the file header
     'image/heif',
     'image/heif-sequence',
     'image/heic',
@@ -23,51 +29,149 @@ MIMETYPE_WHITELIST = [
     'image/avif-sequence',
 ]
 
+# Less common raw formats we can't recognise from their header. Only files with
+# these extensions get checked by 'dcraw -i' so other files are rejected without
+# launching a process.
+DCRAW_EXTENSIONS = [
+    '.3fr', '.ari', '.bay', '.cap', '.crw', '.dcr', '.dcs', '.drf', '.eip', '.erf', '.fff', '.iiq', '.k25',
+    '.kdc', '.mdc', '.mef', '.mos', '.mrw', '.nrw', '.pef', '.ptx', '.pxn', '.r3d', '.raw', '.rwl', '.rwz',
+    '.sr2', '.srf', '.srw', '.x3f',
+]
 
-def record_photo(path, library, inotify_event_type=None):
-    mimetype = get_mimetype(path)
 
-    if not imghdr.what(path) and not mimetype in MIMETYPE_WHITELIST and subprocess.run(['dcraw', '-i', path]).returncode:
-        logger.error(f'File is not a supported type: {path} ({mimetype})')
-        return None
+def is_supported_file(path, mimetype=None):
+    if get_image_mimetype(path) or mimetype in MIMETYPE_WHITELIST:
+        return True
+    if os.path.splitext(path)[1].lower() in DCRAW_EXTENSIONS:
+        return not subprocess.run(['dcraw', '-i', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    return False
 
-    if type(library) == Library:
-        library_id = library.id
-    else:
-        library_id = str(library)
+
+def get_date_taken(metadata, path):
+    date_taken = None
+    possible_date_keys = ['Create Date', 'Date/Time Original', 'Date Time Original', 'Date/Time', 'Date Time', 'GPS Date/Time', 'File Modification Date/Time']
+    for date_key in possible_date_keys:
+        date_taken = parse_datetime(metadata.get(date_key))
+        if date_taken:
+            break
+    # If EXIF data not found.
+    return date_taken or datetime.strptime(time.ctime(os.path.getctime(path)), "%a %b %d %H:%M:%S %Y")
+
+
+def get_camera_make_model(metadata):
+    camera_make = metadata.get('Make', '')[:Camera.make.field.max_length]
+    camera_model = metadata.get('Camera Model Name', '')
+    if camera_model:
+        camera_model = camera_model.replace(camera_make, '').strip()
+    camera_model = camera_model[:Camera.model.field.max_length]
+    return camera_make, camera_model
+
+
+def get_photo_attributes(metadata):
+    # Fields for a new Photo that come straight from the file's metadata
+    latitude = None
+    longitude = None
+    location = metadata.get_gps_location()
+    if location:
+        latitude, longitude = location
+
+    iso_speed = None
+    if metadata.get('ISO'):
+        try:
+            iso_speed = int(re.search(r'[0-9]+', metadata.get('ISO')).group(0))
+        except AttributeError:
+            pass
+
+    aperture = None
+    aperturestr = metadata.get('Aperture')
+    if aperturestr:
+        try:
+            aperture = Decimal(aperturestr)
+            if aperture.is_infinite():
+                aperture = None
+        except:
+            pass
+
+    return dict(
+        taken_by=metadata.get('Artist', '')[:Photo.taken_by.field.max_length] or None,
+        aperture=aperture,
+        exposure=metadata.get('Exposure Time', '')[:Photo.exposure.field.max_length] or None,
+        iso_speed=iso_speed,
+        focal_length=metadata.get('Focal Length') and metadata.get('Focal Length').split(' ', 1)[0] or None,
+        flash=metadata.get('Flash') and 'on' in metadata.get('Flash').lower() or False,
+        metering_mode=metadata.get('Metering Mode', '')[:Photo.metering_mode.field.max_length] or None,
+        drive_mode=metadata.get('Drive Mode', '')[:Photo.drive_mode.field.max_length] or None,
+        shooting_mode=metadata.get('Shooting Mode', '')[:Photo.shooting_mode.field.max_length] or None,
+        latitude=latitude,
+        longitude=longitude,
+        altitude=metadata.get('GPS Altitude') and metadata.get('GPS Altitude').split(' ')[0],
+        star_rating=metadata.get('Rating'),
+    )
+
+
+def get_subjects(metadata):
+    subjects = []
+    for subject in metadata.get('Subject', '').split(','):
+        subject = subject.strip()
+        if subject:
+            subjects.append(subject)
+    return subjects
+
+
+def get_exif_rotation(metadata):
+    # Map EXIF orientation to rotation degrees (stored for reference and display calculation)
+    exif_orientation = metadata.get('Orientation')
+    exif_rotation = 0
+    if exif_orientation in ['Rotate 90 CW', 'Rotate 270 CCW']:
+        exif_rotation = 90
+    elif exif_orientation in ['Rotate 90 CCW', 'Rotate 270 CW']:
+        exif_rotation = 270
+    elif exif_orientation == 'Rotate 180':
+        exif_rotation = 180
+    return exif_rotation
+
+
+def record_photo(path, library, inotify_event_type=None, metadata=None):
     try:
         photo_file = PhotoFile.objects.get(path=path)
     except PhotoFile.DoesNotExist:
         photo_file = PhotoFile()
 
-    if inotify_event_type in ['DELETE', 'MOVED_FROM']: 
-        if PhotoFile.objects.filter(path=path).exists():
+    # The file has already gone so there is nothing to check the type of
+    if inotify_event_type in ['DELETE', 'MOVED_FROM']:
+        if not photo_file._state.adding:
             return delete_photo_record(photo_file)
         else:
             return True
 
+    # Check the header before asking exiftool anything so non-images are cheap to reject
+    if not is_supported_file(path):
+        logger.error(f'File is not a supported type: {path}')
+        return None
+
+    # Metadata can be passed in when it has already been read in bulk
+    if metadata:
+        mimetype = metadata.get('MIME Type') or get_image_mimetype(path)
+    else:
+        mimetype = get_mimetype(path)
+
+    if type(library) == Library:
+        library_id = library.id
+    else:
+        library_id = str(library)
+
     file_modified_at = datetime.fromtimestamp(os.stat(path).st_mtime, tz=utc)
 
     if photo_file and photo_file.file_modified_at == file_modified_at:
         return 'SKIPPED'
 
     logger.info(f'Recording photo {path}')
-    metadata = PhotoMetadata(path)
-    date_taken = None
-    possible_date_keys = ['Create Date', 'Date/Time Original', 'Date Time Original', 'Date/Time', 'Date Time', 'GPS Date/Time', 'File Modification Date/Time']
-    for date_key in possible_date_keys:
-        date_taken = parse_datetime(metadata.get(date_key))
-        if date_taken:
-            break
-    # If EXIF data not found.
-    date_taken = date_taken or datetime.strptime(time.ctime(os.path.getctime(path)), "%a %b %d %H:%M:%S %Y")
+    if not metadata:
+        metadata = PhotoMetadata(path)
+    date_taken = get_date_taken(metadata, path)
 
     camera = None
-    camera_make = metadata.get('Make', '')[:Camera.make.field.max_length]
-    camera_model = metadata.get('Camera Model Name', '')
-    if camera_model:
-        camera_model = camera_model.replace(camera_make, '').strip()
-    camera_model = camera_model[:Camera.model.field.max_length]
+    camera_make, camera_model = get_camera_make_model(metadata)
     if camera_make and camera_model:
         try:
             camera = Camera.objects.get(library_id=library_id, make=camera_make, model=camera_model)
@@ -115,85 +219,37 @@ def record_photo(path, library, inotify_event_type=None):
         except Photo.DoesNotExist:
             pass
 
-    latitude = None
-    longitude = None
-    if metadata.get('GPS Position'):
-        latitude, longitude = parse_gps_location(metadata.get('GPS Position'))
-
-    iso_speed = None
-    if metadata.get('ISO'):
-        try:
-            iso_speed = int(re.search(r'[0-9]+', metadata.get('ISO')).group(0))
-        except AttributeError:
-            pass
     if not photo:
         # Save Photo
-        aperture = None
-        aperturestr = metadata.get('Aperture')
-        if aperturestr:
-            try:
-                aperture = Decimal(aperturestr)
-                if aperture.is_infinite():
-                    aperture = None
-            except:
-                pass
-
         photo = Photo(
             library_id=library_id,
             taken_at=date_taken,
-            taken_by=metadata.get('Artist', '')[:Photo.taken_by.field.max_length] or None,
-            aperture=aperture,
-            exposure=metadata.get('Exposure Time', '')[:Photo.exposure.field.max_length] or None,
-            iso_speed=iso_speed,
-            focal_length=metadata.get('Focal Length') and metadata.get('Focal Length').split(' ', 1)[0] or None,
-            flash=metadata.get('Flash') and 'on' in metadata.get('Flash').lower() or False,
-            metering_mode=metadata.get('Metering Mode', '')[:Photo.metering_mode.field.max_length] or None,
-            drive_mode=metadata.get('Drive Mode', '')[:Photo.drive_mode.field.max_length] or None,
-            shooting_mode=metadata.get('Shooting Mode', '')[:Photo.shooting_mode.field.max_length] or None,
             camera=camera,
             lens=lens,
-            latitude=latitude,
-            longitude=longitude,
-            altitude=metadata.get('GPS Altitude') and metadata.get('GPS Altitude').split(' ')[0],
-            star_rating=metadata.get('Rating')
+            **get_photo_attributes(metadata)
         )
         photo.save()
 
-        for subject in metadata.get('Subject', '').split(','):
-            subject = subject.strip()
-            if subject:
-                tag, _ = Tag.objects.get_or_create(library_id=library_id, name=subject, type="G")
-                PhotoTag.objects.create(
-                    photo=photo,
-                    tag=tag,
-                    confidence=1.0
+        for subject in get_subjects(metadata):
+            tag, _ = Tag.objects.get_or_create(library_id=library_id, name=subject, type="G")
+            PhotoTag.objects.create(
+                photo=photo,
+                tag=tag,
+                confidence=1.0
             )
     else:
         for photo_file in photo.files.all():
             if not os.path.exists(photo_file.path):
                 photo_file.delete()
 
+    # Save PhotoFile
     # Store original file dimensions (pre-rotation). Display dimensions are
     # calculated at query time by swapping based on total rotation.
-    width = metadata.get('Image Width')
-    height = metadata.get('Image Height')
-
-    # Map EXIF orientation to rotation degrees (stored for reference and display calculation)
-    exif_orientation = metadata.get('Orientation')
-    exif_rotation = 0
-    if exif_orientation in ['Rotate 90 CW', 'Rotate 270 CCW']:
-        exif_rotation = 90
-    elif exif_orientation in ['Rotate 90 CCW', 'Rotate 270 CW']:
-        exif_rotation = 270
-    elif exif_orientation == 'Rotate 180':
-        exif_rotation = 180
-
-    # Save PhotoFile
     photo_file.photo = photo
     photo_file.path = path
-    photo_file.width = width
-    photo_file.height = height
-    photo_file.exif_rotation = exif_rotation
+    photo_file.width = metadata.get('Image Width')
+    photo_file.height = metadata.get('Image Height')
+    photo_file.exif_rotation = get_exif_rotation(metadata)
     photo_file.mimetype = mimetype
     photo_file.file_modified_at = file_modified_at
     photo_file.bytes = os.stat(path).st_size
@@ -211,6 +267,187 @@ def record_photo(path, library, inotify_event_type=None):
     return photo
 
 
+def record_photos_bulk(metadatas, library, chunk_size=BULK_IMPORT_CHUNK_SIZE, verbose=False):
+    '''
+    Set-based equivalent of record_photo() for scanning many files at once.
+    `metadatas` is an iterable of PhotoMetadata (e.g. from PhotoMetadata.bulk).
+    Each chunk prefetches existing PhotoFiles, Cameras, Lenses and Tags in a
+    handful of queries and writes new records with bulk_create inside a
+    single transaction. Changed files that are already recorded go through
+    record_photo() as before. Returns counts of what happened to the files.
+    '''
+    if type(library) == Library:
+        library_id = library.id
+    else:
+        library_id = str(library)
+
+    counts = {'imported': 0, 'skipped': 0, 'bad': 0}
+    metadatas = iter(metadatas)
+    while True:
+        chunk = list(islice(metadatas, chunk_size))
+        if not chunk:
+            break
+        for key, val in _record_photos_chunk(chunk, library_id, verbose).items():
+            counts[key] += val
+    return counts
+
+
+def _record_photos_chunk(chunk, library_id, verbose=False):
+    counts = {'imported': 0, 'skipped': 0, 'bad': 0}
+    now = django_timezone.now()
+    existing_files = {photo_file.path: photo_file for photo_file in PhotoFile.objects.filter(path__in=[metadata.path for metadata in chunk])}
+
+    new_files = []
+    for metadata in chunk:
+        path = metadata.path
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            counts['bad'] += 1
+            continue
+        file_modified_at = datetime.fromtimestamp(stat.st_mtime, tz=utc)
+        existing_file = existing_files.get(path)
+        if existing_file and existing_file.file_modified_at == file_modified_at:
+            counts['skipped'] += 1
+            continue
+
+        mimetype = metadata.get('MIME Type') or get_image_mimetype(path)
+        if not is_supported_file(path, mimetype):
+            logger.error(f'File is not a supported type: {path} ({mimetype})')
+            counts['bad'] += 1
+            continue
+
+        if existing_file:
+            # Updates to previously recorded files are rare so take the slow path
+            if record_photo(path, library_id, metadata=metadata):
+                counts['imported'] += 1
+            continue
+
+        new_files.append((metadata, mimetype, file_modified_at, stat.st_size, _as_aware(get_date_taken(metadata, path))))
+
+    if not new_files:
+        return counts
+
+    logger.info(f'Recording {len(new_files)} photos')
+
+    with transaction.atomic():
+        # Cameras and lenses - fetch all used in this chunk then create or widen date ranges
+        camera_dates = {}
+        lens_dates = {}
+        for metadata, _, _, _, date_taken in new_files:
+            camera_make, camera_model = get_camera_make_model(metadata)
+            if camera_make and camera_model:
+                camera_dates.setdefault((camera_make, camera_model), []).append(date_taken)
+            if metadata.get('Lens ID'):
+                lens_dates.setdefault(metadata.get('Lens ID'), []).append(date_taken)
+
+        cameras = {}
+        if camera_dates:
+            for camera in Camera.objects.filter(library_id=library_id, make__in={make for make, _ in camera_dates}, model__in={model for _, model in camera_dates}):
+                cameras[(camera.make, camera.model)] = camera
+        _create_or_extend_date_ranges(
+            cameras, camera_dates, now,
+            lambda key: Camera(library_id=library_id, make=key[0], model=key[1]))
+
+        lenses = {}
+        if lens_dates:
+            for lens in Lens.objects.filter(library_id=library_id, name__in=lens_dates.keys()):
+                lenses[lens.name] = lens
+        _create_or_extend_date_ranges(
+            lenses, lens_dates, now,
+            lambda key: Lens(library_id=library_id, name=key))
+
+        # Generic tags from XMP subjects
+        subjects = {subject for metadata, _, _, _, _ in new_files for subject in get_subjects(metadata)}
+        tags = {}
+        if subjects:
+            Tag.objects.bulk_create([
+                Tag(library_id=library_id, name=subject, type='G', created_at=now, updated_at=now)
+                for subject in subjects
+            ], ignore_conflicts=True)
+            for tag in Tag.objects.filter(library_id=library_id, type='G', name__in=subjects):
+                tags.setdefault(tag.name, tag)
+
+        photos = []
+        photo_files = []
+        photo_tags = []
+        tasks = []
+        for metadata, mimetype, file_modified_at, size, date_taken in new_files:
+            photo = Photo(
+                library_id=library_id,
+                taken_at=date_taken,
+                camera=cameras.get(get_camera_make_model(metadata)),
+                lens=lenses.get(metadata.get('Lens ID')),
+                created_at=now,
+                updated_at=now,
+                **get_photo_attributes(metadata)
+            )
+            photos.append(photo)
+            photo_files.append(PhotoFile(
+                photo=photo,
+                path=metadata.path,
+                width=metadata.get('Image Width'),
+                height=metadata.get('Image Height'),
+                exif_rotation=get_exif_rotation(metadata),
+                mimetype=mimetype,
+                file_modified_at=file_modified_at,
+                bytes=size,
+                created_at=now,
+                updated_at=now,
+            ))
+            for subject in get_subjects(metadata):
+                photo_tags.append(PhotoTag(photo=photo, tag=tags[subject], confidence=1.0, created_at=now, updated_at=now))
+            tasks.append(Task(
+                type='ensure_raw_processed',
+                subject_id=photo.id,
+                complete_with_children=True,
+                library_id=library_id,
+                created_at=now,
+                updated_at=now,
+            ))
+
+        Photo.objects.bulk_create(photos)
+        PhotoFile.objects.bulk_create(photo_files)
+        PhotoTag.objects.bulk_create(photo_tags)
+        Task.objects.bulk_create(tasks)
+
+    if verbose:
+        for metadata, _, _, _, _ in new_files:
+            print('IMPORTED  {}'.format(metadata.path))
+    counts['imported'] += len(new_files)
+    return counts
+
+
+def _as_aware(date):
+    # The filesystem fallback for date taken is naive and can't be compared with EXIF dates
+    if date and not date.tzinfo:
+        return date.replace(tzinfo=utc)
+    return date
+
+
+def _create_or_extend_date_ranges(existing, dates, now, new_instance):
+    # Cameras and Lenses store the date range of the photos taken with them
+    to_create = []
+    for key, key_dates in dates.items():
+        earliest = min(key_dates)
+        latest = max(key_dates)
+        instance = existing.get(key)
+        if instance is None:
+            instance = new_instance(key)
+            instance.earliest_photo = earliest
+            instance.latest_photo = latest
+            instance.created_at = now
+            instance.updated_at = now
+            existing[key] = instance
+            to_create.append(instance)
+        elif earliest < instance.earliest_photo or latest > instance.latest_photo:
+            instance.earliest_photo = min(earliest, instance.earliest_photo)
+            instance.latest_photo = max(latest, instance.latest_photo)
+            instance.save()
+    if to_create:
+        type(to_create[0]).objects.bulk_create(to_create)
+
+
 def delete_photo_record(photo_file_obj):
     """Delete photo record if photo not exixts on library path."""
     delete_photofile_and_photo_record(photo_file_obj)
@@ -241,6 +478,16 @@ def delete_child_dir_all_photos(directory_path, library_id):
     return True
 
 
+def delete_photo_records(paths):
+    """Delete the photo records of files that no longer exist in the library."""
+    for photo_file_obj in PhotoFile.objects.filter(path__in=paths).select_related('photo'):
+        delete_photofile_and_photo_record(photo_file_obj)
+    Tag.objects.filter(photo_tags=None).delete()
+    Camera.objects.filter(photos=None).delete()
+    Lens.objects.filter(photos=None).delete()
+    return True
+
+
 def delete_photofile_and_photo_record(photo_file_obj):
     """Delete photoFile object with its photo object."""
     photo_obj = photo_file_obj.photo
@@ -0,0 +1,93 @@
+import os
+
+
+HEADER_SIZE = 4096
+
+# ISO base media file format brands (the 'ftyp' box) that are still images
+FTYP_BRANDS = {
+    b'crx ': 'image/x-canon-cr3',
+    b'heic': 'image/heic',
+    b'heix': 'image/heic',
+    b'heim': 'image/heic',
+    b'heis': 'image/heic',
+    b'hevc': 'image/heic-sequence',
+    b'hevx': 'image/heic-sequence',
+    b'mif1': 'image/heif',
+    b'msf1': 'image/heif-sequence',
+    b'avif': 'image/avif',
+    b'avis': 'image/avif-sequence',
+}
+
+# Raw formats that are TIFF containers without a distinctive header of their own
+TIFF_RAW_EXTENSIONS = {
+    '.nef': 'image/x-nikon-nef',
+    '.nrw': 'image/x-nikon-nrw',
+    '.arw': 'image/x-sony-arw',
+    '.sr2': 'image/x-sony-sr2',
+    '.srf': 'image/x-sony-srf',
+    '.dng': 'image/x-adobe-dng',
+    '.pef': 'image/x-pentax-pef',
+    '.srw': 'image/x-samsung-srw',
+    '.erf': 'image/x-epson-erf',
+    '.3fr': 'image/x-hasselblad-3fr',
+    '.iiq': 'image/x-phaseone-iiq',
+    '.dcr': 'image/x-kodak-dcr',
+    '.kdc': 'image/x-kodak-kdc',
+    '.mos': 'image/x-raw',
+    '.mef': 'image/x-mamiya-mef',
+}
+
+
+def sniff_mimetype(header, path=''):
+    '''
+    Works out the image type from the first few KB of a file. Returns None if
+    the data doesn't look like an image we can handle. The path is only used
+    to tell apart raw formats that share the plain TIFF container.
+    '''
+    if header[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if header[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if header[:2] == b'BM' and len(header) >= 14:
+        return 'image/bmp'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    if header[:12] == b'\x00\x00\x00\x0cjP  \r\n\x87\n':
+        return 'image/jp2'
+    if header[:16] == b'FUJIFILMCCD-RAW ':
+        return 'image/x-fujifilm-raf'
+    if header[:4] in (b'IIRO', b'IIRS', b'MMOR'):
+        return 'image/x-olympus-orf'
+    if header[:4] == b'IIU\x00':
+        return 'image/x-panasonic-rw2'
+    if header[:4] in (b'II*\x00', b'MM\x00*'):
+        if header[8:10] == b'CR':
+            return 'image/x-canon-cr2'
+        extension = os.path.splitext(str(path))[1].lower()
+        return TIFF_RAW_EXTENSIONS.get(extension, 'image/tiff')
+    if header[4:8] == b'ftyp':
+        # Major brand first, then the compatible brands listed after it
+        box_size = int.from_bytes(header[:4], 'big')
+        brands = [header[8:12]] + [header[i:i + 4] for i in range(16, min(box_size, len(header)) - 3, 4)]
+        if b'avif' in brands and brands[0] in (b'mif1', b'avif'):
+            return 'image/avif'
+        for brand in brands:
+            if brand in FTYP_BRANDS:
+                return FTYP_BRANDS[brand]
+        return None
+    if len(header) >= 3 and header[:1] == b'P' and header[1:2] in b'123456' and header[2:3].isspace():
+        return 'image/x-portable-pixmap'
+    if header.lstrip()[:7] == b'#define':
+        return 'image/x-xbitmap'
+    return None
+
+
+def get_image_mimetype(path):
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+    except (FileNotFoundError, IsADirectoryError, PermissionError):
+        return None
+    return sniff_mimetype(header, path)
@@ -1,19 +1,310 @@
+import atexit
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import copy
 from datetime import datetime, timezone
 from dateutil.parser import parse as parse_date
+from itertools import islice
+import json
 import mimetypes
+from multiprocessing.util import Finalize
 import os
+import queue
 import re
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, DEVNULL
+import threading
+
+from django.conf import settings
 
 utc = timezone.utc
 
+EXIFTOOL_READY_MARKER = b'{ready}'
+EXIFTOOL_BULK_CHUNK_SIZE = 200
+METADATA_CACHE_REDIS_TTL = 60 * 60 * 24
+
+
+class ExiftoolProcess(object):
+    '''
+    A single long-running `exiftool -stay_open True -@ -` process. Arguments
+    are written to stdin one per line and exiftool prints `{ready}` once the
+    output for that command is complete, so the Perl interpreter only has to
+    start up once rather than for every file.
+    '''
+    def __init__(self):
+        self.process = Popen(['exiftool', '-stay_open', 'True', '-@', '-'], stdout=PIPE, stdin=PIPE, stderr=DEVNULL)
+
+    @property
+    def running(self):
+        return self.process.poll() is None
+
+    def execute(self, *args):
+        command = b''.join(os.fsencode(arg) + b'\n' for arg in args) + b'-execute\n'
+        self.process.stdin.write(command)
+        self.process.stdin.flush()
+
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise BrokenPipeError('exiftool process exited unexpectedly')
+            if line.rstrip() == EXIFTOOL_READY_MARKER:
+                break
+            lines.append(line)
+        return b''.join(lines)
+
+    def close(self):
+        try:
+            if self.running:
+                self.process.stdin.write(b'-stay_open\nFalse\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+
+class ExiftoolPool(object):
+    '''
+    Thread-safe pool of warm exiftool processes. Processes are started lazily
+    up to `num_workers` and replaced if they crash. A pool created before a
+    fork is discarded in the child so pipes are never shared between
+    processes.
+    '''
+    def __init__(self, num_workers=None):
+        if num_workers is None:
+            num_workers = settings.EXIFTOOL_NUM_WORKERS
+        self.num_workers = max(num_workers, 1)
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._processes = []
+
+    def _acquire(self):
+        timeout = 0
+        while True:
+            try:
+                return self._idle.get(timeout=timeout) if timeout else self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                if len(self._processes) < self.num_workers:
+                    process = ExiftoolProcess()
+                    self._processes.append(process)
+                    return process
+            # All processes are busy - wait for one to be released, checking
+            # periodically in case a crashed one freed up capacity
+            timeout = 1
+
+    def _release(self, process):
+        self._idle.put(process)
+
+    def _discard(self, process):
+        process.close()
+        with self._lock:
+            if process in self._processes:
+                self._processes.remove(process)
+
+    def execute(self, *args):
+        # Retry once on a fresh process if the one we were given has died
+        for attempt in range(2):
+            process = self._acquire()
+            try:
+                result = process.execute(*args)
+            except (BrokenPipeError, OSError):
+                self._discard(process)
+                if attempt:
+                    raise
+                continue
+            self._release(process)
+            return result
+
+    def close(self):
+        with self._lock:
+            processes, self._processes = self._processes, []
+        for process in processes:
+            process.close()
+
+
+_exiftool_pool = None
+_exiftool_pool_lock = threading.Lock()
+
+
+def get_exiftool_pool():
+    global _exiftool_pool
+    with _exiftool_pool_lock:
+        if _exiftool_pool is None or _exiftool_pool._pid != os.getpid():
+            _exiftool_pool = ExiftoolPool()
+        return _exiftool_pool
+
+
+@atexit.register
+def close_exiftool_pool():
+    if _exiftool_pool is not None and _exiftool_pool._pid == os.getpid():
+        _exiftool_pool.close()
+
+
+class MetadataCache(object):
+    '''
+    Caches parsed metadata keyed by path, modification time and size so the
+    later stages of the pipeline don't have to run exiftool on a file that
+    has already been read. There is an in-process LRU and, if enabled with
+    METADATA_CACHE_REDIS, a shared Redis tier so other workers benefit too.
+    '''
+    def __init__(self, max_size=None, use_redis=None):
+        self.max_size = settings.METADATA_CACHE_SIZE if max_size is None else max_size
+        self.use_redis = settings.METADATA_CACHE_REDIS if use_redis is None else use_redis
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def key(self, path):
+        try:
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return None
+        return f'{os.fspath(path)}:{stat.st_mtime_ns}:{stat.st_size}'
+
+    def _redis(self):
+        from photonix.photos.utils.redis import redis_connection
+        return redis_connection
+
+    def get(self, key):
+        if key is None or not self.max_size:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        if self.use_redis:
+            try:
+                value = self._redis().get(f'metadata:{key}')
+            except Exception:
+                value = None
+            if value:
+                value = json.loads(value)
+                self._store(key, value)
+                with self._lock:
+                    self.hits += 1
+                    self.redis_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set(self, key, value):
+        if key is None or not self.max_size:
+            return
+        # Callers keep using their dicts so changes they make later mustn't reach the cache
+        value = copy.deepcopy(value)
+        self._store(key, value)
+        if self.use_redis:
+            try:
+                self._redis().set(f'metadata:{key}', json.dumps(value), ex=METADATA_CACHE_REDIS_TTL)
+            except Exception:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.redis_hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'hit_rate': lookups and self.hits / lookups or 0,
+            }
+
+
+metadata_cache = MetadataCache()
+
+
+def needs_own_exiftool_process(path):
+    '''
+    Arguments are passed to exiftool one per line in an argument file, which
+    strips surrounding whitespace and treats lines starting with # as
+    comments. Paths that wouldn't survive that have to be passed directly.
+    '''
+    return '\n' in path or path != path.strip() or path.startswith('#')
+
+
+def run_exiftool(path, use_pool=True):
+    path = os.fspath(path)
+    if use_pool and not needs_own_exiftool_process(path):
+        try:
+            return get_exiftool_pool().execute(path)
+        except (BrokenPipeError, OSError):
+            pass
+    return Popen(['exiftool', path], stdout=PIPE, stdin=PIPE, stderr=PIPE).communicate()[0]
+
+
+def run_exiftool_json(paths, use_pool=True):
+    '''
+    Reads many files in a single exiftool command. `-j -l` gives us JSON with
+    the same tag descriptions and print-converted values as the plain output
+    plus a "num" entry holding the machine-readable value where it differs.
+    '''
+    args = ['-j', '-l'] + [os.fspath(path) for path in paths]
+    output = None
+    if use_pool:
+        try:
+            output = get_exiftool_pool().execute(*args)
+        except (BrokenPipeError, OSError):
+            pass
+    if output is None:
+        argfile = b''.join(os.fsencode(arg) + b'\n' for arg in args)
+        output = Popen(['exiftool', '-@', '-'], stdout=PIPE, stdin=PIPE, stderr=PIPE).communicate(argfile)[0]
+    try:
+        # Keep numbers as the strings exiftool printed so values match the plain text output
+        return json.loads(output.decode('utf-8', 'ignore'), parse_float=str, parse_int=str)
+    except ValueError:
+        return []
+
 
 class PhotoMetadata(object):
-    def __init__(self, path):
+    def __init__(self, path, use_pool=True, exiftool_json=None, use_cache=True):
+        self.path = path
         self.data = {}
+        self.numeric = {}
+
+        cache_key = use_cache and metadata_cache.key(path) or None
+        if exiftool_json is None and cache_key:
+            cached = metadata_cache.get(cache_key)
+            if cached:
+                self.data, self.numeric = dict(cached['data']), dict(cached['numeric'])
+                return
+
+        if exiftool_json is not None:
+            self._parse_json(exiftool_json)
+        else:
+            self._parse_text(path, use_pool)
+
+        # Some file MIME Types can not be identified by exiftool so we fall back to Python's mimetypes library so the get_mimetype() funciton below is universal
+        if not self.data.get('MIME Type'):
+            self.data['MIME Type'] = mimetypes.guess_type(path)[0]
+
+        if cache_key:
+            metadata_cache.set(cache_key, {'data': self.data, 'numeric': self.numeric})
+
+    def _parse_text(self, path, use_pool):
         try:
             # exiftool produces data such as MIME Type for non-photos too
-            result = Popen(['exiftool', path], stdout=PIPE, stdin=PIPE, stderr=PIPE).communicate()[0].decode('utf-8', 'ignore')
+            result = run_exiftool(path, use_pool=use_pool).decode('utf-8', 'ignore')
         except UnicodeDecodeError:
             result = ''
         for line in str(result).split('\n'):
@@ -24,16 +315,130 @@ class PhotoMetadata(object):
                 except ValueError:
                     pass
 
-        # Some file MIME Types can not be identified by exiftool so we fall back to Python's mimetypes library so the get_mimetype() funciton below is universal
-        if not self.data.get('MIME Type'):
-            self.data['MIME Type'] = mimetypes.guess_type(path)[0]
+    def _parse_json(self, entry):
+        for key, value in entry.items():
+            if key == 'SourceFile':
+                continue
+            if isinstance(value, dict):
+                description = value.get('desc', key)
+                numeric = value.get('num')
+                value = value.get('val')
+            else:
+                description = key
+                numeric = None
+            if isinstance(value, list):
+                value = ', '.join(str(v) for v in value)
+            # Later tags with the same description win, as in the plain text output
+            self.data[description] = '' if value is None else str(value).strip()
+            if numeric is not None:
+                self.numeric[description] = numeric
+            else:
+                self.numeric.pop(description, None)
+
+    @classmethod
+    def bulk(cls, paths, chunk_size=EXIFTOOL_BULK_CHUNK_SIZE, num_workers=1):
+        '''
+        Generator yielding a PhotoMetadata instance for each path, in order,
+        reading up to `chunk_size` files per exiftool command. With more than
+        one worker, chunks are read in a pool of processes with a bounded
+        number of chunks in flight so huge directory walks don't queue up in
+        memory.
+        '''
+        paths = iter(paths)
+
+        def chunks():
+            while True:
+                chunk = [os.fspath(path) for path in islice(paths, chunk_size)]
+                if not chunk:
+                    break
+                yield chunk
+
+        if num_workers <= 1:
+            for chunk in chunks():
+                yield from cls._read_chunk(chunk)
+            return
+
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_metadata_worker) as executor:
+            in_flight = deque()
+            for chunk in chunks():
+                in_flight.append(executor.submit(_read_metadata_chunk, chunk))
+                if len(in_flight) >= num_workers * 2:
+                    yield from cls._cache_results(in_flight.popleft().result())
+            while in_flight:
+                yield from cls._cache_results(in_flight.popleft().result())
+
+    @classmethod
+    def _read_chunk(cls, chunk):
+        cached = {}
+        batchable = []
+        for path in chunk:
+            value = metadata_cache.get(metadata_cache.key(path))
+            if value:
+                cached[path] = value
+            elif not needs_own_exiftool_process(path):
+                batchable.append(path)
+
+        results = []
+        entries = {entry.get('SourceFile'): entry for entry in run_exiftool_json(batchable)} if batchable else {}
+        for path in chunk:
+            if path in cached:
+                results.append(cls._from_cache(path, cached[path]))
+            elif path in entries:
+                results.append(cls(path, exiftool_json=entries[path]))
+            else:
+                # Unusual names can't go in the argument file, and exiftool's
+                # output may be missing or not match the path, so these are
+                # read individually rather than recorded with no metadata
+                results.append(cls(path))
+        return results
+
+    @classmethod
+    def _cache_results(cls, results):
+        # Results read in worker processes are added to this process's cache
+        # so later stages don't need to read the files again
+        for metadata in results:
+            metadata_cache.set(metadata_cache.key(metadata.path), {'data': metadata.data, 'numeric': metadata.numeric})
+        return results
+
+    @classmethod
+    def _from_cache(cls, path, cached):
+        metadata = cls.__new__(cls)
+        metadata.path = path
+        metadata.data, metadata.numeric = dict(cached['data']), dict(cached['numeric'])
+        return metadata
 
     def get(self, attribute, default=None):
         return self.data.get(attribute, default)
 
+    def get_numeric(self, attribute, default=None):
+        return self.numeric.get(attribute, default)
+
     def get_all(self):
         return self.data
 
+    def get_gps_location(self):
+        # Numeric output from bulk reads lets us skip parsing the DMS string
+        numeric = self.get_numeric('GPS Position')
+        if numeric:
+            try:
+                latitude, longitude = [float(v) for v in str(numeric).split()]
+                return (latitude, longitude)
+            except ValueError:
+                pass
+        if self.get('GPS Position'):
+            return parse_gps_location(self.get('GPS Position'))
+        return None
+
+
+def _init_metadata_worker():
+    # Worker processes don't run atexit handlers so shut exiftool down via
+    # multiprocessing's own finalizers
+    Finalize(None, close_exiftool_pool, exitpriority=10)
+
+
+def _read_metadata_chunk(chunk):
+    return PhotoMetadata._read_chunk(chunk)
+
 
 def parse_datetime(date_str):
     if not date_str:
@@ -68,7 +473,7 @@ def parse_gps_location(gps_str):
     return (latitude, longitude)
 
 
-def get_datetime(path):
+def get_datetime(path, metadata=None):
     '''
     Tries to get date/time from EXIF data which works on JPEG and raw files.
     Failing it that it tries to find the date in the filename.
@@ -76,7 +481,8 @@ def get_datetime(path):
     # TODO: Use 'GPS Date/Time' if available as it's more accurate
 
     # First try the date in the metadata
-    metadata = PhotoMetadata(path)
+    if not metadata:
+        metadata = PhotoMetadata(path)
     date_str = metadata.get('Date/Time Original')
     if date_str:
         parsed_datetime = parse_datetime(date_str)
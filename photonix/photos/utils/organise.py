@@ -1,18 +1,26 @@
+from datetime import datetime, timezone
 import os
 import shutil
 from hashlib import md5
 from io import StringIO
+from time import time
 
 from PIL import Image
 
-from photonix.photos.models import LibraryPath
-from photonix.photos.utils.db import record_photo
+from photonix.photos.models import LibraryPath, PhotoFile
+from photonix.photos.utils.db import delete_photo_records, record_photo, record_photos_bulk
 from photonix.photos.utils.fs import (determine_destination,
                                       find_new_file_name, mkdir_p)
-from photonix.photos.utils.metadata import get_datetime
+from photonix.photos.utils.metadata import PhotoMetadata, get_datetime
 
 
 SYNOLOGY_THUMBNAILS_DIR_NAME = '/@eaDir'
+DELETE_CHUNK_SIZE = 500
+# A rescan won't remove more than this share of a library path's photos (once
+# over MASS_DELETE_MIN_FILES) unless asked to, as it usually means storage is
+# missing or only partly available rather than the photos having been deleted
+MASS_DELETE_FRACTION = 0.5
+MASS_DELETE_MIN_FILES = 100
 
 
 class FileHashCache(object):
@@ -94,100 +102,194 @@ def blacklisted_type(file):
         return True
     return False
 
-def import_photos_from_dir(orig, move=False):
+def import_photos_from_dir(orig, move=False, num_workers=1):
+    start = time()
     imported = 0
     were_duplicates = 0
     were_bad = 0
-
-    for r, d, f in os.walk(orig):
-        if SYNOLOGY_THUMBNAILS_DIR_NAME in r:
-            continue
-        for fn in sorted(f):
-            filepath = os.path.join(r, fn)
-            dest = determine_destination(filepath)
-            if blacklisted_type(fn):
-                # Blacklisted type
-                were_bad += 1
-            elif not dest:
-                # No filters match this file type
+    num_files = 0
+
+    def find_files():
+        nonlocal were_bad, num_files
+        for r, d, f in os.walk(orig):
+            if SYNOLOGY_THUMBNAILS_DIR_NAME in r:
+                continue
+            for fn in sorted(f):
+                num_files += 1
+                filepath = os.path.join(r, fn)
+                if blacklisted_type(fn):
+                    # Blacklisted type
+                    were_bad += 1
+                elif determine_destination(filepath):
+                    yield filepath
+                # Otherwise no filters match this file type
+
+    # Metadata for the files is read by `num_workers` processes while the
+    # copying and recording happens here
+    for metadata in PhotoMetadata.bulk(find_files(), num_workers=num_workers):
+        filepath = metadata.path
+        fn = os.path.basename(filepath)
+        dest = determine_destination(filepath)
+        t = get_datetime(filepath, metadata=metadata)
+        if t:
+            destpath = '%02d/%02d/%02d' % (t.year, t.month, t.day)
+            destpath = os.path.join(dest, destpath)
+            mkdir_p(destpath)
+            destpath = os.path.join(destpath, fn)
+
+            if filepath == destpath:
+                # File is already in the right place so be very careful not to do anything like delete it
                 pass
+            elif not os.path.exists(destpath):
+                if move:
+                    shutil.move(filepath, destpath)
+                else:
+                    shutil.copyfile(filepath, destpath)
+                record_photo(destpath)
+                imported += 1
+                print('IMPORTED  {} -> {}'.format(filepath, destpath))
             else:
-                t = get_datetime(filepath)
-                if t:
-                    destpath = '%02d/%02d/%02d' % (t.year, t.month, t.day)
-                    destpath = os.path.join(dest, destpath)
-                    mkdir_p(destpath)
-                    destpath = os.path.join(destpath, fn)
-
-                    if filepath == destpath:
-                        # File is already in the right place so be very careful not to do anything like delete it
-                        pass
-                    elif not os.path.exists(destpath):
-                        if move:
-                            shutil.move(filepath, destpath)
-                        else:
-                            shutil.copyfile(filepath, destpath)
-                        record_photo(destpath)
-                        imported += 1
-                        print('IMPORTED  {} -> {}'.format(filepath, destpath))
-                    else:
-                        print('PATH EXISTS  {} -> {}'.format(filepath, destpath))
-                        same = determine_same_file(filepath, destpath)
-                        print('PHOTO IS THE SAME')
-                        if same:
-                            if move:
-                                os.remove(filepath)
-                                were_duplicates += 1
-                                print('DELETED FROM SOURCE')
-                        else:
-                            print('NEED TO IMPORT UNDER DIFFERENT NAME')
-                            exit(1)
-                            destpath = find_new_file_name(destpath)
-                            shutil.move(filepath, destpath)
-                            record_photo(destpath)
-                            imported += 1
-                            # print 'IMPORTED  {} -> {}'.format(filepath, destpath)
-
+                print('PATH EXISTS  {} -> {}'.format(filepath, destpath))
+                same = determine_same_file(filepath, destpath)
+                print('PHOTO IS THE SAME')
+                if same:
+                    if move:
+                        os.remove(filepath)
+                        were_duplicates += 1
+                        print('DELETED FROM SOURCE')
                 else:
-                    print('ERROR READING DATE: {}'.format(filepath))
-                    were_bad += 1
+                    print('NEED TO IMPORT UNDER DIFFERENT NAME')
+                    exit(1)
+                    destpath = find_new_file_name(destpath)
+                    shutil.move(filepath, destpath)
+                    record_photo(destpath)
+                    imported += 1
+                    # print 'IMPORTED  {} -> {}'.format(filepath, destpath)
+
+        else:
+            print('ERROR READING DATE: {}'.format(filepath))
+            were_bad += 1
 
     if imported or were_duplicates:
         print('\n{} PHOTOS IMPORTED\n{} WERE DUPLICATES\n{} WERE BAD'.format(imported, were_duplicates, were_bad))
+    print_throughput(num_files, time() - start)
 
 
-def import_photos_in_place(library_path, quiet=True):
+def scan_directory(path, errors=None):
+    '''
+    Recursively yields (path, stat) for every file below path using os.scandir
+    so the stat results come from the directory listing where possible.
+    Directories that can't be listed and entries that can't be stat'ed are
+    appended to `errors` so callers know which parts of the tree weren't seen.
+    '''
+    try:
+        entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+    except OSError:
+        if errors is not None:
+            errors.append(path)
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                if not entry.is_symlink() and SYNOLOGY_THUMBNAILS_DIR_NAME not in entry.path:
+                    yield from scan_directory(entry.path, errors)
+            elif entry.is_file():
+                yield entry.path, entry.stat()
+        except OSError:
+            if errors is not None:
+                errors.append(entry.path)
+
+
+def import_photos_in_place(library_path, quiet=True, full=False, num_workers=1, allow_mass_delete=False):
+    '''
+    Records new and changed files in a library path. Unless `full` is set,
+    files whose modification time and size match what is already stored on
+    their PhotoFile are skipped using only a stat so an unchanged library can
+    be rescanned without running exiftool at all. Files that have been removed
+    since the last scan have their records deleted, unless the path looks
+    unmounted or most of it has gone and `allow_mass_delete` isn't set.
+
+    The directory walk happens here, metadata is read by `num_workers`
+    processes and the results are written to the database in batches by this
+    process.
+    '''
+    start = time()
     orig = library_path.path
-    imported = 0
-    already_imported = 0
     were_bad = 0
+    already_imported = 0
 
-    for r, d, f in os.walk(orig):
-        if SYNOLOGY_THUMBNAILS_DIR_NAME in r:
-            continue
-        for fn in sorted(f):
-            filepath = os.path.join(r, fn)
+    # Index of everything we already know about in this library path
+    prefix = os.path.join(orig, '')
+    known_files = {}
+    if not full:
+        for path, file_modified_at, size in PhotoFile.objects.filter(
+                photo__library=library_path.library, path__startswith=prefix).values_list('path', 'file_modified_at', 'bytes').iterator():
+            known_files[path] = (file_modified_at, size)
+    num_known = len(known_files)
+
+    scan_errors = []
+    num_seen = 0
+
+    def find_files():
+        nonlocal were_bad, already_imported, num_seen
+        for filepath, stat in scan_directory(orig, scan_errors):
+            num_seen += 1
+            fn = os.path.basename(filepath)
             if blacklisted_type(fn):
                 # Blacklisted type
                 were_bad += 1
-            else:
-                result = record_photo(filepath, library_path.library)
-                if result == 'SKIPPED':
-                    already_imported += 1
-                elif result:
-                    imported += 1
-                    if not quiet:
-                        print('IMPORTED  {}'.format(filepath))
-
-    if imported or already_imported:
-        print('\n{} PHOTOS IMPORTED\n{} ALREADY IMPORTED\n{} WERE BAD'.format(imported, already_imported, were_bad))
-
-
-def rescan_photo_libraries(paths=[]):
+                continue
+            known = known_files.pop(filepath, None)
+            if known and known == (datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc), stat.st_size):
+                already_imported += 1
+                continue
+            yield filepath
+
+    # Metadata is read for many files per exiftool call and the database
+    # records are written in chunks
+    counts = record_photos_bulk(PhotoMetadata.bulk(find_files(), num_workers=num_workers), library_path.library, verbose=not quiet)
+    imported = counts['imported']
+    already_imported += counts['skipped']
+    were_bad += counts['bad']
+
+    # Anything left in the index wasn't found on disk. If the library root
+    # couldn't be listed (e.g. it's unmounted) nothing is deleted, and files
+    # under any directory or entry we failed to read are left alone.
+    if orig in scan_errors:
+        print(f'Could not read library path {orig}, not removing any photos')
+        known_files = {}
+    elif scan_errors:
+        print('Could not read {} paths in {}, not removing photos below them'.format(len(scan_errors), orig))
+        unseen_paths = set(scan_errors)
+        unseen_dirs = tuple(os.path.join(path, '') for path in scan_errors)
+        known_files = {path: known for path, known in known_files.items() if path not in unseen_paths and not path.startswith(unseen_dirs)}
+    deleted_paths = list(known_files.keys())
+    if deleted_paths and not allow_mass_delete:
+        # An unmounted network share or USB drive usually leaves an empty mount point behind
+        if not num_seen:
+            print(f'Library path {orig} is empty, not removing any photos - check it is mounted or rescan with --allow-mass-delete')
+            deleted_paths = []
+        elif len(deleted_paths) > max(MASS_DELETE_MIN_FILES, num_known * MASS_DELETE_FRACTION):
+            print(f'{len(deleted_paths)} of {num_known} photos are missing from {orig}, not removing them - rescan with --allow-mass-delete if they really have been deleted')
+            deleted_paths = []
+    for i in range(0, len(deleted_paths), DELETE_CHUNK_SIZE):
+        delete_photo_records(deleted_paths[i:i + DELETE_CHUNK_SIZE])
+
+    if imported or already_imported or deleted_paths:
+        print('\n{} PHOTOS IMPORTED\n{} ALREADY IMPORTED\n{} WERE BAD\n{} WERE DELETED'.format(imported, already_imported, were_bad, len(deleted_paths)))
+    print_throughput(imported + already_imported + were_bad, time() - start)
+
+
+def print_throughput(num_files, duration):
+    rate = duration and num_files / duration or 0
+    print('{} FILES SCANNED IN {:.1f}s ({:.1f} FILES/SEC)'.format(num_files, duration, rate))
+
+
+def rescan_photo_libraries(paths=[], full=False, num_workers=1, allow_mass_delete=False):
     library_paths = LibraryPath.objects.filter(type='St', backend_type='Lo')
     if paths:
         library_paths = library_paths.filter(path__in=paths)
 
     for library_path in library_paths:
         print(f'Searching path for changes {library_path.path}')
-        library_path.rescan()
+        library_path.rescan(full=full, num_workers=num_workers, allow_mass_delete=allow_mass_delete)
@@ -1,3 +1,4 @@
+from contextlib import closing
 import os
 import re
 import shutil
@@ -12,6 +13,7 @@ from photonix.photos.models import Photo, PhotoFile, Task
 from photonix.web.utils import logger
 
 from .metadata import get_dimensions, get_mimetype
+from .tasks import claim_pending_tasks
 
 RAW_PROCESS_VERSION = '20190305'
 NON_RAW_MIMETYPES = [
@@ -28,9 +30,10 @@ NON_RAW_MIMETYPES = [
 
 
 def ensure_raw_processing_tasks():
-    for task in Task.objects.filter(type='ensure_raw_processed', status='P').order_by('created_at'):
-        photo_id = task.subject_id
-        ensure_raw_processed(photo_id, task)
+    with closing(claim_pending_tasks('ensure_raw_processed')) as tasks:
+        for task in tasks:
+            photo_id = task.subject_id
+            ensure_raw_processed(photo_id, task)
 
 
 def ensure_raw_processed(photo_id, task):
@@ -50,9 +53,10 @@ def ensure_raw_processed(photo_id, task):
 
 
 def process_raw_tasks():
-    for task in Task.objects.filter(type='process_raw', status='P').order_by('created_at'):
-        photo_file_id = task.subject_id
-        process_raw_task(photo_file_id, task)
+    with closing(claim_pending_tasks('process_raw')) as tasks:
+        for task in tasks:
+            photo_file_id = task.subject_id
+            process_raw_task(photo_file_id, task)
 
 
 def process_raw_task(photo_file_id, task):
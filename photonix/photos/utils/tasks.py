@@ -1,8 +1,22 @@
 from datetime import timedelta
+import os
+import queue
+import select
+import signal
+import socket
+import threading
+from time import sleep, time
 
+from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 from django.db.models import Q
-from photonix.photos.models import Task
+from photonix.photos.models import Task, get_worker_id
+from photonix.web.utils import logger
+
+
+# Channel the photos_task trigger (migration 0021) notifies when a task becomes pending
+TASK_NOTIFY_CHANNEL = 'photonix_tasks'
 
 
 def requeue_stuck_tasks(task_type, age_hours=24, max_num=8):
@@ -15,6 +29,158 @@ def requeue_stuck_tasks(task_type, age_hours=24, max_num=8):
         task.save()
 
 
+def claim_pending_tasks(task_type, batch_size=16, **filters):
+    '''
+    Yields pending tasks of a type, claiming them from the queue a batch at a
+    time. If the caller stops early, e.g. because handling a task raised, the
+    rest of the batch that was never handed out goes back to pending - close
+    the generator (contextlib.closing) so this happens straight away.
+    '''
+    while True:
+        tasks = Task.objects.claim(task_type, limit=batch_size, **filters)
+        if not tasks:
+            return
+        num_yielded = 0
+        try:
+            for task in tasks:
+                num_yielded += 1
+                yield task
+        finally:
+            unstarted = tasks[num_yielded:]
+            if unstarted:
+                Task.objects.filter(id__in=[task.id for task in unstarted]).release()
+
+
+def _worker_is_alive(worker_id):
+    try:
+        pid = int(worker_id.rsplit(':', 1)[1])
+    except (IndexError, ValueError):
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def requeue_dead_worker_tasks(task_type):
+    '''
+    Puts back tasks of a type that were claimed by worker processes on this
+    host which no longer exist, e.g. after a crash or restart. Meant to be
+    called when a processor starts, so this process's own worker ID counts as
+    dead too - its PID may have been reused from before the restart.
+    '''
+    queryset = Task.objects.filter(type=task_type, status='S', claimed_by__startswith=f'{socket.gethostname()}:')
+    own_worker_id = get_worker_id()
+    dead_worker_ids = [
+        worker_id for worker_id in queryset.order_by().values_list('claimed_by', flat=True).distinct()
+        if worker_id == own_worker_id or not _worker_is_alive(worker_id)
+    ]
+    if not dead_worker_ids:
+        return 0
+
+    count = queryset.filter(claimed_by__in=dead_worker_ids).release()
+    if count:
+        logger.info(f'Requeued {count} {task_type} tasks claimed by stopped workers')
+    return count
+
+
+def release_queued_tasks(task_queue):
+    '''
+    Empties a worker queue of tasks that have been claimed but not handed to
+    a worker yet and puts them back to pending.
+    '''
+    task_ids = []
+    while True:
+        try:
+            task = task_queue.get_nowait()
+        except queue.Empty:
+            break
+        task_queue.task_done()
+        if task is not None:
+            task_ids.append(task.id)
+
+    if not task_ids:
+        return 0
+    count = Task.objects.filter(id__in=task_ids).release()
+    logger.info(f'Returned {count} unstarted tasks to the queue')
+    return count
+
+
+def interrupt_on_sigterm():
+    '''
+    Makes SIGTERM (as sent by supervisord and docker stop) raise
+    KeyboardInterrupt so processors get to shut down cleanly.
+    '''
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+
+class TaskListener:
+    """
+    Lets a worker sleep until a task it handles becomes pending.
+
+    On Postgres this LISTENs on a dedicated connection for notifications sent
+    by the task table trigger, so workers wake within milliseconds and an idle
+    system doesn't poll the database. Other databases fall back to sleeping for
+    a second, as the processors always did.
+    """
+
+    def __init__(self, task_types, poll_interval=None):
+        self.task_types = set(task_types)
+        self.poll_interval = settings.TASK_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.connection = None
+
+    def _connect(self):
+        self.connection = connection.get_new_connection(connection.get_connection_params())
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {TASK_NOTIFY_CHANNEL}')
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def wait(self):
+        """
+        Blocks until a relevant task is queued or the poll interval has passed.
+        Returns True if woken by a notification.
+        """
+        if connection.vendor != 'postgresql':
+            sleep(1)
+            return False
+
+        try:
+            if self.connection is None:
+                self._connect()
+            deadline = time() + self.poll_interval
+            while True:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                if select.select([self.connection], [], [], remaining)[0]:
+                    self.connection.poll()
+                    notified = False
+                    while self.connection.notifies:
+                        notify = self.connection.notifies.pop(0)
+                        if notify.payload in self.task_types:
+                            notified = True
+                    if notified:
+                        return True
+        except Exception as e:
+            # Drop the connection and reconnect on the next wait
+            logger.warning(f'Task listener connection failed: {e}')
+            self.close()
+            sleep(1)
+            return False
+
+
 def count_remaining_task(task_type):
     """Returned count of remaining task."""
     return {
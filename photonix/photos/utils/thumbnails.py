@@ -1,4 +1,5 @@
 
+from contextlib import closing
 import io
 import os
 import math
@@ -9,15 +10,17 @@ import numpy as np
 
 from django.conf import settings
 from photonix.photos.models import Photo, PhotoFile, Task
+from photonix.photos.utils.tasks import claim_pending_tasks
 
 
 THUMBNAILER_VERSION = 20260127
 
 
 def process_generate_thumbnails_tasks():
-    for task in Task.objects.filter(type='generate_thumbnails', status='P').order_by('created_at'):
-        photo_id = task.subject_id
-        generate_thumbnails_for_photo(photo_id, task)
+    with closing(claim_pending_tasks('generate_thumbnails')) as tasks:
+        for task in tasks:
+            photo_id = task.subject_id
+            generate_thumbnails_for_photo(photo_id, task)
 
 
 def generate_thumbnails_for_photo(photo, task):
@@ -213,12 +213,36 @@ PHOTO_RAW_PROCESSED_DIR = '/data/raw-photos-processed'
 
 MODEL_INFO_URL = 'https://photonix.org/models.json'
 
+# Metadata reading
+EXIFTOOL_NUM_WORKERS = int(os.environ.get('EXIFTOOL_NUM_WORKERS', 4))  # Warm exiftool processes per worker process
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 2048))  # Files kept in each process's cache
+METADATA_CACHE_REDIS = os.environ.get('METADATA_CACHE_REDIS', 'false').lower() in ('1', 'true', 'yes')
+
 # Classifier model lifecycle management
 CLASSIFIER_IDLE_TIMEOUT_SECONDS = int(os.environ.get('CLASSIFIER_IDLE_TIMEOUT', 300))  # 5 min
 CLASSIFIER_WATCHDOG_INTERVAL_SECONDS = int(os.environ.get('CLASSIFIER_WATCHDOG_INTERVAL', 15))
 CLASSIFIER_MEMORY_BUFFER_MB = int(os.environ.get('CLASSIFIER_MEMORY_BUFFER_MB', 500))  # Safety buffer
 CLASSIFIER_MEMORY_RETRY_SECONDS = int(os.environ.get('CLASSIFIER_MEMORY_RETRY_SECONDS', 30))  # 30 sec retry
 CLASSIFIER_LOAD_COOLDOWN_SECONDS = int(os.environ.get('CLASSIFIER_LOAD_COOLDOWN', 15))
+CLASSIFIER_INFERENCE_BATCH_SIZE = int(os.environ.get('CLASSIFIER_INFERENCE_BATCH_SIZE', 8))  # Photos per model run
+CLASSIFIER_DECODE_THREADS = int(os.environ.get('CLASSIFIER_DECODE_THREADS', 4))
+
+# Face recognition
+FACE_EMBEDDING_BATCH_SIZE = int(os.environ.get('FACE_EMBEDDING_BATCH_SIZE', 32))  # Faces per Facenet call
+# Faces added since the last similarity index build are searched by brute force until there are this many of them...
+FACE_INDEX_MIN_NEW_FACES = int(os.environ.get('FACE_INDEX_MIN_NEW_FACES', 200))
+# ...or they make up this fraction of the index
+FACE_INDEX_REBUILD_FRACTION = float(os.environ.get('FACE_INDEX_REBUILD_FRACTION', 0.05))
+
+# Reverse-geocoding cache. Coordinates are rounded to LOCATION_CACHE_PRECISION
+# decimal places (3 is a cell of roughly 100m) to make the key.
+LOCATION_CACHE_PRECISION = int(os.environ.get('LOCATION_CACHE_PRECISION', 3))
+# Each cached cell takes roughly 1KB, which LocationModel.approx_ram_mb allows for
+LOCATION_CACHE_SIZE = int(os.environ.get('LOCATION_CACHE_SIZE', 20000))  # 0 turns the cache off
+LOCATION_CACHE_REDIS = os.environ.get('LOCATION_CACHE_REDIS', 'false') == 'true'
+
+# Longest a task worker waits before checking the queue anyway (delayed and memory-wait tasks don't notify)
+TASK_POLL_INTERVAL = float(os.environ.get('TASK_POLL_INTERVAL', 10))  # Seconds
 
 GRAPHENE = {
     'SCHEMA': 'photonix.web.schema.schema',
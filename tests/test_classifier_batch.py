@@ -10,6 +10,7 @@ import pytest
 
 from photonix.classifiers.color import ColorModel, run_on_photo
 from photonix.classifiers.style import StyleModel, run_on_photo
+from photonix.photos.models import Task
 from photonix.photos.utils.classification import ThreadedQueueProcessor
 from .factories import PhotoFactory, PhotoFileFactory, LibraryFactory, TaskFactory
 
@@ -33,3 +34,50 @@ def test_classifier_batch():
     assert photo.photo_tags.count() == 1
     assert photo.photo_tags.all()[0].tag.name == 'serene'
     assert photo.photo_tags.all()[0].confidence > 0.9
+
+
+@pytest.mark.django_db
+def test_classifier_prefetch_depth():
+    processed = []
+    lock = threading.Lock()
+
+    def runner(photo_id):
+        with lock:
+            processed.append(photo_id)
+        return None, None
+
+    for _ in range(6):
+        TaskFactory(type='classify.color', subject_id=uuid.uuid4())
+
+    # batch_size limits how many tasks are claimed ahead of the workers
+    threaded_queue_processor = ThreadedQueueProcessor(task_type='classify.color', runner=runner, num_workers=2, batch_size=4)
+    threaded_queue_processor.run(loop=False)
+
+    assert len(processed) == 4
+    assert Task.objects.filter(type='classify.color', status='C').count() == 4
+    assert Task.objects.filter(type='classify.color', status='P').count() == 2
+
+
+@pytest.mark.django_db
+def test_classifier_inference_batches():
+    batches = []
+    lock = threading.Lock()
+
+    def batch_runner(photo_ids):
+        with lock:
+            batches.append(len(photo_ids))
+        return [(PhotoFactory(), []) for _ in photo_ids]
+
+    def runner(photo_id):
+        raise AssertionError('Tasks should be classified in batches')
+
+    for _ in range(10):
+        TaskFactory(type='classify.color', subject_id=uuid.uuid4())
+
+    threaded_queue_processor = ThreadedQueueProcessor(
+        task_type='classify.color', runner=runner, batch_runner=batch_runner,
+        num_workers=1, batch_size=10, inference_batch_size=4)
+    threaded_queue_processor.run(loop=False)
+
+    assert batches == [4, 4, 2]
+    assert Task.objects.filter(type='classify.color', status='C').count() == 10
@@ -1,4 +1,5 @@
 import os
+from collections import Counter
 import time
 from datetime import datetime
 from pathlib import Path
@@ -7,6 +8,17 @@ from django.conf import settings
 from PIL import Image
 
 
+def add_face(library, embedding, name=None, verified=False, photo=None, created_at=None):
+    '''Adds a face with the given embedding to a library, on its own tag and (unless given) its own photo.'''
+    from photonix.classifiers.face.embeddings import embedding_to_bytes
+    from .factories import PhotoFactory, PhotoTagFactory, TagFactory
+
+    tag = TagFactory(library=library, type='F', source='C', **({'name': name} if name else {}))
+    return PhotoTagFactory(
+        photo=photo or PhotoFactory(library=library), tag=tag, source='F', confidence=1, verified=verified,
+        created_at=created_at, embedding=embedding_to_bytes(embedding))
+
+
 def test_downloading(tmpdir):
     from photonix.classifiers.style.model import StyleModel
 
@@ -33,6 +45,43 @@ def test_color_predict():
     assert expected == actual
 
 
+def test_color_predict_matches_per_pixel(tmpdir):
+    import numpy as np
+    from PIL import ImageOps
+    from photonix.classifiers.color.model import ColorModel
+
+    model = ColorModel()
+
+    def predict_per_pixel(image_file, image_size=32, min_score=0.005):
+        # Original implementation, one pixel and palette color at a time
+        image = ImageOps.exif_transpose(Image.open(image_file)).resize((image_size, image_size), Image.Resampling.BICUBIC)
+        summed = {}
+        for pixel in [j for i in np.asarray(image) for j in i]:
+            best_color, best_score = None, 0
+            for name, (target, _) in model.colors.items():
+                score = model.color_distance(pixel, target)
+                if score > best_score:
+                    best_color, best_score = name, score
+            if best_color:
+                summed[best_color] = summed.get(best_color, 0) + 1
+        results = [(k, v / (image_size * image_size)) for k, v in summed.items() if v / (image_size * image_size) >= min_score]
+        return sorted(results, key=lambda x: x[1], reverse=True)
+
+    # Noise, flat greys (hue is undefined) and the exact palette colors
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (32, 32, 3), dtype=np.uint8) for _ in range(3)]
+    images.append(np.repeat(rng.integers(0, 256, (32, 32, 1), dtype=np.uint8), 3, axis=2))
+    palette = np.array([target for target, _ in model.colors.values()], dtype=np.uint8)
+    images.append(palette[rng.integers(0, len(palette), (32, 32))])
+    for i, pixels in enumerate(images):
+        path = str(tmpdir / f'{i}.png')
+        Image.fromarray(pixels).save(path)
+        assert model.predict(path) == predict_per_pixel(path)
+
+    snow = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    assert model.predict(snow) == predict_per_pixel(snow)
+
+
 def test_location_predict():
     from photonix.classifiers.location.model import LocationModel
 
@@ -71,6 +120,117 @@ def test_location_predict():
     assert result['city']['name'] == 'Téteghem'
 
 
+def test_location_country_index():
+    import numpy as np
+    from photonix.classifiers.location.model import LocationModel
+
+    model = LocationModel()
+    model._ensure_loaded()
+
+    def scan_all_polygons(lon, lat):
+        for path, (name, code) in zip(model.polygon_paths, model.polygon_countries):
+            if path.contains_points([[lat, lon]])[0]:
+                return {'name': name, 'code': code}
+        return None
+
+    # Same answer as testing every polygon, including over the sea and near borders
+    rng = np.random.default_rng(0)
+    points = [(lat, lon) for lat, lon in zip(rng.uniform(-60, 75, 500), rng.uniform(-180, 180, 500))]
+    points += [(46.1760906, 5.9929043), (51.074323, 2.547278), (36.4396445, 25.3560936), (0.0, 0.0), (-90.0, 180.0)]
+    for point in points:
+        # Points are passed in the same order predict() does
+        assert model.get_country(*point) == scan_all_polygons(*point)
+
+
+def test_location_city_index():
+    import numpy as np
+    from photonix.classifiers.location.model import LocationModel
+
+    model = LocationModel()
+    model._ensure_loaded()
+
+    def scan_all_cities(lon, lat, country_code=None):
+        distances = model.haversine([lon, lat], [model.city_latitudes, model.city_longitudes]).astype(int)
+        best = None
+        for i in np.flatnonzero(distances < 10000):
+            code = model.city_country_codes[model.city_country_indexes[i]]
+            if country_code and code != country_code:
+                continue
+            if model.city_populations[i] > (best and best['population'] or 0):
+                best = {'name': model.city_names[i], 'population': model.city_populations[i], 'country_code': code}
+        return best
+
+    # Points scattered around real cities so most have several candidates
+    rng = np.random.default_rng(0)
+    cities = rng.choice(len(model.city_names), 200)
+    points = np.column_stack([model.city_latitudes[cities], model.city_longitudes[cities]]) + rng.normal(0, 0.05, (200, 2))
+    for lat, lon in points:
+        for country_code in [None, 'GB']:
+            expected = scan_all_cities(lat, lon, country_code)
+            result = model.get_city(lat, lon, country_code)
+            if expected is None:
+                assert result is None
+            else:
+                assert (result['name'], result['population'], result['country_code']) == (expected['name'], expected['population'], expected['country_code'])
+
+
+def test_location_bulk(db):
+    from photonix.classifiers.location.model import LocationModel, run_on_photos_in_bulk
+    from photonix.photos.models import Photo, PhotoTag
+    from .factories import LibraryFactory, PhotoFactory, PhotoTagFactory, TagFactory
+
+    library = LibraryFactory()
+    london = PhotoFactory(library=library, latitude=51.530421, longitude=-0.128645)
+    santorini = PhotoFactory(library=library, latitude=36.439645, longitude=25.356094)
+    at_sea = PhotoFactory(library=library, latitude=58.687674, longitude=-3.420686)
+    no_gps = PhotoFactory(library=library)
+    # Stale tag from an earlier run gets replaced
+    PhotoTagFactory(photo=london, tag=TagFactory(library=library, name='Atlantis', type='L', source='C'), source='C', confidence=1.0)
+
+    num_photos, num_tagged = run_on_photos_in_bulk(Photo.objects.filter(library=library), model=LocationModel(), batch_size=2)
+    assert (num_photos, num_tagged) == (3, 2)
+
+    def tag_names(photo):
+        return sorted(PhotoTag.objects.filter(photo=photo, tag__type='L').values_list('tag__name', flat=True))
+
+    assert tag_names(london) == ['London', 'United Kingdom']
+    assert tag_names(santorini) == ['Greece', 'Oía']
+    assert tag_names(at_sea) == []
+    assert tag_names(no_gps) == []
+    city = PhotoTag.objects.get(photo=london, tag__name='London')
+    assert city.tag.parent.name == 'United Kingdom'
+    assert city.created_at is not None
+
+
+def test_location_cache():
+    from photonix.classifiers.location.cache import LocationCache
+    from photonix.classifiers.location.model import LocationModel
+
+    cache = LocationCache(version=1, precision=3, size=2, use_redis=False)
+    cache.set(51.53042, -0.12864, {'country': {'name': 'United Kingdom'}})
+    # Same ~100m cell
+    result = cache.get(51.53011, -0.12871)
+    assert result == {'country': {'name': 'United Kingdom'}}
+    result['country']['name'] = 'Changed'
+    assert cache.get(51.5304, -0.1286)['country']['name'] == 'United Kingdom'
+    assert cache.get(51.5324, -0.1286) is None
+
+    # Least recently used cell is dropped first
+    cache.set(1, 1, {'country': None})
+    cache.set(2, 2, {'country': None})
+    assert cache.get(51.5304, -0.1286) is None
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 2
+
+    model = LocationModel()
+    model.cache = LocationCache(version=model.version, precision=3, use_redis=False)
+    first = model.predict(location=[51.5304213, -0.1286445])
+    assert model.predict(location=[51.5304100, -0.1286400]) == first
+    assert model.predict_many([[51.5304300, -0.1286500], [36.4396445, 25.3560936]])[0] == first
+    assert model.cache.stats()['hits'] == 2
+    assert model.cache.stats()['misses'] == 2
+
+
 def test_object_predict():
     from photonix.classifiers.object.model import ObjectModel
 
@@ -97,6 +257,27 @@ def test_object_predict():
     assert '{0:.3f}'.format(result[2]['significance']) == '0.025'
 
 
+def test_object_predict_shared_session():
+    from concurrent.futures import ThreadPoolExecutor
+    from photonix.classifiers.object.model import ObjectModel
+
+    model = ObjectModel()
+    snow = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    expected = [(r['label'], '{0:.3f}'.format(r['score'])) for r in model.predict(snow)]
+    session = model.session
+
+    # Worker threads share the one session and get the same answer
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: model.predict(snow), range(8)))
+    for result in results:
+        assert [(r['label'], '{0:.3f}'.format(r['score'])) for r in result] == expected
+    assert model.session is session
+
+    model.close()
+    assert model.session is None
+    assert len(model.predict(snow)) == len(expected)
+
+
 def test_style_predict():
     from photonix.classifiers.style.model import StyleModel
 
@@ -114,6 +295,35 @@ def test_style_predict():
     assert result == None
 
 
+def test_style_predict_batch():
+    from photonix.classifiers.style.model import StyleModel
+
+    model = StyleModel()
+    snow = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    cmyk = str(Path(__file__).parent / 'photos' / 'cmyk.tif')
+
+    # Undecodable images don't stop the rest of the batch
+    results = model.predict_batch([snow, cmyk, snow])
+    assert results[1] is None
+    for result in [results[0], results[2]]:
+        assert len(result) == 1
+        assert result[0][0] == 'serene'
+        assert '{0:.3f}'.format(result[0][1]) == '0.962'
+
+
+def test_object_predict_batch():
+    from photonix.classifiers.object.model import ObjectModel
+
+    model = ObjectModel()
+    snow = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    expected = [(r['label'], '{0:.3f}'.format(r['score'])) for r in model.predict(snow)]
+
+    results = model.predict_batch([snow, snow])
+    assert len(results) == 2
+    for result in results:
+        assert [(r['label'], '{0:.3f}'.format(r['score'])) for r in result] == expected
+
+
 def test_face_predict():
     from photonix.classifiers.face.model import FaceModel
     from photonix.classifiers.face.deepface.commons.distance import findEuclideanDistance
@@ -179,3 +389,288 @@ def test_face_predict():
             os.remove(Path(settings.MODEL_DIR) / 'face' / fn)
         except:
             pass
+
+
+def test_face_embeddings_batch():
+    import numpy as np
+    from photonix.classifiers.face.model import FaceModel
+
+    model = FaceModel()
+    paths = [str(Path(__file__).parent / 'photos' / 'faces' / fn) for fn in ['Boris_Becker_0003.jpg', 'David_Beckham_0001.jpg']]
+
+    # Faces from several photos go through Facenet together and come back in order
+    faces = []
+    for path in paths:
+        image = model.load_image(path)
+        for detection in model.detect_faces(image):
+            faces.append((image, detection))
+    assert len(faces) == 2
+
+    embeddings = model.get_face_embeddings(faces)
+    for (image, detection), embedding in zip(faces, embeddings):
+        assert len(embedding) == 128
+        single = model.get_face_embedding_from_detection(image, detection)
+        assert np.allclose(embedding, single, atol=1e-4)
+
+
+def test_face_embedding_matrix():
+    from datetime import timedelta
+    import numpy as np
+    from django.utils import timezone
+    from photonix.classifiers.face.embeddings import FaceEmbeddingMatrix
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(1000, 128)).astype(np.float32)
+    now = timezone.now()
+
+    matrix = FaceEmbeddingMatrix('00000000-0000-0000-0000-000000000000')
+    for i, embedding in enumerate(embeddings):
+        matrix.add(f'pt{i}', f'tag{i}', embedding, now - timedelta(days=i))
+    assert len(matrix) == 1000
+
+    # Nearest first and the same as a plain Euclidean distance
+    results = matrix.search(embeddings[10] + 0.01, k=3)
+    assert len(results) == 3
+    assert results[0][0] == 'tag10'
+    assert abs(results[0][1] - np.linalg.norm(embeddings[10] + 0.01 - embeddings[10])) < 0.001
+    assert results[0][1] <= results[1][1] <= results[2][1]
+
+    # Only faces created after a date
+    results = matrix.search(embeddings[10], k=1, created_after=now - timedelta(days=5, hours=12))
+    assert results[0][0] in [f'tag{i}' for i in range(6)]
+
+    # Re-adding a PhotoTag updates its row rather than adding another
+    matrix.add('pt10', 'renamed', embeddings[10], now)
+    assert len(matrix) == 1000
+    assert matrix.search(embeddings[10], k=1)[0][0] == 'renamed'
+
+    # Every face within a distance, nearest first
+    distances = np.linalg.norm(embeddings - embeddings[20], axis=1)
+    radius = np.sort(distances)[5] + 0.001
+    within = matrix.search_within(embeddings[20], radius)
+    assert [photo_tag_id for photo_tag_id, _, _ in within] == [f'pt{i}' for i in np.argsort(distances)[:6]]
+    assert within[0][1] == 'tag20'
+    assert within[0][2] < 0.001
+
+
+def test_face_embedding_storage(db):
+    import numpy as np
+    from photonix.classifiers.face.embeddings import FaceEmbeddingMatrix, embedding_from_bytes
+    from photonix.photos.models import PhotoTag
+    from .factories import LibraryFactory, PhotoFactory
+
+    rng = np.random.default_rng(1)
+    embeddings = rng.normal(size=(3, 128)).astype(np.float32)
+    library = LibraryFactory()
+    photo = PhotoFactory(library=library)
+    photo_tags = [add_face(library, embedding, photo=photo) for embedding in embeddings]
+    tags = [photo_tag.tag for photo_tag in photo_tags]
+
+    # Stored as 512 bytes and read back unchanged
+    stored = PhotoTag.objects.get(id=photo_tags[0].id).embedding
+    assert len(stored) == 512
+    assert np.array_equal(embedding_from_bytes(stored), embeddings[0])
+
+    matrix = FaceEmbeddingMatrix(library.id)
+    matrix.refresh()
+    assert len(matrix) == 3
+    assert matrix.search(embeddings[1])[0][0] == str(tags[1].id)
+
+    # Deleted faces are dropped on the next refresh
+    photo_tags[1].delete()
+    matrix.refresh()
+    assert len(matrix) == 2
+    assert matrix.search(embeddings[1])[0][0] != str(tags[1].id)
+
+
+def test_face_similarity_index_reload():
+    import numpy as np
+    from photonix.classifiers.face.model import FaceModel
+
+    model = FaceModel()
+    model.library_id = '00000000-0000-0000-0000-000000000001'
+    rng = np.random.default_rng(2)
+    embeddings = rng.normal(size=(4, 128)).tolist()
+
+    try:
+        model.retrain_face_similarity_index(training_data=[('a', embeddings[0]), ('b', embeddings[1])])
+        index, tag_ids = model.get_similarity_index()
+        assert tag_ids == ['a', 'b']
+
+        # Held open between lookups
+        assert model.get_similarity_index()[0] is index
+        assert model.find_closest_face_tag_by_ann(embeddings[1])[0] == 'b'
+
+        # A rebuild gets picked up on the next lookup
+        model.retrain_face_similarity_index(training_data=[('c', embeddings[2]), ('d', embeddings[3])])
+        new_index, tag_ids = model.get_similarity_index()
+        assert new_index is not index
+        assert tag_ids == ['c', 'd']
+        assert model.find_closest_face_tag_by_ann(embeddings[3])[0] == 'd'
+    finally:
+        for fn in ['faces.ann', 'faces_tag_ids.json', 'retrained_version.txt']:
+            try:
+                os.remove(Path(settings.MODEL_DIR) / 'face' / f'{model.library_id}_{fn}')
+            except FileNotFoundError:
+                pass
+
+
+def test_face_similarity_index_per_library(db):
+    from datetime import timedelta
+    import numpy as np
+    from django.utils import timezone
+    from photonix.classifiers.face.model import FaceModel
+    from .factories import LibraryFactory, TagFactory
+
+    rng = np.random.default_rng(3)
+    yesterday = timezone.now() - timedelta(days=1)
+
+    library = LibraryFactory()
+    photo_tags = [add_face(library, rng.normal(size=128), created_at=yesterday) for _ in range(3)]
+    add_face(LibraryFactory(), rng.normal(size=128), created_at=yesterday)
+
+    model = FaceModel(library_id=library.id)
+    try:
+        assert model.similarity_index_needs_retrain() == 'no index yet for 3 faces'
+
+        # Only faces from this library are indexed
+        stats = model.retrain_face_similarity_index()
+        assert stats['num_items'] == 3
+        assert model.similarity_index_needs_retrain() is None
+
+        # A few new faces are left to the brute force search
+        add_face(library, rng.normal(size=128))
+        assert model.similarity_index_needs_retrain() is None
+
+        # Editing a face means the index would return the old tag
+        photo_tags[0].tag = TagFactory(library=library, type='F')
+        photo_tags[0].save()
+        assert model.similarity_index_needs_retrain() == '1 edited and 0 deleted faces'
+    finally:
+        for fn in ['faces.ann', 'faces_tag_ids.json', 'retrained_version.txt']:
+            try:
+                os.remove(Path(settings.MODEL_DIR) / 'face' / f'{library.id}_{fn}')
+            except FileNotFoundError:
+                pass
+
+
+def test_cluster_faces(db):
+    import numpy as np
+    from django.core.management import call_command
+    from photonix.classifiers.face.model import FaceModel
+    from photonix.photos.models import PhotoTag, Tag
+    from .factories import LibraryFactory
+
+    rng = np.random.default_rng(4)
+    library = LibraryFactory()
+    people = rng.normal(size=(2, 128)) * 10
+
+    # Three photos each of two people plus someone only seen once, all with their own tag
+    for i in range(3):
+        add_face(library, people[0] + rng.normal(size=128) * 0.1, f'Unknown person 00000{i}')
+        add_face(library, people[1] + rng.normal(size=128) * 0.1, f'Unknown person 00001{i}')
+    add_face(library, rng.normal(size=128) * 10, 'Unknown person 000020')
+    # Faces the user has named are left alone
+    named = add_face(library, people[0], 'Alice', verified=True)
+
+    try:
+        call_command('cluster_faces', library=str(library.id))
+
+        assert Tag.objects.filter(library=library, type='F').count() == 4
+        tags = PhotoTag.objects.filter(photo__library=library).exclude(id=named.id).values_list('tag__name', flat=True)
+        assert sorted(Counter(tags).values()) == [1, 3, 3]
+        assert PhotoTag.objects.get(id=named.id).tag.name == 'Alice'
+
+        # The similarity index is rebuilt so it only refers to tags that still exist
+        _, tag_ids = FaceModel(library_id=library.id).get_similarity_index()
+        assert len(tag_ids) == 8
+        assert set(tag_ids) == {str(id) for id in Tag.objects.filter(library=library, type='F').values_list('id', flat=True)}
+    finally:
+        for fn in ['faces.ann', 'faces_tag_ids.json', 'retrained_version.txt']:
+            try:
+                os.remove(Path(settings.MODEL_DIR) / 'face' / f'{library.id}_{fn}')
+            except FileNotFoundError:
+                pass
+
+
+def test_cluster_faces_chain(db):
+    import numpy as np
+    from django.core.management import call_command
+    from photonix.classifiers.face.embeddings import cluster_embeddings
+    from photonix.classifiers.face.model import DISTANCE_THRESHOLD
+    from photonix.photos.models import PhotoTag
+    from .factories import LibraryFactory
+
+    # A is close to B and B is close to C, but A and C are too far apart to be the same person
+    direction = np.zeros(128)
+    direction[0] = DISTANCE_THRESHOLD * 0.8
+    chain = [direction * 0, direction, direction * 2]
+    labels = cluster_embeddings(np.stack(chain), DISTANCE_THRESHOLD)
+    assert labels[0] != labels[2]
+    assert len(set(labels)) == 2
+
+    # Every face in a cluster is close to all the others
+    rng = np.random.default_rng(6)
+    embeddings = rng.normal(size=(300, 128)) * 0.6
+    labels = cluster_embeddings(embeddings, DISTANCE_THRESHOLD, max_block_elements=1000)
+    for label in set(labels):
+        members = embeddings[labels == label]
+        distances = np.linalg.norm(members[:, None] - members[None], axis=2)
+        assert distances.max() < DISTANCE_THRESHOLD
+
+    library = LibraryFactory()
+    photo_tags = [add_face(library, embedding, f'Unknown person 00000{i}') for i, embedding in enumerate(chain)]
+
+    # A dry run doesn't change anything
+    call_command('cluster_faces', library=str(library.id), dry_run=True)
+    assert len(set(PhotoTag.objects.filter(photo__library=library).values_list('tag_id', flat=True))) == 3
+
+    try:
+        call_command('cluster_faces', library=str(library.id))
+        tag_ids = [PhotoTag.objects.get(id=photo_tag.id).tag_id for photo_tag in photo_tags]
+        assert tag_ids[0] != tag_ids[2]
+        assert len(set(tag_ids)) == 2
+    finally:
+        for fn in ['faces.ann', 'faces_tag_ids.json', 'retrained_version.txt']:
+            try:
+                os.remove(Path(settings.MODEL_DIR) / 'face' / f'{library.id}_{fn}')
+            except FileNotFoundError:
+                pass
+
+
+def test_propagate_face_tag(db):
+    import numpy as np
+    from photonix.classifiers.face.model import FaceModel, propagate_face_tag
+    from photonix.photos.models import PhotoTag, Tag
+    from .factories import LibraryFactory
+
+    rng = np.random.default_rng(5)
+    library = LibraryFactory()
+    person = rng.normal(size=128) * 10
+
+    named = add_face(library, person, 'Bob', verified=True)
+    same_person = [add_face(library, person + rng.normal(size=128) * 0.1, f'Unknown person 00000{i}') for i in range(3)]
+    someone_else = add_face(library, rng.normal(size=128) * 10, 'Unknown person 000010')
+
+    model = FaceModel(library_id=library.id)
+    try:
+        model.retrain_face_similarity_index()
+        assert model.get_similarity_index()[1] is not None
+
+        assert propagate_face_tag(named.id) == 3
+        for photo_tag in same_person:
+            assert PhotoTag.objects.get(id=photo_tag.id).tag_id == named.tag_id
+        assert PhotoTag.objects.get(id=someone_else.id).tag.name == 'Unknown person 000010'
+        # The emptied unknown tags are removed
+        assert Tag.objects.filter(library=library, type='F').count() == 2
+
+        # The index referred to the removed tags so it's dropped until rebuilt
+        assert model.get_similarity_index() == (None, None)
+        assert model.retrained_version == 0
+        assert model.similarity_index_needs_retrain() == 'no index yet for 5 faces'
+    finally:
+        for fn in ['faces.ann', 'faces_tag_ids.json', 'retrained_version.txt']:
+            try:
+                os.remove(Path(settings.MODEL_DIR) / 'face' / f'{library.id}_{fn}')
+            except FileNotFoundError:
+                pass
@@ -3,11 +3,15 @@ import shutil
 import tempfile
 from datetime import datetime, timezone
 from pathlib import Path
+from unittest import mock
 
 import pytest
 
-from photonix.photos.utils.db import record_photo
-from photonix.photos.utils.metadata import PhotoMetadata, parse_gps_location, get_datetime
+from photonix.photos.models import LibraryPath, Photo, PhotoFile, Task
+from photonix.photos.utils.db import is_supported_file, record_photo, record_photos_bulk
+from photonix.photos.utils.filetypes import get_image_mimetype, sniff_mimetype
+from photonix.photos.utils.organise import import_photos_in_place
+from photonix.photos.utils.metadata import PhotoMetadata, ExiftoolPool, metadata_cache, needs_own_exiftool_process, parse_gps_location, get_datetime, get_dimensions
 from .factories import LibraryFactory
 
 
@@ -27,6 +31,128 @@ def test_metadata():
     assert metadata.get('Artist') == ''
 
 
+def test_metadata_pool():
+    # Persistent exiftool processes should give the same output as forking one per file
+    photo_path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    assert PhotoMetadata(photo_path).get_all() == PhotoMetadata(photo_path, use_pool=False).get_all()
+
+    # A crashed worker gets replaced transparently
+    pool = ExiftoolPool(num_workers=1)
+    first_output = pool.execute(photo_path)
+    pool._processes[0].process.kill()
+    pool._processes[0].process.wait()
+    assert pool.execute(photo_path) == first_output
+    assert len(pool._processes) == 1
+    pool.close()
+
+
+def test_metadata_bulk():
+    # Reading many files in one exiftool call gives the same values as reading one at a time
+    paths = [str(Path(__file__).parent / 'photos' / fn) for fn in ['snow.jpg', 'tree.jpg', 'does_not_exist.jpg']]
+    results = list(PhotoMetadata.bulk(paths, chunk_size=2))
+    assert [metadata.path for metadata in results] == paths
+    for key in ['Image Size', 'Date Time', 'Make', 'ISO', 'MIME Type']:
+        assert results[0].get(key) == PhotoMetadata(paths[0]).get(key)
+    assert results[2].get('MIME Type') == 'image/jpeg'
+
+    # Reading in a pool of processes gives the same results in the same order
+    parallel_results = list(PhotoMetadata.bulk(paths, chunk_size=1, num_workers=2))
+    assert [metadata.get_all() for metadata in parallel_results] == [metadata.get_all() for metadata in results]
+
+    # Numeric GPS output is used instead of parsing the degrees/minutes/seconds string
+    latitude, longitude = results[1].get_gps_location()
+    expected_latitude, expected_longitude = PhotoMetadata(paths[1]).get_gps_location()
+    assert abs(latitude - expected_latitude) < 0.0001
+    assert abs(longitude - expected_longitude) < 0.0001
+
+
+def test_metadata_bulk_missing_entries():
+    # Files exiftool's JSON doesn't cover are read individually rather than left empty
+    photo_path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    metadata_cache.clear()
+    with mock.patch('photonix.photos.utils.metadata.run_exiftool_json', return_value=[]):
+        results = list(PhotoMetadata.bulk([photo_path]))
+    assert results[0].get('Make') == 'Xiaomi'
+    assert results[0].get('Date Time') == '2018:02:28 07:16:25'
+    metadata_cache.clear()
+
+    # Duplicate descriptions keep the last value, like the plain text output
+    metadata = PhotoMetadata(photo_path, exiftool_json={
+        'SourceFile': photo_path,
+        'EXIF:Make': {'desc': 'Make', 'val': 'First'},
+        'MakerNotes:Make': {'desc': 'Make', 'val': 'Second'},
+    }, use_cache=False)
+    assert metadata.get('Make') == 'Second'
+
+
+def test_metadata_unusual_filenames():
+    snow_path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    assert needs_own_exiftool_process('#photo.jpg')
+    assert needs_own_exiftool_process(' photo.jpg')
+    assert not needs_own_exiftool_process('/photos/my photo.jpg')
+
+    # Trailing whitespace would be stripped from an argument file line
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'snow.jpg ')
+        shutil.copy2(snow_path, path)
+        metadata_cache.clear()
+        assert PhotoMetadata(path).get('Make') == 'Xiaomi'
+        metadata_cache.clear()
+        assert list(PhotoMetadata.bulk([path]))[0].get('Make') == 'Xiaomi'
+
+
+def test_metadata_cache():
+    photo_path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    metadata_cache.clear()
+
+    metadata = PhotoMetadata(photo_path)
+    assert metadata_cache.stats()['misses'] == 1
+    assert metadata_cache.stats()['hits'] == 0
+
+    # Later stages re-reading the same unchanged file are served from the cache
+    assert get_dimensions(photo_path) == (800, 600)
+    assert PhotoMetadata(photo_path).get_all() == metadata.get_all()
+    assert metadata_cache.stats()['hits'] == 2
+
+    # Modifying the file invalidates the entry
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        copy_path = os.path.join(tmp_dir, 'snow.jpg')
+        shutil.copy2(photo_path, copy_path)
+        PhotoMetadata(copy_path)
+        os.utime(copy_path, (0, 0))
+        PhotoMetadata(copy_path)
+    assert metadata_cache.stats()['misses'] == 3
+
+    # Changing a reading afterwards doesn't alter what the cache hands out
+    metadata.data['Make'] = 'Changed'
+    assert PhotoMetadata(photo_path).get('Make') == 'Xiaomi'
+
+
+def test_image_mimetype():
+    photos_dir = Path(__file__).parent / 'photos'
+    assert get_image_mimetype(str(photos_dir / 'snow.jpg')) == 'image/jpeg'
+    assert get_image_mimetype(str(photos_dir / 'cmyk.tif')) == 'image/tiff'
+    assert get_image_mimetype(str(photos_dir / 'missing.jpg')) is None
+    assert get_image_mimetype(__file__) is None
+
+    # Raw and container formats are recognised from their headers
+    assert sniff_mimetype(b'II*\x00\x10\x00\x00\x00CR\x02\x00') == 'image/x-canon-cr2'
+    assert sniff_mimetype(b'II*\x00\x08\x00\x00\x00', 'DSC_0001.NEF') == 'image/x-nikon-nef'
+    assert sniff_mimetype(b'FUJIFILMCCD-RAW 0201FF383501') == 'image/x-fujifilm-raf'
+    assert sniff_mimetype(b'IIU\x00\x18\x00\x00\x00') == 'image/x-panasonic-rw2'
+    assert sniff_mimetype(b'\x00\x00\x00\x18ftypcrx \x00\x00\x00\x01crx isom') == 'image/x-canon-cr3'
+    assert sniff_mimetype(b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic') == 'image/heic'
+    assert sniff_mimetype(b'\x00\x00\x00\x1cftypavif\x00\x00\x00\x00avifmif1miaf') == 'image/avif'
+    assert sniff_mimetype(b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom') is None
+    assert sniff_mimetype(b'RIFF\x00\x00\x00\x00WEBPVP8 ') == 'image/webp'
+
+    # Non-images are rejected without launching dcraw
+    with mock.patch('photonix.photos.utils.db.subprocess.run') as run:
+        assert not is_supported_file(__file__)
+        assert is_supported_file(str(photos_dir / 'snow.jpg'))
+        assert not run.called
+
+
 def test_location():
     # Conversion from GPS exif data to latitude/longitude
     gps_position = '64 deg 9\' 0.70" N, 21 deg 56\' 3.47" W'
@@ -81,3 +207,125 @@ def test_duplicate_date_photos():
         photo2 = record_photo(path_photo2, library)
 
         assert photo1 != photo2
+
+
+@pytest.mark.django_db
+def test_record_photos_bulk(django_assert_max_num_queries):
+    library = LibraryFactory()
+    snow_path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i in range(10):
+            path = os.path.join(tmp_dir, f'snow_{i}.jpg')
+            shutil.copy2(snow_path, path)
+            paths.append(path)
+
+        # Whole chunk is written with a fixed number of queries
+        with django_assert_max_num_queries(20):
+            counts = record_photos_bulk(PhotoMetadata.bulk(paths), library)
+        assert counts == {'imported': 10, 'skipped': 0, 'bad': 0}
+        assert Photo.objects.filter(library=library).count() == 10
+        assert PhotoFile.objects.filter(path__in=paths).count() == 10
+        assert Task.objects.filter(type='ensure_raw_processed', library=library).count() == 10
+        photo_file = PhotoFile.objects.get(path=paths[0])
+        assert photo_file.photo.camera.make == 'Xiaomi'
+        assert photo_file.bytes == os.stat(snow_path).st_size
+
+        # Unchanged files are skipped on the next scan
+        counts = record_photos_bulk(PhotoMetadata.bulk(paths), library)
+        assert counts == {'imported': 0, 'skipped': 10, 'bad': 0}
+
+
+@pytest.mark.django_db
+def test_rescan_unchanged_library():
+    library = LibraryFactory()
+    snow_path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.mkdir(os.path.join(tmp_dir, 'sub'))
+        paths = [os.path.join(tmp_dir, 'a.jpg'), os.path.join(tmp_dir, 'sub', 'b.jpg')]
+        for path in paths:
+            shutil.copy2(snow_path, path)
+        library_path = LibraryPath.objects.create(library=library, type='St', backend_type='Lo', path=tmp_dir)
+
+        import_photos_in_place(library_path)
+        assert PhotoFile.objects.filter(photo__library=library).count() == 2
+
+        # Nothing changed so no files should have their metadata read
+        with mock.patch('photonix.photos.utils.metadata.run_exiftool_json') as run_exiftool_json:
+            import_photos_in_place(library_path)
+            assert not run_exiftool_json.called
+
+        # Modified files are re-read and removed ones are deleted
+        os.utime(paths[0], (0, 0))
+        os.remove(paths[1])
+        import_photos_in_place(library_path)
+        assert PhotoFile.objects.filter(photo__library=library).count() == 1
+        assert PhotoFile.objects.get(photo__library=library).path == paths[0]
+
+
+@pytest.mark.django_db
+def test_rescan_unreadable_paths_keep_photos():
+    library = LibraryFactory()
+    snow_path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, 'library')
+        os.makedirs(os.path.join(root, 'sub'))
+        paths = [os.path.join(root, 'a.jpg'), os.path.join(root, 'sub', 'b.jpg')]
+        for path in paths:
+            shutil.copy2(snow_path, path)
+        library_path = LibraryPath.objects.create(library=library, type='St', backend_type='Lo', path=root)
+        import_photos_in_place(library_path)
+        assert PhotoFile.objects.filter(photo__library=library).count() == 2
+
+        # Library root missing, e.g. an unmounted drive
+        os.rename(root, root + '_unmounted')
+        import_photos_in_place(library_path)
+        assert PhotoFile.objects.filter(photo__library=library).count() == 2
+        os.rename(root + '_unmounted', root)
+
+        # A subdirectory can't be listed
+        real_scandir = os.scandir
+
+        def scandir(path):
+            if path == os.path.join(root, 'sub'):
+                raise PermissionError(path)
+            return real_scandir(path)
+
+        with mock.patch('os.scandir', side_effect=scandir):
+            import_photos_in_place(library_path)
+        assert PhotoFile.objects.filter(photo__library=library).count() == 2
+        assert Photo.objects.filter(library=library).count() == 2
+
+
+
+@pytest.mark.django_db
+def test_rescan_empty_or_mostly_missing_path_keeps_photos():
+    library = LibraryFactory()
+    snow_path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.join(tmp_dir, 'library')
+        elsewhere = os.path.join(tmp_dir, 'elsewhere')
+        os.mkdir(root)
+        os.mkdir(elsewhere)
+        names = [f'{i}.jpg' for i in range(4)]
+        for name in names:
+            shutil.copy2(snow_path, os.path.join(root, name))
+        library_path = LibraryPath.objects.create(library=library, type='St', backend_type='Lo', path=root)
+        import_photos_in_place(library_path)
+        assert PhotoFile.objects.filter(photo__library=library).count() == 4
+
+        # Root exists but is empty, like the mount point of an unmounted share
+        for name in names:
+            os.rename(os.path.join(root, name), os.path.join(elsewhere, name))
+        import_photos_in_place(library_path)
+        assert PhotoFile.objects.filter(photo__library=library).count() == 4
+
+        # Most of the path has gone
+        os.rename(os.path.join(elsewhere, names[0]), os.path.join(root, names[0]))
+        with mock.patch('photonix.photos.utils.organise.MASS_DELETE_MIN_FILES', 0):
+            import_photos_in_place(library_path)
+            assert PhotoFile.objects.filter(photo__library=library).count() == 4
+
+            # Unless the deletions are confirmed
+            import_photos_in_place(library_path, allow_mass_delete=True)
+            assert PhotoFile.objects.filter(photo__library=library).count() == 1
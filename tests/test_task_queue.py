@@ -1,12 +1,22 @@
+from contextlib import closing
 from pathlib import Path
+import queue
+import socket
+import subprocess
+import sys
+import threading
+from time import time
+from unittest import mock
 
+from django.db import connection
 from django.utils import timezone
 import pytest
 
-from .factories import LibraryFactory
-from photonix.photos.models import Task
+from .factories import LibraryFactory, TaskFactory
+from photonix.photos.models import Task, get_worker_id
 from photonix.photos.utils.classification import process_classify_images_tasks
 from photonix.photos.utils.raw import ensure_raw_processing_tasks
+from photonix.photos.utils.tasks import TaskListener, claim_pending_tasks, release_queued_tasks, requeue_dead_worker_tasks
 from photonix.photos.utils.thumbnails import process_generate_thumbnails_tasks
 
 # pytestmark = pytest.mark.django_db
@@ -86,3 +96,118 @@ def test_tasks_created_updated(photo_fixture_snow):
         child.complete()
         assert child.status == 'C'
     assert task.status == 'C'
+
+
+def test_task_claim(db):
+    library = LibraryFactory(classification_style_enabled=True)
+    low = TaskFactory(library=library, priority=0)
+    high = TaskFactory(library=library, priority=10)
+    TaskFactory(library=LibraryFactory(classification_style_enabled=False))
+
+    # Highest priority first and only for libraries with the classifier enabled
+    tasks = Task.objects.claim('classify.style', limit=1, worker_id='host:1', library__classification_style_enabled=True)
+    assert [task.id for task in tasks] == [high.id]
+    assert tasks[0].status == 'S'
+    high.refresh_from_db()
+    assert high.status == 'S'
+    assert high.claimed_by == 'host:1'
+    assert (timezone.now() - high.started_at).seconds < 1
+
+    # Claimed tasks aren't handed out again
+    tasks = Task.objects.claim('classify.style', limit=8, worker_id='host:2', library__classification_style_enabled=True)
+    assert [task.id for task in tasks] == [low.id]
+    assert Task.objects.claim('classify.style', library__classification_style_enabled=True) == []
+
+    # Starting a claimed task doesn't need another write
+    started_at = tasks[0].started_at
+    tasks[0].start()
+    assert tasks[0].started_at == started_at
+
+
+def test_release_queued_tasks(db):
+    library = LibraryFactory()
+    for _ in range(3):
+        TaskFactory(library=library)
+    tasks = Task.objects.claim('classify.style', limit=3, worker_id='host:1')
+
+    # The first task has been handed to a worker, the other two are still buffered
+    task_queue = queue.Queue()
+    for task in tasks[1:]:
+        task_queue.put(task)
+    task_queue.put(None)
+
+    assert release_queued_tasks(task_queue) == 2
+    assert task_queue.empty()
+    assert Task.objects.get(id=tasks[0].id).status == 'S'
+    for task in tasks[1:]:
+        task.refresh_from_db()
+        assert task.status == 'P'
+        assert task.claimed_by is None
+        assert task.started_at is None
+
+
+def test_requeue_dead_worker_tasks(db):
+    hostname = socket.gethostname()
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+
+    library = LibraryFactory()
+    dead = TaskFactory(library=library, status='S', claimed_by=f'{hostname}:{process.pid}')
+    own = TaskFactory(library=library, status='S', claimed_by=get_worker_id())
+    alive = TaskFactory(library=library, status='S', claimed_by=f'{hostname}:1')
+    other_host = TaskFactory(library=library, status='S', claimed_by=f'{hostname}-other:{process.pid}')
+    other_type = TaskFactory(library=library, type='classify.color', status='S', claimed_by=f'{hostname}:{process.pid}')
+
+    assert requeue_dead_worker_tasks('classify.style') == 2
+    for task, status in [(dead, 'P'), (own, 'P'), (alive, 'S'), (other_host, 'S'), (other_type, 'S')]:
+        task.refresh_from_db()
+        assert task.status == status
+
+
+def test_claim_pending_tasks_releases_remainder(db):
+    library = LibraryFactory()
+    for _ in range(4):
+        TaskFactory(library=library)
+
+    # Handling the second task fails so the two after it were never handed out
+    handled = []
+    with pytest.raises(RuntimeError):
+        with closing(claim_pending_tasks('classify.style', batch_size=4)) as tasks:
+            for task in tasks:
+                handled.append(task)
+                if len(handled) == 2:
+                    raise RuntimeError
+
+    assert Task.objects.filter(status='S').count() == 2
+    assert Task.objects.filter(status='P', claimed_by__isnull=True).count() == 2
+    assert set(Task.objects.filter(status='S').values_list('id', flat=True)) == {task.id for task in handled}
+
+
+def test_task_listener_poll_fallback(db, settings):
+    settings.TASK_POLL_INTERVAL = 3
+    listener = TaskListener(['classify.style'])
+    assert listener.poll_interval == 3
+    if connection.vendor == 'postgresql':
+        pytest.skip('Postgres is woken by notifications instead')
+
+    # Databases without LISTEN/NOTIFY sleep for a second and report no wake-up
+    with mock.patch('photonix.photos.utils.tasks.sleep') as sleep:
+        assert listener.wait() is False
+    sleep.assert_called_once_with(1)
+
+
+@pytest.mark.skipif(connection.vendor != 'postgresql', reason='LISTEN/NOTIFY needs Postgres')
+def test_task_listener_wakes_on_insert(transactional_db):
+    library = LibraryFactory()
+    listener = TaskListener(['classify.style'], poll_interval=30)
+    listener._connect()
+    try:
+        # A task of another type doesn't wake it but a matching one does
+        timer = threading.Timer(0.2, lambda: (TaskFactory(library=library, type='classify.color'), TaskFactory(library=library)))
+        timer.start()
+        start = time()
+        assert listener.wait() is True
+        assert time() - start < 5
+        timer.join()
+    finally:
+        listener.close()